@@ -35,12 +35,15 @@
 
 """
 
-import os
-import re
 import argparse
-import subprocess
 
-debug = False
+from engine import (DEFAULTS, MIN_BATCH_SIZE, MAX_COMMAND_LENGTH, plan,
+                    print_plan, run_plan, make_pool, make_executor, watch,
+                    check_renderer, stream_plan)
+from metrics import Metrics
+from render import RenderError
+from priority import POLICIES
+from broker import Coordinator, Worker, parse_address, new_authkey
 
 parser = argparse.ArgumentParser(description='''A script to facilitate
 the automatic conversion of STM data with Omicron VernissageCmd and/or
@@ -64,6 +67,15 @@ This script use {path} and {outdir} to format the command string.
 parser.add_argument('--vernissageexporter',
     default='Flattener',
     help='''Can be any Vernissage supported exporter plug-in name.''')
+parser.add_argument('--vernissagegroup', default=1, type=int, metavar='N',
+    help='''Convert up to N folders with each VernissageCmd call, repeating
+the flag before {path}, so that Wine and Vernissage start once for several
+small folders. Folders with files of the same name are converted
+separately. The folders of a failed call are then converted one by one,
+each with its own --retries.''')
+parser.add_argument('--vernissagegroupsize', default=100, type=int,
+    metavar='MB',
+    help='Maximal size of the files converted by one VernissageCmd call.')
 
 # Gwyexport related options
 parser.add_argument('--noimage', default=False, action='store_true',
@@ -71,18 +83,35 @@ parser.add_argument('--noimage', default=False, action='store_true',
 parser.add_argument('--gwyexportcmd', default='gwyexport',
     help='Path/Executable name for gwyexport')
 parser.add_argument('--gwyexportflags',
-    default=('-s -f {exportformat} -m -o "{outputpath}" --filters'
-             '{filterlist} --gradient {gradient} --colormap'
-             ' {colormap} {inputfiles}'),
+    default=DEFAULTS['gwyexportflags'],
     help='''Gwyexport command flags, see gwyexport for help.
 
 This script use {exportformat}, {outputpath}, {filterlist}, {gradient},
-{colormap} and {inputfiles} to format the command string.
+{colormap} and {inputfiles} to format the command string, or
+{inputfolder} to convert the whole folder with a single command.
     ''')
+parser.add_argument('--engine', dest='renderer',
+    choices=['gwyexport', 'native'], default=DEFAULTS['renderer'],
+    help='''Render the images with Gwyexport, or with the built-in NumPy
+renderer (native), which renders the Flattener files in the worker
+processes without starting a command. The native renderer needs NumPy, and
+PIL for the jpg format.''')
+parser.add_argument('--direct', default=False, action='store_true',
+    help='''With --engine native, render the Matrix image files directly,
+without Vernissage. Vernissage still converts the folders with files the
+native reader does not support, like spectroscopy curves.''')
 parser.add_argument('-io', '--imageoutfolder', default='img_out',
     help='Image files output folder')
 parser.add_argument('-f', '--format', choices=['jpg','png'], default='jpg',
     help='Image output format')
+parser.add_argument('--include', action='append', default=[],
+    metavar='GLOB',
+    help='''Pass the files matching GLOB to Gwyexport, even if not recognised as
+data files. Can be given several times.''')
+parser.add_argument('--exclude', action='append', default=[],
+    metavar='GLOB',
+    help='''Never pass the files matching GLOB to Gwyexport. Can be given
+several times.''')
 parser.add_argument('--filters', default='pc;melc;sr;melc;pc',
     help='A list of Gwyddion filter/modules separated by semicolon.')
 parser.add_argument('--gradient', default='Wrappmono',
@@ -97,100 +126,168 @@ parser.add_argument('--quiet', dest='verbose', default=True,
     help='Output executed command and running informations.')
 parser.add_argument('-R', '--recursive', default=False, action='store_true',
     help='Convert also data in all subfolders')
+parser.add_argument('-j', '--jobs', default=1, type=int,
+    help='''Number of processes run simultaneously. Each folder is still
+exported first with Vernissage and then with Gwyexport, the files of a
+folder are split among the jobs for Gwyexport.''')
+parser.add_argument('--executor', choices=['events', 'pool'],
+    default=DEFAULTS['executor'],
+    help='''Run the processes from a single event loop forwarding their
+output (events, default on POSIX systems) or from a pool of worker
+processes (pool, default elsewhere).''')
+parser.add_argument('--adaptive', default=False, action='store_true',
+    help='''Adapt the number of simultaneous Vernissage and Gwyexport processes,
+each between --minjobs and --jobs, to the CPU load, I/O wait and
+throughput.''')
+parser.add_argument('--minjobs', default=1, type=int,
+    help='Minimal number of processes per tool with --adaptive.')
+parser.add_argument('--minbatch', default=MIN_BATCH_SIZE, type=int,
+    help='''Minimal size in bytes of the files given to one Gwyexport call,
+smaller folders are not split since the startup of Gwyexport would
+dominate.''')
+parser.add_argument('--maxcmdlength', default=MAX_COMMAND_LENGTH, type=int,
+    help='''Maximal length of a Gwyexport command line, larger folders are
+split in several calls, and of a VernissageCmd command line converting
+several folders.''')
+parser.add_argument('--priority', choices=POLICIES, default='walk',
+    help='''Order in which the folders are converted: in the walk order,
+the most recently modified first, or the smallest first.''')
+parser.add_argument('--pin', action='append', default=[], metavar='FOLDER',
+    help='''Convert FOLDER before the others, whatever --priority. Can be
+given several times.''')
+parser.add_argument('--vernissagetimeout', default=0, type=float,
+    metavar='SECONDS',
+    help='Stop a Vernissage job running longer than SECONDS, 0 for no limit.')
+parser.add_argument('--gwyexporttimeout', default=0, type=float,
+    metavar='SECONDS',
+    help='Stop a Gwyexport job running longer than SECONDS, 0 for no limit.')
+parser.add_argument('--idletimeout', default=0, type=float, metavar='SECONDS',
+    help='''Stop a job which did not output anything for SECONDS, as hung, 0
+to never stop it.''')
+parser.add_argument('--retries', default=2, type=int,
+    help='''Number of times a failed or stopped job is run again, waiting
+--retrydelay seconds, doubled at each retry.''')
+parser.add_argument('--retrydelay', default=10, type=float, metavar='SECONDS',
+    help='Delay before the first retry of a failed job.')
+parser.add_argument('--deadletter', metavar='FILE',
+    help='''Append the jobs which still failed after the retries to FILE, as
+JSON lines.''')
+parser.add_argument('--metrics', metavar='FILE',
+    help='''Append the timing and throughput record of each job to FILE, as
+JSON lines.''')
+parser.add_argument('--cache', metavar='FOLDER',
+    help='''Keep the images rendered by Gwyexport in FOLDER, and take them
+from there when the same data is rendered again with the same settings.''')
+parser.add_argument('--cachesize', default=1000, type=int, metavar='MB',
+    help='''Maximal size of the image cache, the least recently used images
+are removed beyond.''')
 parser.add_argument('--overwrite', default=False, action='store_true',
     help='''Overwrite files if output folders exist. Please double check what
 you are doing, since it could results in file overwritten/destroyed.''')
+parser.add_argument('-n', '--dry-run', dest='dryrun', default=False,
+    action='store_true',
+    help='Only print the planned conversion jobs, nothing is run or created.')
+parser.add_argument('--incremental', default=False, action='store_true',
+    help='''Convert only new or changed files, using a manifest stored in
+each output folder. Existing output folders are then not skipped. Vernissage
+is given only the new or changed Matrix files of a folder converted before,
+with -file instead of -path.''')
+parser.add_argument('--resume', default=False, action='store_true',
+    help='''Resume the last conversion: the folders it converted successfully
+are skipped, the unfinished or failed ones are converted again. Existing
+output folders are then not skipped.''')
+parser.add_argument('--watch', default=False, action='store_true',
+    help='''After the conversion, keep watching the input folders and convert
+new or changed files as they are written. Implies --incremental.''')
+parser.add_argument('--settle', default=5.0, type=float,
+    help='''Seconds a file must stay unchanged before being converted in
+watch mode.''')
+parser.add_argument('--coordinator', metavar='[HOST:]PORT',
+    help='''Hand the jobs to the workers connecting to PORT instead of
+running them. --jobs is then the number of jobs handed at once, usually the
+total number of worker processes. Only the local machine can connect unless
+HOST is given, 0.0.0.0 for all the network interfaces.''')
+parser.add_argument('--worker', metavar='HOST:PORT',
+    help='''Run the jobs of the coordinator at HOST:PORT until interrupted,
+--jobs at once. No input folder is given to a worker, the data and output
+folders must be at the same paths as on the coordinator.
+--vernissagecmd and --gwyexportcmd replace the commands of the coordinator
+if given.''')
+parser.add_argument('--authkey',
+    help='''Secret shared by the coordinator and its workers, needed by the
+workers. The coordinator makes and prints a random one if not given. Anyone
+knowing it can run commands on the coordinator and the workers.''')
 
 # Input folders containing data
-parser.add_argument('inputfolders', nargs='+',
+parser.add_argument('inputfolders', nargs='*',
     help='The folder containing the data to convert.')
-
-def build_command_list(cmd, flags='', arguments={}):
-
-    command_list = [cmd,]
-    
-    argument = re.compile('^\{.*\}$')
-    for flag in flags.split(' '):
-        if argument.match(flag):
-            if isinstance(arguments[flag], list):
-                command_list.extend(arguments[flag])
-            else:
-                command_list.append(arguments[flag])
-        else:
-            command_list.append(flag)
-
-    return command_list
-
-def convert(dirname, args, stdout=None, stderr=None):
-    current_dirpath = os.path.relpath(dirname)
-
-    if not args.novernissage: # Do Vernissage convertion
-        vernissageout_dirpath = os.path.join(args.vernissageoutfolder,
-                                           current_dirpath)
-        if not os.path.isdir(vernissageout_dirpath):
-            if args.verbose: print 'Creating %s' % vernissageout_dirpath
-            os.mkdir(vernissageout_dirpath)
-        elif not args.overwrite: # dir exist + do not overwrite
-            return
-
-        # vernissage
-        subprocess.call(build_command_list(
-                    args.vernissagecmd, args.vernissageflags,
-                    {'{path}': current_dirpath,
-                     '{outdir}': vernissageout_dirpath,
-                     '{exporter}': args.vernissageexporter}),
-                     stdout=stdout, stderr=stderr)
-
-    if not args.noimage: # Do Gwyexport
-
-        output_dirpath_img = os.path.join(args.imageoutfolder, current_dirpath)
-        if not os.path.isdir(output_dirpath_img):
-            os.mkdir(output_dirpath_img)
-        elif not args.overwrite:
-            return
-
-        # Use the flat files rather than Matrix if available
-        if not args.novernissage and args.vernissageexporter=='Flattener':
-            current_dirpath = vernissageout_dirpath
-
-        files = [os.path.join(current_dirpath, filename)
-                    for filename in os.listdir(current_dirpath)]
-
-        subprocess.call( build_command_list(
-            args.gwyexportcmd, args.gwyexportflags,
-               {'{exportformat}': args.format,
-                '{outputpath}': output_dirpath_img,
-                '{filterlist}': args.filters,
-                '{gradient}': args.gradient,
-                '{colormap}': args.colormap,
-                '{inputfiles}': files}),
-                stdout=stdout, stderr=stderr )
-
-def process(inputfolder, args, stdout=None, stderr=None):
-
-    data_dirpath = os.path.abspath(inputfolder)
-
-    if not os.path.isdir(data_dirpath):
-        print 'Error %s is not a directory.' % data_dirpath
-        return
-
-    if not args.novernissage and not os.path.isdir(args.vernissageoutfolder):
-        os.mkdir(args.vernissageoutfolder)
-    if not args.noimage and not os.path.isdir(args.imageoutfolder):
-        os.mkdir(args.imageoutfolder)
-
-    for dirname, subdirnames, filenames in os.walk(data_dirpath):
-        convert(dirname, args, stdout, stderr)
-
-        if args.recursive:
-            for subdirname in subdirnames:
-                convert(os.path.join(dirname, subdirname), args, stdout, stderr)
+# The folders are mirrored relative to the current folder
+parser.set_defaults(root=None)
+
+def run_worker(args):
+    commands = {}
+    for tool, option in (('vernissage', 'vernissagecmd'),
+                         ('gwyexport', 'gwyexportcmd')):
+        if getattr(args, option) != parser.get_default(option):
+            commands[tool] = getattr(args, option)
+    worker = Worker(parse_address(args.worker), args.authkey, args.jobs,
+                    commands, verbose=args.verbose)
+    worker.run()
 
 def main():
     args = parser.parse_args()
-    for inputfolder in args.inputfolders:
-        if args.verbose: print 'Converting data in %s' % inputfolder
-        process(inputfolder, args)
+    if args.worker:
+        if not args.authkey:
+            parser.error('--worker needs the --authkey of the coordinator')
+        run_worker(args)
+        return
+    if not args.inputfolders:
+        parser.error('no input folder given')
+    if args.watch:
+        args.incremental = True
+    if args.direct and args.renderer != 'native':
+        parser.error('--direct needs --engine native')
+    try:
+        check_renderer(args)
+    except RenderError, e:
+        parser.error(str(e))
+    if args.verbose:
+        print 'Converting data in %s' % ', '.join(args.inputfolders)
+    if args.dryrun:
+        print_plan(plan(args.inputfolders, args))
+        return
+    jobs = stream_plan(args.inputfolders, args)
+
+    if args.coordinator:
+        if not args.authkey:
+            args.authkey = new_authkey()
+            print 'Workers connect with --authkey %s' % args.authkey
+        executor = Coordinator(parse_address(args.coordinator),
+                               args.authkey)
+        if args.verbose:
+            print 'Waiting for workers on %s:%d' % executor.address
+    else:
+        executor = make_executor(args)
+    pool = make_pool(args.jobs) if executor is None else None
+    metrics = Metrics(args.metrics)
+    try:
+        run_plan(jobs, args, pool=pool, metrics=metrics, executor=executor)
+        if args.watch:
+            watch(args, pool, metrics, executor)
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    finally:
+        if args.coordinator:
+            executor.close()
+        if args.verbose and metrics.records:
+            print metrics.format_summary()
+        metrics.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file benchmark.py
+    \date 2013
+
+    \mainpage Benchmark of the conversion driver with stub converters
+
+    Build a synthetic tree of Matrix-like files and convert it with stand-in
+    VernissageCmd and gwyexport commands of configurable latency and output
+    size, for an increasing number of workers. This measures the throughput
+    and the overhead of the walk and of the scheduling, without Vernissage
+    nor Gwyddion installed.
+
+    Usage: python benchmark.py --depth 2 --fanout 3 --files 20 -w 1 2 4 8
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import engine
+from autoconvert import parser as autoconvert_parser
+from metrics import Metrics
+from datafiles import MATRIX_IMAGE_MAGIC, FLAT_MAGIC
+
+# A single stub stands in for both tools:
+#   stub.py LATENCY OUTSIZE vernissage -path P -outdir O -exporter E
+#   stub.py LATENCY OUTSIZE gwyexport -o OUT FILE_OR_FOLDER...
+STUB = '''import os, sys, time
+latency, outsize, tool = float(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+args = sys.argv[4:]
+time.sleep(latency)
+if tool == 'vernissage':
+    path, outdir = args[args.index('-path')+1], args[args.index('-outdir')+1]
+    for f in os.listdir(path):
+        if f.endswith('_mtrx'):
+            with open(os.path.join(outdir, f[:-5] + '_flat'), 'wb') as o:
+                o.write(%(flat)r + '\\0' * outsize)
+else:
+    outdir = args[args.index('-o')+1]
+    inputs = []
+    for f in args[args.index('-o')+2:]:
+        if os.path.isdir(f):
+            inputs.extend(os.path.join(f, g) for g in os.listdir(f))
+        else:
+            inputs.append(f)
+    for f in inputs:
+        with open(os.path.join(outdir, os.path.basename(f) + '.jpg'),
+                  'wb') as o:
+            o.write('\\0' * outsize)
+''' % {'flat': FLAT_MAGIC}
+
+parser = argparse.ArgumentParser(description='''Benchmark the autoconvert
+driver against stub converters.''')
+parser.add_argument('--depth', default=2, type=int,
+    help='Depth of the synthetic folder tree.')
+parser.add_argument('--fanout', default=3, type=int,
+    help='Number of subfolders per folder.')
+parser.add_argument('--files', default=10, type=int,
+    help='Number of channel files per folder.')
+parser.add_argument('--size', default=100000, type=int,
+    help='Size in bytes of each channel file.')
+parser.add_argument('--latency', default=0.05, type=float,
+    help='Seconds each stub command takes.')
+parser.add_argument('--outsize', default=10000, type=int,
+    help='Size in bytes of each file written by the stubs.')
+parser.add_argument('-w', '--workers', default=[1, 2, 4, 8], type=int,
+    nargs='+', help='Numbers of workers to benchmark.')
+parser.add_argument('--drivers', default=['pool', 'events'], nargs='+',
+    choices=['pool', 'events'],
+    help='Executors of the command line driver to benchmark.')
+parser.add_argument('--gui', default=False, action='store_true',
+    help='Benchmark also the ProcessesQueue of the window (needs PyQt4).')
+parser.add_argument('--json', metavar='FILE',
+    help='Write the results to FILE as JSON.')
+parser.add_argument('--workdir',
+    help='Folder for the synthetic tree, a temporary folder by default.')
+
+def make_tree(root, depth, fanout, files, size):
+    """Create a tree of folders each with a parameter file and files
+    channel files. Return the number of folders."""
+
+    os.makedirs(root)
+    with open(os.path.join(root, 'default_0001.mtrx'), 'wb') as f:
+        f.write('ONTMATRX0101ATEM')
+    for i in range(files):
+        name = 'default_%04d.Z_mtrx' % (i + 1)
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(MATRIX_IMAGE_MAGIC + '\0' * size)
+    folders = 1
+    if depth > 0:
+        for i in range(fanout):
+            folders += make_tree(os.path.join(root, 'folder%d' % i),
+                                 depth - 1, fanout, files, size)
+    return folders
+
+def write_stub(workdir):
+    path = os.path.join(workdir, 'stub.py')
+    with open(path, 'w') as f:
+        f.write(STUB)
+    return path
+
+def stub_args(stub, options, outdir):
+    """Return the autoconvert arguments running the stubs"""
+
+    prefix = '%s %s %d' % (stub, options.latency, options.outsize)
+    return ['--quiet', '-R',
+            '--vernissagecmd', sys.executable,
+            '--vernissageflags', prefix + ' vernissage -path {path} '
+                                 '-outdir {outdir} -exporter {exporter}',
+            '--vernissageoutfolder', os.path.join(outdir, 'vernissage_out'),
+            '--gwyexportcmd', sys.executable,
+            '--gwyexportflags', prefix + ' gwyexport -o {outputpath} '
+                                '{inputfiles}',
+            '--imageoutfolder', os.path.join(outdir, 'img_out')]
+
+def bench_cli(datadir, stub, options, workers, driver='pool'):
+    """Convert datadir with engine.run_plan, running the stubs with the
+    driver executor, and return the results"""
+
+    outdir = tempfile.mkdtemp(dir=options.workdir)
+    args = autoconvert_parser.parse_args(
+        stub_args(stub, options, outdir) + ['-j', str(workers),
+                                            '--executor', driver, datadir])
+
+    cpu0, wall0 = os.times()[:2], time.time()
+    jobs = engine.plan(args.inputfolders, args)
+    plan_time = time.time() - wall0
+
+    metrics = Metrics()
+    executor = engine.make_executor(args)
+    pool = engine.make_pool(workers) if executor is None else None
+    try:
+        engine.run_plan(jobs, args, pool=pool, metrics=metrics,
+                        executor=executor)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    wall = time.time() - wall0
+    cpu = sum(os.times()[:2]) - sum(cpu0)
+    shutil.rmtree(outdir)
+
+    busy = sum(r['duration'] for r in metrics.records)
+    return result(driver, workers, wall, plan_time, cpu, busy, metrics)
+
+def bench_gui(datadir, stub, options, workers):
+    """Convert datadir with two pipelined ProcessesQueue, as the window
+    does, and return the results"""
+
+    from PyQt4 import Qt
+    import qtautoconvert
+
+    app = Qt.QCoreApplication.instance() or Qt.QCoreApplication(sys.argv)
+    outdir = tempfile.mkdtemp(dir=options.workdir)
+    prefix = [stub, str(options.latency), str(options.outsize)]
+    metrics = Metrics()
+
+    wall0 = time.time()
+    cpu0 = os.times()[:2]
+    queue1 = qtautoconvert.ProcessesQueue(workers)
+    queue2 = qtautoconvert.ProcessesQueue(workers)
+
+    def make_job(args, tool, folder, inputs):
+        job = qtautoconvert.ProcessJob(args, tool, folder, None)
+        def started():
+            job.started = time.time()
+        def finished(exitCode):
+            end = time.time()
+            metrics.add({'tool': tool, 'folder': folder, 'start':
+                job.started, 'end': end, 'wait': job.started - job.queued,
+                'duration': end - job.started, 'returncode': exitCode,
+                'input_files': len(inputs),
+                'input_bytes': sum(os.path.getsize(f) for f in inputs),
+                'output_files': 0, 'queued': job.queued})
+        def processCreated(process):
+            Qt.QObject.connect(process, Qt.SIGNAL("started()"), started)
+            Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"), finished)
+        job.processCreated = processCreated
+        return job
+
+    for dirname, subdirnames, filenames in os.walk(datadir):
+        rel = os.path.relpath(dirname, datadir)
+        vof = os.path.normpath(os.path.join(outdir, 'vernissage_out', rel))
+        iof = os.path.normpath(os.path.join(outdir, 'img_out', rel))
+        os.makedirs(vof)
+        os.makedirs(iof)
+        inputs = [os.path.join(dirname, f) for f in filenames]
+
+        j1 = make_job([sys.executable] + prefix +
+                      ['vernissage', '-path', dirname, '-outdir', vof],
+                      'vernissage', rel, inputs)
+        j2 = make_job([sys.executable] + prefix +
+                      ['gwyexport', '-o', iof, vof],
+                      'gwyexport', rel, [])
+        queue1.append(j1)
+        queue2.append(j2, j1)
+    plan_time = time.time() - wall0
+
+    state = {'running': 2}
+    def queueFinished():
+        state['running'] -= 1
+        if state['running'] == 0:
+            app.quit()
+    for queue in (queue1, queue2):
+        Qt.QObject.connect(queue, Qt.SIGNAL("finished()"), queueFinished)
+    queue1.start()
+    queue2.start()
+    if state['running']:
+        app.exec_()
+
+    wall = time.time() - wall0
+    cpu = sum(os.times()[:2]) - sum(cpu0)
+    shutil.rmtree(outdir)
+
+    busy = sum(r['duration'] for r in metrics.records)
+    return result('gui', workers, wall, plan_time, cpu, busy, metrics)
+
+def result(driver, workers, wall, plan_time, cpu, busy, metrics):
+    """Return the result of a run. The overhead is the time the worker slots
+    were not busy, per job."""
+
+    files = sum(r['input_files'] for r in metrics.records
+                if r['tool'] == 'vernissage')
+    nbytes = sum(r['input_bytes'] for r in metrics.records
+                 if r['tool'] == 'vernissage')
+    jobs = len(metrics.records)
+    return {'driver': driver,
+            'workers': workers,
+            'jobs': jobs,
+            'wall': wall,
+            'plan': plan_time,
+            'driver_cpu': cpu,
+            'files_per_s': files / wall,
+            'mb_per_s': nbytes / 1e6 / wall,
+            'overhead_per_job': max(0., wall * workers - busy) / max(jobs, 1),
+            'summary': metrics.summary()}
+
+def print_results(results):
+    print '%-6s %7s %6s %8s %8s %8s %10s %9s %8s %10s' % ('driver',
+        'workers', 'jobs', 'wall s', 'plan s', 'cpu s', 'files/s', 'MB/s',
+        'speedup', 'idle/job s')
+    base = {}
+    for r in results:
+        base.setdefault(r['driver'], r['wall'])
+        print '%-6s %7d %6d %8.2f %8.3f %8.2f %10.1f %9.2f %8.2f %10.3f' % (
+            r['driver'], r['workers'], r['jobs'], r['wall'], r['plan'],
+            r['driver_cpu'], r['files_per_s'], r['mb_per_s'],
+            base[r['driver']] / r['wall'], r['overhead_per_job'])
+
+def main():
+    options = parser.parse_args()
+    tmpdir = None
+    if options.workdir is None:
+        options.workdir = tmpdir = tempfile.mkdtemp(prefix='autoconvert-')
+
+    if options.json:
+        options.json = os.path.abspath(options.json)
+    # autoconvert mirrors the input folder path relative to the current one
+    cwd = os.getcwd()
+    os.chdir(options.workdir)
+    options.workdir = '.'
+    datadir = 'data'
+    try:
+        folders = make_tree(datadir, options.depth, options.fanout,
+                            options.files, options.size)
+        stub = os.path.abspath(write_stub(options.workdir))
+        print '%d folders, %d files of %d bytes' % (folders,
+            folders * options.files, options.size)
+
+        results = []
+        for driver in options.drivers:
+            for workers in options.workers:
+                results.append(bench_cli(datadir, stub, options, workers,
+                                         driver))
+        if options.gui:
+            for workers in options.workers:
+                results.append(bench_gui(datadir, stub, options, workers))
+        print_results(results)
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(results, f, indent=1)
+    finally:
+        if os.path.isdir(datadir):
+            shutil.rmtree(datadir)
+        os.chdir(cwd)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
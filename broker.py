@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file broker.py
+    \date 2013
+
+    \mainpage Share the conversion jobs with workers on other computers
+
+    A coordinator plans the jobs of the input folders as usual, but hands
+    them to a broker instead of running them. Workers, on the same or other
+    computers, connect to the broker over TCP, take jobs, run them and
+    report the result. A worker regularly tells the broker it is alive, the
+    jobs of a worker not heard of for a while are given to other workers.
+
+    The data and output folders must be reachable by every worker at the
+    same paths as on the coordinator, for example on a network share
+    mounted at the same place. Workers run from the working folder of the
+    coordinator if it exists on their computer.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+
+import os
+import sys
+import time
+import Queue
+import socket
+import threading
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+from engine import run_job
+
+debug = False
+
+DEFAULT_PORT = 50507
+HEARTBEAT = 5.0 # seconds between the messages of a busy worker
+LOST_AFTER = 30.0 # seconds without message before a worker is lost
+RECONNECT_DELAY = 5.0
+EXPOSED = ('take', 'heartbeat', 'done', 'workdir')
+CLOSED = 'closed' # given by take() once the coordinator is done
+
+
+def parse_address(address, host='127.0.0.1'):
+    """Return the (host, port) of a [HOST:]PORT string, on the local
+    machine only if no HOST is given"""
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        port = address
+    return host, int(port or DEFAULT_PORT)
+
+
+class Broker(object):
+    """The jobs waiting for a worker, the jobs taken by the workers and the
+    results. The workers use take(), heartbeat() and done() through the
+    network, each call in its own thread."""
+
+    def __init__(self, lost_after=LOST_AFTER, workdir=None):
+        self.lost_after = lost_after
+        self.cwd = workdir
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.taken = {} # job id -> (worker, job)
+        self.seen = {} # worker -> time of its last message
+        self.results = Queue.Queue()
+        self.count = 0
+        self.closed = False
+
+    def put(self, job):
+        with self.condition:
+            self.count += 1
+            job.broker_id = self.count
+            self.waiting.append(job)
+            self.condition.notify()
+
+    def take(self, worker, timeout=1.0):
+        """Return the next job for worker, None if there is none within
+        timeout seconds, or CLOSED if the coordinator is done"""
+
+        deadline = time.time() + timeout
+        with self.condition:
+            self.seen[worker] = time.time()
+            self.requeue_lost()
+            while not self.waiting:
+                if self.closed:
+                    return CLOSED
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            job = self.waiting.popleft()
+            self.taken[job.broker_id] = (worker, job)
+            if debug: print '%s takes %s %s' % (worker, job.tool, job.folder)
+            return job
+
+    def heartbeat(self, worker):
+        with self.condition:
+            self.seen[worker] = time.time()
+
+    def done(self, worker, job):
+        """Store the result of a job. Return False if the job was given to
+        another worker meanwhile, its result is then dropped."""
+
+        with self.condition:
+            self.seen[worker] = time.time()
+            if self.taken.get(job.broker_id, (None,))[0] != worker:
+                return False
+            del self.taken[job.broker_id]
+        self.results.put(job)
+        return True
+
+    def workdir(self):
+        return self.cwd
+
+    def requeue_lost(self):
+        """Give the jobs of the lost workers to the others, first"""
+
+        now = time.time()
+        for job_id, (worker, job) in sorted(self.taken.items(), reverse=True):
+            if now - self.seen.get(worker, 0) > self.lost_after:
+                print >> sys.stderr, 'Worker %s lost, %s of %s queued ' \
+                    'again' % (worker, job.tool, job.folder)
+                del self.taken[job_id]
+                self.waiting.appendleft(job)
+                self.condition.notify()
+
+    def result(self, timeout=None):
+        """Wait up to timeout seconds for the next result, forever if None.
+        Return None if no job finished meanwhile."""
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 1.0 # Queue.get can not be interrupted without timeout
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+            try:
+                return self.results.get(timeout=max(0., wait))
+            except Queue.Empty:
+                pass
+            with self.condition:
+                self.requeue_lost()
+            if deadline is not None and time.time() >= deadline:
+                return None
+
+    def pending(self):
+        with self.condition:
+            return len(self.waiting) + len(self.taken)
+
+    def cancel(self):
+        """Drop the waiting jobs and forget the taken ones"""
+
+        with self.condition:
+            self.waiting.clear()
+            self.taken.clear()
+
+    def close(self):
+        """Make the workers waiting for a job return at once"""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Coordinator(object):
+    """Serve a broker at address and hand it the jobs of run_plan(), as an
+    executor"""
+
+    def __init__(self, address, authkey, lost_after=LOST_AFTER):
+        self.broker = Broker(lost_after, os.getcwd())
+        broker = self.broker
+
+        class Manager(BaseManager): pass
+        Manager.register('broker', callable=lambda: broker, exposed=EXPOSED)
+        self.server = Manager(address=address, authkey=authkey).get_server()
+        self.address = self.server.address
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self):
+        return self.broker.pending()
+
+    def start(self, job):
+        self.broker.put(job)
+
+    def wait(self, timeout=None):
+        return self.broker.result(timeout)
+
+    def terminate(self):
+        self.broker.cancel()
+
+    def close(self):
+        self.broker.close()
+        time.sleep(0.1) # let the calls of the workers return
+
+
+class WorkerManager(BaseManager): pass
+WorkerManager.register('broker')
+
+def new_authkey():
+    """Return a random secret for the coordinator and its workers"""
+
+    return os.urandom(16).encode('hex')
+
+def connect(address, authkey, verbose=True):
+    """Return the broker of the coordinator at address, waiting for the
+    coordinator as long as needed"""
+
+    while True:
+        manager = WorkerManager(address=address, authkey=authkey)
+        try:
+            manager.connect()
+            return manager.broker()
+        except (socket.error, EOFError, IOError), e:
+            if verbose:
+                print 'No coordinator at %s:%d (%s), retrying' % (address[0],
+                    address[1], e)
+            time.sleep(RECONNECT_DELAY)
+
+
+class Worker(object):
+    """Run the jobs of a coordinator, jobs at once, until interrupted.
+
+    commands replaces the command of the jobs, keyed by tool, for the
+    programs installed elsewhere than on the coordinator."""
+
+    def __init__(self, address, authkey, jobs=1, commands=None,
+                 name=None, verbose=True):
+        self.address = address
+        self.authkey = authkey
+        self.jobs = jobs
+        self.commands = {}
+        for tool, command in (commands or {}).items():
+            if os.path.dirname(command): # not looked up in the PATH
+                command = os.path.abspath(command)
+            self.commands[tool] = command
+        self.name = name or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.verbose = verbose
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        broker = connect(self.address, self.authkey, self.verbose)
+        workdir = broker.workdir()
+        if workdir and os.path.isdir(workdir):
+            os.chdir(workdir)
+        if self.verbose:
+            print 'Worker %s running %d jobs for %s:%d' % (self.name,
+                self.jobs, self.address[0], self.address[1])
+
+        threads = [threading.Thread(target=self.run_jobs)
+                   for i in range(self.jobs)]
+        threads.append(threading.Thread(target=self.send_heartbeats))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # the main thread only waits, to remain interruptible by Ctrl-C
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1.0)
+
+    def run_jobs(self):
+        broker = connect(self.address, self.authkey, False)
+        while True:
+            try:
+                job = broker.take(self.name)
+                if job is None:
+                    continue
+                if job == CLOSED:
+                    # wait for the coordinator to quit before reconnecting
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+                with self.lock:
+                    self.busy += 1
+                command = job.command
+                try:
+                    if job.tool in self.commands:
+                        job.command = [self.commands[job.tool]] + command[1:]
+                    if self.verbose:
+                        print '%s %s' % (job.tool, job.folder)
+                    run_job(job)
+                finally:
+                    job.command = command # as planned, for the retries
+                    with self.lock:
+                        self.busy -= 1
+                if not broker.done(self.name, job) and self.verbose:
+                    print 'Result of %s %s dropped' % (job.tool, job.folder)
+            except (socket.error, EOFError, IOError):
+                if self.verbose: print 'Coordinator lost, reconnecting'
+                time.sleep(RECONNECT_DELAY)
+                broker = connect(self.address, self.authkey, self.verbose)
+
+    def send_heartbeats(self):
+        broker = connect(self.address, self.authkey, False)
+        while True:
+            time.sleep(HEARTBEAT)
+            if not self.busy:
+                continue
+            try:
+                broker.heartbeat(self.name)
+            except (socket.error, EOFError, IOError):
+                broker = connect(self.address, self.authkey, False)
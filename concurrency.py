@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file concurrency.py
+    \date 2013
+
+    \mainpage Adaptive number of simultaneous conversion processes
+
+    Vernissage under Wine is mostly waiting for the disk while Gwyexport is
+    mostly using the CPU, so no fixed number of processes suits both. A
+    controller per stage probes a higher number of processes as long as the
+    stage throughput improves and the machine is not saturated, and backs
+    off when the CPU or the disk is saturated without throughput gain.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import time
+import multiprocessing
+
+debug = False
+
+def cpu_times():
+    """Return the (total, idle, iowait) CPU times of the machine, or None if
+    not available on this OS"""
+
+    try:
+        with open('/proc/stat') as f:
+            fields = f.readline().split()
+    except IOError:
+        return None
+    values = [int(v) for v in fields[1:]]
+    # user nice system idle iowait irq softirq steal...
+    return sum(values), values[3], values[4] if len(values) > 4 else 0
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class LoadSampler(object):
+    """Measure the CPU busy and I/O wait fractions since the last sample.
+
+    Use /proc/stat on Linux, the load average on other POSIX systems and
+    report no load elsewhere."""
+
+    def __init__(self):
+        self.last = cpu_times()
+
+    def sample(self):
+        """Return (busy, iowait) as fractions between 0 and 1"""
+
+        current = cpu_times()
+        if current is not None and self.last is not None:
+            total = current[0] - self.last[0]
+            idle = current[1] - self.last[1]
+            iowait = current[2] - self.last[2]
+            self.last = current
+            if total <= 0:
+                return 0., 0.
+            return (float(total - idle - iowait) / total,
+                    float(iowait) / total)
+        if hasattr(os, 'getloadavg'):
+            return min(1., os.getloadavg()[0] / cpu_count()), 0.
+        return 0., 0.
+
+
+class ConcurrencyController(object):
+    """Adjust the number of simultaneous jobs of a stage between floor and
+    ceiling.
+
+    Every interval seconds the throughput of the stage (finished jobs per
+    second) is compared with the previous interval. The limit is raised
+    while the stage uses all its slots, has waiting jobs and its throughput
+    does not drop; it is lowered if the throughput drops after a raise, or
+    if the CPU or the disk is saturated without throughput gain."""
+
+    def __init__(self, floor=1, ceiling=None, initial=None, interval=5.0,
+                 cpu_high=0.9, iowait_high=0.25, sampler=None):
+        if ceiling is None:
+            ceiling = 2 * cpu_count()
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        if initial is None:
+            initial = cpu_count()
+        self.limit = min(self.ceiling, max(self.floor, initial))
+        self.interval = interval
+        self.cpu_high = cpu_high
+        self.iowait_high = iowait_high
+        self.sampler = sampler or LoadSampler()
+
+        self.completed = 0
+        self.throughput = None
+        self.lastUpdate = time.time()
+
+    def job_finished(self):
+        self.completed += 1
+
+    def update(self, running, waiting):
+        """Return the limit of simultaneous jobs, given the number of running
+        and waiting jobs of the stage."""
+
+        now = time.time()
+        elapsed = now - self.lastUpdate
+        if elapsed < self.interval:
+            return self.limit
+
+        throughput = self.completed / elapsed
+        busy, iowait = self.sampler.sample()
+        previous = self.throughput
+        improved = previous is None or throughput >= previous * 0.95
+
+        if busy >= self.cpu_high or iowait >= self.iowait_high:
+            if not improved or previous is None:
+                self.limit -= 1
+        elif running >= self.limit and waiting > 0:
+            self.limit += 1 if improved else -1
+        self.limit = min(self.ceiling, max(self.floor, self.limit))
+
+        if debug:
+            print 'busy %.2f iowait %.2f throughput %.2f/s -> %d jobs' % (
+                busy, iowait, throughput, self.limit)
+
+        self.completed = 0
+        self.throughput = throughput
+        self.lastUpdate = now
+        return self.limit
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file datafiles.py
+    \date 2013
+
+    \mainpage Find the SPM data files of a folder
+
+    Only the image and spectroscopy channel files should be passed to
+    Gwyexport, not the Matrix parameter files, logs or previously exported
+    images. Files are classified by their extension and, for unknown
+    extensions, by their first bytes.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import re
+import time
+import fnmatch
+
+# Magic bytes, as checked by the Gwyddion file modules
+MATRIX_IMAGE_MAGIC = 'ONTMATRX0101TLKB' # Matrix channel file
+FLAT_MAGIC = 'FLAT0100' # Vernissage Flattener export
+
+# Channel files are named like default_0001.Z_mtrx or .I(V)_flat, the
+# Matrix parameter file like default_0001.mtrx
+DATA_NAME = re.compile(r'.*\.[^.]+_(mtrx|flat)$', re.IGNORECASE)
+NOT_DATA_EXTENSIONS = ('.mtrx', '.png', '.jpg', '.jpeg', '.txt', '.log',
+                       '.json', '.tmp', '.ini', '.xml')
+
+# A folder modified more recently may still get files within the same
+# mtime tick, its listing is not cached
+MTIME_RESOLUTION = 2.0
+
+def sniff(path):
+    """Return True if the file starts with a known data file magic"""
+
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(MATRIX_IMAGE_MAGIC))
+    except IOError:
+        return False
+    return head.startswith(MATRIX_IMAGE_MAGIC) or head.startswith(FLAT_MAGIC)
+
+
+class FileClassifier(object):
+    """Select the data files of folders.
+
+    Include and exclude are lists of glob patterns matched against the file
+    names. Exclude takes precedence, then include, then the file extension
+    and magic bytes decide. The result is cached per folder as long as the
+    folder is not modified."""
+
+    def __init__(self, include=(), exclude=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.cache = {} # dirpath -> (mtime, filenames)
+
+    def is_data_file(self, path):
+        filename = os.path.basename(path)
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(filename, pattern):
+                return False
+        for pattern in self.include:
+            if fnmatch.fnmatch(filename, pattern):
+                return os.path.isfile(path)
+        if DATA_NAME.match(filename):
+            return os.path.isfile(path)
+        if filename.startswith('.') or \
+           os.path.splitext(filename)[1].lower() in NOT_DATA_EXTENSIONS:
+            return False
+        return os.path.isfile(path) and sniff(path)
+
+    def data_files(self, dirpath):
+        """Return the sorted data file names of dirpath"""
+
+        mtime = os.stat(dirpath).st_mtime
+        cached = self.cache.get(dirpath)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        filenames = [filename for filename in sorted(os.listdir(dirpath))
+                     if self.is_data_file(os.path.join(dirpath, filename))]
+        if time.time() - mtime > MTIME_RESOLUTION:
+            self.cache[dirpath] = (mtime, filenames)
+        return filenames
@@ -0,0 +1,1196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file engine.py
+    \date 2013
+
+    \mainpage Conversion engine shared by the command line and the window
+
+    Plan the folders to convert, build the VernissageCmd and Gwyexport jobs
+    of each folder and run them, without any user interface. Settings are
+    given as an object with the attributes of the command line options,
+    see settings().
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import Queue
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from collections import deque
+
+from manifest import Manifest, changed_files
+from watcher import Watcher
+from walker import walk, StatCache
+from datafiles import FileClassifier, sniff
+from metrics import files_size, count_outputs, job_record
+from concurrency import ConcurrencyController, cpu_count
+from priority import prioritize
+from journal import Journal, JOURNAL_FILENAME, replay
+from executor import EventExecutor, AVAILABLE as EVENTS_AVAILABLE
+from imagecache import ImageCache, settings_key
+import render
+import matrix
+
+debug = False
+
+MIN_BATCH_SIZE = 10*1024*1024
+MAX_COMMAND_LENGTH = 30000 # Windows limit is 32767 characters
+PLAN_AHEAD = 2 # jobs ready per process, the plan is consumed as they run
+GROUP_PREFIX = '.autoconvert_group_' # temporary output folders of groups
+RENDER_SCRIPT = os.path.splitext(os.path.abspath(render.__file__))[0] + '.py'
+
+# Default settings, the command line options without the input folders
+DEFAULTS = {
+    'novernissage': False,
+    'vernissageoutfolder': 'vernissage_out',
+    'vernissagecmd': 'VernissageCmd.exe',
+    'vernissageflags': '-path {path} -outdir {outdir} -exporter {exporter}',
+    'vernissageexporter': 'Flattener',
+    'vernissagegroup': 1, # folders per VernissageCmd call
+    'vernissagegroupsize': 100, # MB
+    'noimage': False,
+    'gwyexportcmd': 'gwyexport',
+    'gwyexportflags': ('-s -f {exportformat} -m -o {outputpath} '
+                       '--filters {filterlist} --gradient {gradient} '
+                       '--colormap {colormap} {inputfiles}'),
+    'renderer': 'gwyexport',
+    'direct': False,
+    'imageoutfolder': 'img_out',
+    'format': 'jpg',
+    'include': [],
+    'exclude': [],
+    'filters': 'pc;melc;sr;melc;pc',
+    'gradient': 'Wrappmono',
+    'colormap': 'adaptive',
+    'verbose': True,
+    'recursive': False,
+    'jobs': 1,
+    'executor': 'events' if EVENTS_AVAILABLE else 'pool',
+    'adaptive': False,
+    'minjobs': 1,
+    'minbatch': MIN_BATCH_SIZE,
+    'maxcmdlength': MAX_COMMAND_LENGTH,
+    'priority': 'walk',
+    'pin': [],
+    'vernissagetimeout': 0,
+    'gwyexporttimeout': 0,
+    'idletimeout': 0,
+    'retries': 2,
+    'retrydelay': 10,
+    'deadletter': None,
+    'metrics': None,
+    'cache': None,
+    'cachesize': 1000, # MB
+    'overwrite': False,
+    'dryrun': False,
+    'incremental': False,
+    'resume': False,
+    'watch': False,
+    'settle': 5.0,
+    # folder the output folders mirror the input folders from, by default
+    # the current folder
+    'root': None,
+    }
+
+def settings(**values):
+    """Return the default settings, with the given values changed"""
+
+    args = dict((key, list(value) if isinstance(value, list) else value)
+                for key, value in DEFAULTS.items())
+    args.update(values)
+    return argparse.Namespace(**args)
+
+
+class InvalidFlag(Exception): pass
+
+
+def build_command_list(cmd, flags='', arguments={}):
+    """Return the command line of cmd with flags, replacing each {name}
+    flag by its value in arguments. A list value gives several arguments.
+
+    Raise InvalidFlag if a flag has no value."""
+
+    command_list = [cmd,]
+    
+    argument = re.compile('^\{.*\}$')
+    for flag in flags.split(' '):
+        if argument.match(flag):
+            try:
+                value = arguments[flag]
+            except KeyError:
+                raise InvalidFlag('Error malformed command string for %s,\n'
+                                  'check flags %s' % (cmd, flags))
+            if isinstance(value, list):
+                command_list.extend(value)
+            else:
+                command_list.append(value)
+        elif flag:
+            command_list.append(flag)
+
+    return command_list
+
+def relative_folder(dirname, args):
+    """Return the path of dirname relative to args.root, or to the current
+    folder by default. The output folders mirror this path."""
+
+    return os.path.relpath(dirname, args.root or os.curdir)
+
+def input_path(dirname, args):
+    """Return the path of dirname given to the tools, relative to the current
+    folder unless args.root is given"""
+
+    if args.root is None:
+        return os.path.relpath(dirname)
+    return dirname
+
+def output_path(outputfolder, dirname, args):
+    return os.path.normpath(os.path.join(outputfolder,
+                                         relative_folder(dirname, args)))
+
+def direct_folder(dirname, args):
+    """Return True if the native renderer reads the Matrix files of dirname
+    directly, with args.direct, Vernissage converting only the folders with
+    files it can not read"""
+
+    if not args.direct or args.renderer != 'native' or args.novernissage \
+       or args.noimage:
+        return False
+    dirpath = input_path(dirname, args)
+    filenames = file_classifier(args).data_files(dirpath)
+    return bool(filenames) and all(matrix.supported(os.path.join(dirpath,
+                                                                 filename))
+                                   for filename in filenames)
+
+def plan_tools(dirname, args, stats=None):
+    """Return the tools to run for dirname, without side effects.
+
+    A tool is skipped if its output folder exists, unless args.overwrite,
+    args.incremental or args.resume. The root of the output trees may
+    always exist. stats is the StatCache of a planning pass, if given."""
+
+    isdir = stats.isdir if stats is not None else os.path.isdir
+
+    current_dirpath = relative_folder(dirname, args)
+    keep = args.overwrite or args.incremental or args.resume or \
+           current_dirpath == os.curdir
+    tools = []
+
+    if not args.novernissage and not direct_folder(dirname, args):
+        # Do Vernissage convertion
+        vernissageout_dirpath = output_path(args.vernissageoutfolder,
+                                            dirname, args)
+        if isdir(vernissageout_dirpath) and not keep:
+            return tools # dir exist + do not overwrite
+        tools.append('vernissage')
+
+    if not args.noimage: # Do Gwyexport
+        output_dirpath_img = output_path(args.imageoutfolder, dirname, args)
+        if isdir(output_dirpath_img) and not keep:
+            return tools
+        tools.append('gwyexport')
+
+    return tools
+
+def make_output_folders(dirname, tools, args):
+    """Create the output folders of dirname needed by tools"""
+
+    outfolders = {'vernissage': args.vernissageoutfolder,
+                  'gwyexport': args.imageoutfolder}
+    for tool in tools:
+        output_dirpath = output_path(outfolders[tool], dirname, args)
+        if not os.path.isdir(output_dirpath):
+            if args.verbose: print 'Creating %s' % output_dirpath
+            os.makedirs(output_dirpath)
+
+def iter_plan(inputfolders, args, cancelled=None):
+    """Yield the (dirname, tools) to convert in the walk order, walking the
+    input folders as they are consumed.
+
+    Each folder appears only once, even if reached from several input
+    folders. Subfolders are only included with args.recursive. The walk
+    stops as soon as cancelled(), if given, returns True."""
+
+    if args.resume:
+        states = resumed_states(args)
+
+    seen = set()
+    stats = StatCache()
+    for inputfolder in inputfolders:
+        if cancelled is not None and cancelled():
+            return
+        data_dirpath = os.path.abspath(inputfolder)
+
+        if not os.path.isdir(data_dirpath):
+            print 'Error %s is not a directory.' % data_dirpath
+            continue
+
+        if args.recursive:
+            dirnames = walk(data_dirpath, cancelled)
+        else:
+            dirnames = [data_dirpath]
+
+        for dirname in dirnames:
+            key = os.path.normcase(os.path.realpath(dirname))
+            if key in seen:
+                continue
+            seen.add(key)
+            tools = plan_tools(dirname, args, stats)
+            if args.resume:
+                folder = relative_folder(dirname, args)
+                tools = [tool for tool in tools
+                              if states[tool].get(folder) != 'done']
+            if tools:
+                yield dirname, tools
+
+def plan(inputfolders, args, cancelled=None):
+    """Return the list of (dirname, tools) to convert, in the order given by
+    args.priority and args.pin"""
+
+    return prioritize(iter_plan(inputfolders, args, cancelled),
+                      args.priority, args.pin, key=lambda job: job[0])
+
+def stream_plan(inputfolders, args, cancelled=None):
+    """Return the (dirname, tools) to convert as plan(), but as a generator
+    walking the tree as the folders are converted if args.priority is the
+    walk order without pinned folders. The other orders need the whole
+    tree."""
+
+    if args.priority == 'walk' and not args.pin:
+        return iter_plan(inputfolders, args, cancelled)
+    return plan(inputfolders, args, cancelled)
+
+def print_plan(jobs):
+    for dirname, tools in jobs:
+        for tool in tools:
+            print '%s\t%s' % (tool, os.path.relpath(dirname))
+    print '%d jobs in %d folders' % (sum(len(tools) for d, tools in jobs),
+                                     len(jobs))
+
+class Job(object):
+    """An external command run for a folder, writing to outdir.
+
+    folder is the path of the folder in the output trees, used for the
+    records, manifests and journals. The command is run in cwd if given."""
+
+    def __init__(self, tool, dirname, command, outdir, files=(),
+                 inputfiles=None, folder=None, cwd=None):
+        self.tool = tool
+        self.dirname = dirname
+        self.folder = folder if folder is not None \
+                             else os.path.relpath(dirname)
+        self.command = command
+        self.outdir = outdir
+        self.cwd = cwd
+        self.files = files # Gwyexport input files
+        if inputfiles is None:
+            inputfiles = files
+        self.input_paths = inputfiles
+        self.input_files = len(inputfiles)
+        self.input_bytes = files_size(inputfiles)
+        self.returncode = None
+        self.queued = self.started = self.finished = None
+        self.output_files = 0
+        self.timeout = None # seconds, for the whole job
+        self.idle_timeout = None # seconds, without output
+        self.attempts = 0
+        self.reason = None # why the job was stopped, 'timeout' or 'idle'
+        # called in-process with the command arguments, if given, rather
+        # than running the command
+        self.function = None
+        # the jobs of the folders converted together by this job, if any
+        self.members = []
+
+    def record(self):
+        return job_record(self.tool, self.folder,
+                          self.queued, self.started, self.finished,
+                          self.returncode, self.input_bytes,
+                          self.input_files, self.output_files)
+
+def split_files(files, chunks, maxlength, minsize=0):
+    """Split files in chunks lists of about the same total size in bytes,
+    but with lists of at least minsize bytes.
+
+    A list is split further if its file names joined are longer than
+    maxlength, so that a command line never exceeds the OS limit."""
+
+    if not files:
+        return []
+
+    sizes = [(os.path.getsize(f), f) for f in files]
+    if minsize > 0:
+        chunks = min(chunks, sum(size for size, f in sizes) // minsize)
+
+    # Largest files first, each to the lightest list
+    heap = [(0, i, []) for i in range(max(1, min(chunks, len(files))))]
+    for size, filename in sorted(sizes, reverse=True):
+        total, i, chunk = heapq.heappop(heap)
+        chunk.append(filename)
+        heapq.heappush(heap, (total + size, i, chunk))
+
+    result = []
+    for total, i, chunk in sorted(heap, key=lambda c: c[1]):
+        current, length = [], 0
+        for filename in sorted(chunk):
+            if current and length + len(filename) + 1 > maxlength:
+                result.append(current)
+                current, length = [], 0
+            current.append(filename)
+            length += len(filename) + 1
+        result.append(current)
+    return result
+
+_classifiers = {}
+
+def file_classifier(args):
+    """Return the classifier of the data files, kept between runs for its
+    cache"""
+
+    key = (tuple(args.include), tuple(args.exclude))
+    if key not in _classifiers:
+        _classifiers[key] = FileClassifier(args.include, args.exclude)
+    return _classifiers[key]
+
+def path_arguments(flags, paths, flag=None):
+    """Return the flags and the value of {path} giving each of paths to
+    VernissageCmd, repeating the flag before {path}, or replacing it by
+    flag if given"""
+
+    tokens = flags.split(' ')
+    index = tokens.index('{path}')
+    before = tokens[index - 1] if index > 0 else ''
+    if before.startswith('{'):
+        before = ''
+    if before and flag is not None:
+        tokens[index - 1] = before = flag
+    value = paths[:1]
+    for path in paths[1:]:
+        if before:
+            value.append(before)
+        value.append(path)
+    return ' '.join(tokens), value
+
+def vernissage_job(dirname, args, files=None):
+    """Return the Vernissage job of dirname.
+
+    If files is given, only these files are converted, with -file instead
+    of -path in the flags, unless the flags have no -path {path} or the
+    command would be longer than args.maxcmdlength."""
+
+    vernissageout_dirpath = output_path(args.vernissageoutfolder, dirname,
+                                        args)
+    inputfiles = [path for path in (os.path.join(dirname, filename)
+                                    for filename in os.listdir(dirname))
+                  if os.path.isfile(path)]
+    ## To fix a BUG with VernissageCmd (or possibly Wine)
+    ## which prevent using absolute posix path as input path
+    ## we set the working directory as the current path
+    ## and we run the command with the relative path '.'
+    cmd = args.vernissagecmd
+    if os.path.dirname(cmd): # not looked up in the PATH
+        cmd = os.path.abspath(cmd)
+    arguments = {'{path}': '.',
+                 '{outdir}': os.path.abspath(vernissageout_dirpath),
+                 '{exporter}': args.vernissageexporter}
+    command = build_command_list(cmd, args.vernissageflags, arguments)
+
+    flags = args.vernissageflags.split(' ')
+    if files and '{path}' in flags and \
+       flags[flags.index('{path}') - 1].lower() == '-path':
+        flags, arguments['{path}'] = path_arguments(args.vernissageflags,
+            [os.path.basename(path) for path in files], '-file')
+        file_command = build_command_list(cmd, flags, arguments)
+        if len(' '.join(file_command)) <= args.maxcmdlength:
+            command, inputfiles = file_command, files
+
+    return Job('vernissage', dirname, command,
+               vernissageout_dirpath, inputfiles=inputfiles,
+               folder=relative_folder(dirname, args), cwd=dirname)
+
+def group_command(jobs, args, outdir):
+    """Return the working folder and the command converting the folders of
+    the Vernissage jobs with a single VernissageCmd call, writing to outdir.
+
+    The command runs in the common parent of the folders with their
+    relative paths, for the same reason as in vernissage_job. The flag
+    before {path} in args.vernissageflags is repeated for each folder."""
+
+    dirpaths = [os.path.abspath(job.dirname) for job in jobs]
+    cwd = os.path.dirname(os.path.commonprefix([dirpath + os.sep
+                                                 for dirpath in dirpaths]))
+    paths = [os.path.relpath(dirpath, cwd) for dirpath in dirpaths]
+    flags, value = path_arguments(args.vernissageflags, paths)
+    return cwd, build_command_list(jobs[0].command[0], flags,
+                    {'{path}': value,
+                     '{outdir}': os.path.abspath(outdir),
+                     '{exporter}': args.vernissageexporter})
+
+def vernissage_group_job(jobs, args):
+    """Return a job converting the folders of the Vernissage jobs with a
+    single VernissageCmd call, so that the startup of Wine and Vernissage
+    is paid once for all of them.
+
+    Vernissage writes to a temporary folder of args.vernissageoutfolder,
+    whose files are moved to the output folder of each job by
+    split_group()."""
+
+    outdir = tempfile.mkdtemp(prefix=GROUP_PREFIX,
+                              dir=args.vernissageoutfolder)
+    cwd, command = group_command(jobs, args, outdir)
+    job = Job('vernissage', cwd, command, outdir, inputfiles=(),
+              folder=relative_folder(cwd, args), cwd=cwd)
+    job.input_files = sum(member.input_files for member in jobs)
+    job.input_bytes = sum(member.input_bytes for member in jobs)
+    job.members = list(jobs)
+    return job
+
+def remove_groups(jobs):
+    """Remove the temporary output folders of the group jobs among jobs,
+    which will not be split as they will not run"""
+
+    for job in jobs:
+        if job.members:
+            shutil.rmtree(job.outdir, ignore_errors=True)
+
+def split_group(job):
+    """Give the result of a group job to each of its member jobs and return
+    them.
+
+    If the group succeeded, each output file goes to the output folder of
+    the member having the input file whose name, without its mtrx ending,
+    is the longest prefix of the output name, or of the first member if
+    none. The temporary output folder of the group is removed."""
+
+    owners = {}
+    for member in job.members:
+        member.started, member.finished = job.started, job.finished
+        member.returncode, member.reason = job.returncode, job.reason
+        member.output_files = 0
+        for path in member.input_paths:
+            name = os.path.basename(path)
+            if name.lower().endswith('mtrx'):
+                owners[name[:-4]] = member
+            else:
+                owners[os.path.splitext(name)[0]] = member
+
+    try:
+        filenames = os.listdir(job.outdir) if job.returncode == 0 else []
+    except OSError:
+        filenames = []
+    for filename in filenames:
+        owner = job.members[0]
+        for end in range(len(filename), 0, -1):
+            if filename[:end] in owners:
+                owner = owners[filename[:end]]
+                break
+        path = os.path.join(owner.outdir, filename)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path) # rename does not overwrite on Windows
+        os.rename(os.path.join(job.outdir, filename), path)
+        if os.path.isfile(path):
+            owner.output_files += 1
+    shutil.rmtree(job.outdir, ignore_errors=True)
+    return job.members
+
+
+class VernissageGrouper(object):
+    """Pack the Vernissage jobs of consecutive folders into group jobs of
+    up to args.vernissagegroup folders, args.vernissagegroupsize MB of
+    input files and args.maxcmdlength characters of command line.
+
+    The jobs are given back unchanged if args.vernissagegroup is 1 or the
+    flags have no {path}. Folders with files of the same name are not
+    packed together, as Vernissage writes their output to the same
+    folder."""
+
+    def __init__(self, args):
+        self.args = args
+        self.enabled = args.vernissagegroup > 1 and \
+                       '{path}' in args.vernissageflags.split(' ')
+        self.maxsize = args.vernissagegroupsize * 1000000
+        self.jobs = []
+        self.names = set()
+        self.size = 0
+
+    def add(self, job):
+        """Add the Vernissage job of a folder, return the jobs to queue"""
+
+        if not self.enabled:
+            return [job]
+        jobs = []
+        if self.jobs and not self.fits(job):
+            jobs = self.flush()
+        self.jobs.append(job)
+        self.names.update(os.path.basename(path) for path in job.input_paths)
+        self.size += job.input_bytes
+        if len(self.jobs) >= self.args.vernissagegroup or \
+           self.size >= self.maxsize:
+            jobs.extend(self.flush())
+        return jobs
+
+    def fits(self, job):
+        """Return whether job can join the jobs packed so far"""
+
+        if self.size + job.input_bytes > self.maxsize:
+            return False
+        if any(os.path.basename(path) in self.names
+               for path in job.input_paths):
+            return False
+        # the temporary output folder has a name of this length
+        outdir = os.path.join(self.args.vernissageoutfolder,
+                              GROUP_PREFIX + 'X' * 6)
+        cwd, command = group_command(self.jobs + [job], self.args, outdir)
+        return len(' '.join(command)) <= self.args.maxcmdlength
+
+    def flush(self):
+        """Return the job of the folders packed so far, a group job if
+        there are several"""
+
+        jobs = self.jobs
+        self.jobs = []
+        self.names = set()
+        self.size = 0
+        if len(jobs) < 2:
+            return jobs
+        return [vernissage_group_job(jobs, self.args)]
+
+def check_renderer(args):
+    """Raise RenderError if the native renderer can not render the images
+    with args"""
+
+    if args.renderer == 'native' and not args.noimage:
+        render.check(args.format, args.filters, args.gradient, args.colormap)
+
+def render_key(args):
+    """Return the key of the Gwyexport settings in the image cache"""
+
+    return settings_key({'renderer': args.renderer,
+                         'cmd': args.gwyexportcmd,
+                         'flags': args.gwyexportflags,
+                         'format': args.format,
+                         'filters': args.filters,
+                         'gradient': args.gradient,
+                         'colormap': args.colormap})
+
+def gwyexport_jobs(dirname, args, records=None, cache=None):
+    """Return the Gwyexport jobs of dirname, with the input files split
+    among args.jobs processes if the flags contain {inputfiles}, or a
+    single job for the whole folder with {inputfolder}. There is no job if
+    the folder has no data file.
+
+    If records is given, only the new or changed files are converted, and
+    the new records of the folder are returned too. If cache is given, the
+    images it has for the files are used instead of converting them.
+
+    With the native renderer, the jobs render their files in-process, or
+    with render.py if run as a command."""
+
+    folder = relative_folder(dirname, args)
+    output_dirpath_img = output_path(args.imageoutfolder, dirname, args)
+
+    # Use the flat files rather than Matrix if available
+    current_dirpath = input_path(dirname, args)
+    if not args.novernissage and args.vernissageexporter=='Flattener' \
+       and not direct_folder(dirname, args):
+        current_dirpath = output_path(args.vernissageoutfolder, dirname, args)
+
+    filenames = file_classifier(args).data_files(current_dirpath)
+    new_records = None
+    if records is not None:
+        files, new_records = changed_files(current_dirpath, records,
+                                           filenames)
+    else:
+        files = [os.path.join(current_dirpath, filename)
+                    for filename in filenames]
+
+    native = args.renderer == 'native'
+
+    def command(files):
+        if native:
+            return [sys.executable, RENDER_SCRIPT, '-f', args.format,
+                    '-o', output_dirpath_img, '--filters', args.filters,
+                    '--gradient', args.gradient,
+                    '--colormap', args.colormap] + files
+        return build_command_list(
+            args.gwyexportcmd, args.gwyexportflags,
+               {'{exportformat}': args.format,
+                '{outputpath}': output_dirpath_img,
+                '{filterlist}': args.filters,
+                '{gradient}': args.gradient,
+                '{colormap}': args.colormap,
+                '{inputfolder}': current_dirpath,
+                '{inputfiles}': files})
+
+    inputfiles = native or '{inputfiles}' in args.gwyexportflags.split(' ')
+    if cache is not None and files:
+        settings = render_key(args)
+        keys = dict((path, cache.key(path, settings)) for path in files)
+        # a single command converts the whole folder with {inputfolder}
+        if inputfiles or all(key in cache.entries for key in keys.values()):
+            files = [path for path in files
+                     if not cache.fetch(keys[path], path, output_dirpath_img)]
+        cache.detach(files, output_dirpath_img)
+
+    if not files:
+        return [], new_records
+    if not inputfiles:
+        return [Job('gwyexport', dirname, command([current_dirpath]),
+                    output_dirpath_img, files, folder=folder)], new_records
+
+    maxlength = args.maxcmdlength - len(' '.join(command([])))
+    jobs = [Job('gwyexport', dirname, command(chunk), output_dirpath_img,
+                chunk, folder=folder)
+            for chunk in split_files(files, args.jobs, maxlength,
+                                     args.minbatch)]
+    if native:
+        for job in jobs:
+            job.function = render.main
+    return jobs, new_records
+
+def _forward(pipe, output, activity):
+    """Copy pipe to output, storing the time of the last output"""
+
+    while True:
+        data = os.read(pipe.fileno(), 4096)
+        if not data:
+            break
+        activity[0] = time.time()
+        output.write(data)
+        output.flush()
+    pipe.close()
+
+def stop_process(process, grace=5.0):
+    """Terminate process, and kill it if still running after grace seconds"""
+
+    process.terminate()
+    deadline = time.time() + grace
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.kill()
+
+def call_watched(command, stdout=None, stderr=None, timeout=None,
+                 idle_timeout=None, cwd=None):
+    """Run command as subprocess.call, but stop it if it runs longer than
+    timeout seconds or does not output anything for idle_timeout seconds.
+
+    Return the return code and the reason the command was stopped, None,
+    'timeout' or 'idle'."""
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, cwd=cwd)
+    started = time.time()
+    activity = [started]
+    readers = [threading.Thread(target=_forward,
+                                args=(pipe, output or default, activity))
+               for pipe, output, default in ((process.stdout, stdout,
+                                              sys.stdout),
+                                             (process.stderr, stderr,
+                                              sys.stderr))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    reason = None
+    while process.poll() is None:
+        now = time.time()
+        if timeout and now - started > timeout:
+            reason = 'timeout'
+        elif idle_timeout and now - activity[0] > idle_timeout:
+            reason = 'idle'
+        if reason is not None:
+            stop_process(process)
+            break
+        # the readers end as soon as the command exits
+        for reader in readers:
+            if reader.is_alive():
+                reader.join(0.5)
+                break
+        else:
+            time.sleep(0.01)
+
+    for reader in readers:
+        # a child of the command may keep the pipes open
+        reader.join(0.2)
+    return process.wait(), reason
+
+def run_job(job, stdout=None, stderr=None):
+    """Run job and store its return code, which is None if the command
+    could not be started or the function raised, its start and end times
+    and output files.
+
+    The job is stopped after job.timeout seconds, or job.idle_timeout
+    seconds without output, if given. A job with a function is run
+    in-process and can not be stopped.
+
+    No exception is raised, as the pool would then never give the job
+    back."""
+
+    job.started = time.time()
+    job.attempts += 1
+    job.returncode = None
+    job.reason = None
+    try:
+        if job.function is not None:
+            job.returncode = job.function(job.command[2:])
+        elif job.timeout or job.idle_timeout:
+            job.returncode, job.reason = call_watched(job.command, stdout,
+                            stderr, job.timeout, job.idle_timeout, job.cwd)
+        else:
+            job.returncode = subprocess.call(job.command, stdout=stdout,
+                                             stderr=stderr, cwd=job.cwd)
+    except Exception, e:
+        print >> sys.stderr, 'Error running %s: %s: %s' % (job.command[0],
+                                                    type(e).__name__, e)
+    job.finished = time.time()
+    job.output_files = count_outputs(job.outdir, job.started)
+    return job
+
+def convert(dirname, args, stdout=None, stderr=None):
+    run_plan([(dirname, plan_tools(dirname, args))], args, stdout, stderr)
+
+def open_manifests(args):
+    """Return the manifests of the output trees, keyed by tool"""
+
+    manifests = {}
+    if not args.novernissage:
+        manifests['vernissage'] = Manifest(args.vernissageoutfolder,
+            {'flags': args.vernissageflags,
+             'exporter': args.vernissageexporter})
+    if not args.noimage:
+        manifests['gwyexport'] = Manifest(args.imageoutfolder,
+            {'flags': args.gwyexportflags,
+             'format': args.format,
+             'filters': args.filters,
+             'gradient': args.gradient,
+             'colormap': args.colormap,
+             'renderer': args.renderer,
+             'flattener': not args.novernissage and
+                          args.vernissageexporter == 'Flattener'})
+    return manifests
+
+def output_folders(args):
+    """Return the output trees, keyed by tool"""
+
+    folders = {}
+    if not args.novernissage:
+        folders['vernissage'] = args.vernissageoutfolder
+    if not args.noimage:
+        folders['gwyexport'] = args.imageoutfolder
+    return folders
+
+def resumed_states(args):
+    """Return the {folder: state} of the conversions to resume, keyed by
+    tool"""
+
+    return dict((tool, replay(os.path.join(folder, JOURNAL_FILENAME)))
+                for tool, folder in output_folders(args).items())
+
+def _init_worker():
+    # Let the main process handle Ctrl-C and terminate the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def make_pool(jobs):
+    """Return a process pool for jobs workers, or None to run in-process"""
+    if jobs <= 1:
+        return None
+    return multiprocessing.Pool(jobs, _init_worker)
+
+def make_executor(args):
+    """Return the executor of the jobs given by args.executor, None for
+    the process pool. The native renderer always runs in the pool."""
+    if args.executor == 'events' and args.renderer != 'native':
+        return EventExecutor()
+    return None
+
+class ResultQueue(object):
+    """The finished jobs, put by the pool result handler thread.
+
+    In Python 2, Queue.get with a timeout polls with sleeps of up to 50 ms,
+    which delays each job, and without a timeout cannot be interrupted by
+    Ctrl-C. Waiting on a pipe wakes up as soon as a job is put and remains
+    interruptible."""
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.rfd, self.wfd = os.pipe()
+
+    def put(self, job):
+        self.queue.put(job)
+        os.write(self.wfd, '.')
+
+    def wake(self):
+        """Make get() return, even if no job finished"""
+        os.write(self.wfd, '.')
+
+    def get(self):
+        """Wait for the next finished job. Return None if woken up by wake()
+        meanwhile.
+
+        Each put() and wake() writes one byte, and each call reads one, so
+        that the pipe never fills up, even if the jobs are put before get()
+        is called, as when running in-process."""
+        os.read(self.rfd, 1)
+        try:
+            return self.queue.get_nowait()
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def run_plan(jobs, args, stdout=None, stderr=None, pool=None, metrics=None,
+             resume=None, events=None, executor=None):
+    """Run the jobs returned by plan() or stream_plan(), using executor, an
+    EventExecutor, or else pool to run folders in parallel if given. The
+    record of each job is added to metrics if given.
+
+    The folders are taken from jobs as the conversion goes, keeping
+    PLAN_AHEAD jobs per process ready, so that a streamed plan walks the
+    tree while the first folders are converted.
+
+    If events is given, it is called as events(name, job) when a job is
+    'queued', 'started', 'retrying' after a failure and 'finished' for
+    good, successfully or not.
+
+    With args.vernissagegroup, the Vernissage jobs of several folders run
+    as one group job, whose result is then given to the job of each
+    folder. The folders of a failed group are then run alone, with their
+    own retries.
+
+    The state of each folder is written to the journal of each output tree,
+    as a continuation of the previous conversion if resume, by default
+    args.resume.
+
+    stdout and stderr can not be passed to the pool workers, they are
+    only used when running in-process. The executor has its own."""
+
+    check_renderer(args)
+    if not args.novernissage and not os.path.isdir(args.vernissageoutfolder):
+        os.mkdir(args.vernissageoutfolder)
+    if not args.noimage and not os.path.isdir(args.imageoutfolder):
+        os.mkdir(args.imageoutfolder)
+
+    manifests = open_manifests(args) if args.incremental else None
+    cache = None
+    if args.cache and not args.noimage:
+        cache = ImageCache(args.cache, args.cachesize * 1000000)
+    if resume is None:
+        resume = args.resume
+    journals = dict((tool, Journal(folder, resume, args.overwrite))
+                    for tool, folder in output_folders(args).items())
+    planned = iter(jobs)
+    tools = {}
+    # Gwyexport jobs are started first, to get the first images early
+    tools_order = ('gwyexport', 'vernissage')
+    ready = dict((tool, deque()) for tool in tools_order)
+    vernissage_records = {} # dirname -> new records once Vernissage succeeds
+    gwyexport_pending = {} # dirname -> [jobs left, new records, failed files]
+    grouper = VernissageGrouper(args)
+    groups = {} # outdir -> group job not split yet
+
+    def notify(name, job):
+        if events is not None:
+            events(name, job)
+
+    def queue_vernissage(jobs):
+        for job in jobs:
+            if job.members:
+                groups[job.outdir] = job
+        ready['vernissage'].extend(jobs)
+
+    def queue_gwyexport(dirname):
+        """Queue the Gwyexport jobs of a folder"""
+        folder = relative_folder(dirname, args)
+        records = None
+        if manifests is not None:
+            records = manifests['gwyexport'].records(folder)
+        gjobs, new_records = gwyexport_jobs(dirname, args, records, cache)
+        if gjobs:
+            journals['gwyexport'].queued(folder, len(gjobs))
+            gwyexport_pending[dirname] = [len(gjobs), new_records, []]
+            for job in gjobs:
+                job.queued = time.time()
+                notify('queued', job)
+            ready['gwyexport'].extend(gjobs)
+        else:
+            journals['gwyexport'].record(folder, 'done')
+            if manifests is not None:
+                manifests['gwyexport'].update(folder, new_records)
+
+    def queue_folder(dirname):
+        if 'vernissage' not in tools[dirname]:
+            queue_gwyexport(dirname)
+            return
+
+        folder = relative_folder(dirname, args)
+        files = None
+        if manifests is not None:
+            records = manifests['vernissage'].records(folder)
+            changed, new_records = changed_files(input_path(dirname, args),
+                                                 records)
+            if records:
+                # converted before, only the changed channel files are
+                changed = files = [path for path in changed if sniff(path)]
+            if not changed:
+                manifests['vernissage'].update(folder, new_records)
+                journals['vernissage'].record(folder, 'done')
+                if 'gwyexport' in tools[dirname]:
+                    queue_gwyexport(dirname)
+                return
+            vernissage_records[dirname] = new_records
+        job = vernissage_job(dirname, args, files)
+        job.queued = time.time()
+        journals['vernissage'].queued(folder)
+        notify('queued', job)
+        if files is None:
+            queue_vernissage(grouper.add(job))
+        else:
+            ready['vernissage'].append(job)
+
+    def finished(job):
+        if metrics is not None:
+            metrics.add(job.record())
+        notify('finished', job)
+        folder = job.folder
+        journals[job.tool].job_finished(folder, job.returncode == 0)
+        if job.tool == 'vernissage':
+            if manifests is not None and job.returncode == 0:
+                manifests['vernissage'].update(folder,
+                                        vernissage_records.pop(job.dirname))
+            if 'gwyexport' in tools[job.dirname]:
+                queue_gwyexport(job.dirname)
+            if job.dirname not in gwyexport_pending:
+                done(job.dirname)
+            return
+
+        pending = gwyexport_pending[job.dirname]
+        pending[0] -= 1
+        if job.returncode != 0:
+            pending[2].extend(job.files)
+        elif cache is not None:
+            cache.store_outputs(job.files, job.outdir, job.started,
+                                render_key(args))
+        if pending[0] == 0:
+            del gwyexport_pending[job.dirname]
+            if manifests is not None:
+                # failed files are dropped to be converted again next time
+                new_records = pending[1]
+                for path in pending[2]:
+                    new_records.pop(os.path.basename(path), None)
+                manifests['gwyexport'].update(folder, new_records)
+            done(job.dirname)
+
+    def done(dirname):
+        if args.verbose and maxrunning > 1:
+            print 'Done %s' % dirname
+
+    def completed(job):
+        """Retry a failed job, or finish it once out of retries"""
+        if job.returncode != 0 and job.attempts <= args.retries:
+            if metrics is not None:
+                metrics.add(job.record())
+            delay = args.retrydelay * 2 ** (job.attempts - 1)
+            if args.verbose:
+                print '%s failed on %s%s, retrying in %g s' % (job.tool,
+                    job.dirname, ' (%s)' % job.reason if job.reason
+                    else '', delay)
+            heapq.heappush(retrying, (time.time() + delay, job))
+            notify('retrying', job)
+            if executor is None:
+                timer = threading.Timer(delay, results.wake)
+                timer.daemon = True
+                timer.start()
+            return
+        if job.returncode != 0:
+            dead.append(job)
+        finished(job)
+
+    results = ResultQueue()
+    timeouts = {'vernissage': args.vernissagetimeout,
+                'gwyexport': args.gwyexporttimeout}
+    retrying = [] # heap of (time, job) to run again
+    dead = [] # jobs which failed after all their retries
+    running = dict((tool, 0) for tool in tools_order)
+    maxrunning = 1
+    if pool is not None or executor is not None:
+        maxrunning = args.jobs
+    limits = dict((tool, maxrunning) for tool in tools_order)
+    controllers = {}
+    if args.adaptive and maxrunning > 1:
+        for tool in tools_order:
+            controllers[tool] = ConcurrencyController(args.minjobs,
+                                    args.jobs, min(args.jobs, cpu_count()))
+            limits[tool] = controllers[tool].limit
+
+    backlog = PLAN_AHEAD * maxrunning
+
+    try:
+        while any(ready.values()) or sum(running.values()) or retrying or \
+              planned is not None:
+            while planned is not None and \
+                  sum(len(queue) for queue in ready.values()) < backlog:
+                try:
+                    dirname, t = next(planned)
+                except StopIteration:
+                    planned = None
+                    queue_vernissage(grouper.flush())
+                    break
+                tools[dirname] = t
+                # Output folders are created in plan order
+                make_output_folders(dirname, t, args)
+                queue_folder(dirname)
+
+            while retrying and retrying[0][0] <= time.time():
+                job = heapq.heappop(retrying)[1]
+                job.queued = time.time()
+                ready[job.tool].append(job)
+
+            for tool in tools_order:
+                while ready[tool] and running[tool] < limits[tool] and \
+                      sum(running.values()) < maxrunning:
+                    job = ready[tool].popleft()
+                    job.timeout = timeouts[tool]
+                    job.idle_timeout = args.idletimeout
+                    for member in job.members or [job]:
+                        journals[tool].job_started(member.folder)
+                        notify('started', member)
+                    if executor is not None:
+                        executor.start(job)
+                    elif pool is None:
+                        results.put(run_job(job, stdout, stderr))
+                    else:
+                        pool.apply_async(run_job, (job,),
+                                         callback=results.put)
+                    running[tool] += 1
+
+            if not sum(running.values()) and not retrying:
+                continue # the plan is over, or had nothing to convert
+            if executor is not None:
+                job = executor.wait(retrying[0][0] - time.time()
+                                    if retrying else None)
+            else:
+                job = results.get()
+            if job is None: # a retry is due
+                continue
+            running[job.tool] -= 1
+            if job.tool in controllers:
+                controller = controllers[job.tool]
+                controller.job_finished()
+                limits[job.tool] = controller.update(running[job.tool],
+                                                     len(ready[job.tool]))
+            if job.members:
+                if job.returncode != 0 and args.verbose:
+                    print '%s failed on %d folders of %s, converting them ' \
+                          'one by one' % (job.tool, len(job.members),
+                                          job.dirname)
+                del groups[job.outdir]
+                for member in split_group(job):
+                    if member.returncode == 0:
+                        completed(member)
+                        continue
+                    # not counted as an attempt of the folder
+                    if metrics is not None:
+                        metrics.add(member.record())
+                    member.queued = time.time()
+                    notify('retrying', member)
+                    ready[member.tool].append(member)
+            else:
+                completed(job)
+    finally:
+        if executor is not None and len(executor):
+            executor.terminate() # interrupted
+        if dead:
+            report_dead_letters(dead, args.deadletter)
+        results.close()
+        # the groups not run nor finished if interrupted
+        remove_groups(groups.values())
+        for journal in journals.values():
+            journal.close()
+        # keep what was converted, even if interrupted
+        if manifests is not None:
+            for manifest in manifests.values():
+                manifest.save()
+        if cache is not None:
+            cache.save()
+            if args.verbose and cache.hits:
+                print 'Images of %d files taken from the cache' % cache.hits
+
+def report_dead_letters(jobs, path=None):
+    """Print the jobs which failed after their retries, and append them to
+    the file path as JSON lines if given"""
+
+    print >> sys.stderr, '%d jobs failed after %d attempts:' % (len(jobs),
+        max(job.attempts for job in jobs))
+    for job in jobs:
+        print >> sys.stderr, '  %s\t%s\t%s' % (job.tool, job.dirname,
+            job.reason or 'exit code %s' % job.returncode)
+    if path:
+        with open(path, 'a') as f:
+            for job in jobs:
+                f.write(json.dumps({'tool': job.tool,
+                                    'folder': job.folder,
+                                    'command': job.command,
+                                    'files': list(job.files),
+                                    'returncode': job.returncode,
+                                    'reason': job.reason,
+                                    'attempts': job.attempts,
+                                    'time': job.finished},
+                                   sort_keys=True) + '\n')
+
+def watch(args, pool=None, metrics=None, executor=None):
+    """Convert the new or changed files of the input folders until
+    interrupted."""
+
+    watcher = Watcher(args.inputfolders, args.recursive,
+                      exclude=(args.vernissageoutfolder, args.imageoutfolder),
+                      settle=args.settle)
+    if args.verbose: print 'Watching %s' % ', '.join(args.inputfolders)
+    try:
+        while True:
+            jobs = []
+            for dirname in watcher.changes(timeout=1.0):
+                if args.verbose: print 'New data in %s' % dirname
+                jobs.append((dirname, plan_tools(dirname, args)))
+            if jobs:
+                jobs = prioritize(jobs, args.priority, args.pin,
+                                  key=lambda job: job[0])
+                run_plan(jobs, args, pool=pool, metrics=metrics, resume=True,
+                         executor=executor)
+    finally:
+        watcher.close()
+
+def process(inputfolder, args, stdout=None, stderr=None, pool=None):
+    """Convert inputfolder, see run_plan()"""
+    run_plan(plan([inputfolder], args), args, stdout, stderr, pool)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file executor.py
+    \date 2013
+
+    \mainpage Run the conversion commands from a single event loop
+
+    The children are started without waiting for them, and their output
+    is forwarded as it comes by polling all their pipes from one thread.
+    Timeouts, output inactivity and the end of the children are checked in
+    the same loop, so that many simultaneous commands cost almost nothing
+    to the driver and can all be stopped at once.
+
+    Each child runs in its own process group, which is stopped as a whole,
+    so that the programs started by a command, for example by Wine, do not
+    survive it. Polling pipes and process groups are only available on
+    POSIX systems, elsewhere the process pool of the engine is used.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import subprocess
+from collections import deque
+
+from metrics import count_outputs
+
+debug = False
+
+AVAILABLE = os.name == 'posix'
+MAX_WAIT = 1.0 # seconds between checks of the children, at most
+EXIT_DRAIN = 0.2 # seconds to read the pipes a child left open at its exit
+
+
+def _child_setup():
+    os.setpgrp()
+    # Python ignores SIGPIPE, the commands expect the default
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class Child(object):
+    """A running job, its process and its open pipes"""
+
+    def __init__(self, job, process):
+        self.job = job
+        self.process = process
+        self.fds = set()
+        self.activity = job.started
+        self.exited = None # time the process was seen exited
+        self.kill = None # time to kill the process if still running
+
+
+class EventExecutor(object):
+    """Run engine jobs as child processes and wait for them from a single
+    thread.
+
+    The output of the children is written to stdout and stderr, by default
+    the ones of this process. A job is stopped after job.timeout seconds,
+    or job.idle_timeout seconds without output, if given, and killed if
+    still running grace seconds later."""
+
+    def __init__(self, stdout=None, stderr=None, grace=5.0):
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+        self.grace = grace
+        self.children = []
+        self.pipes = {} # fd -> (child, pipe, output)
+        self.done = deque()
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+
+    def __len__(self):
+        return len(self.children)
+
+    def start(self, job):
+        """Start job, without waiting for it"""
+
+        job.started = time.time()
+        job.attempts += 1
+        job.reason = None
+        job.returncode = None
+        try:
+            process = subprocess.Popen(job.command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, cwd=job.cwd,
+                                       preexec_fn=_child_setup)
+        except OSError, e:
+            print >> sys.stderr, 'Error running %s: %s' % (job.command[0], e)
+            self.finish(job)
+            return
+
+        child = Child(job, process)
+        for pipe, output in ((process.stdout, self.stdout),
+                             (process.stderr, self.stderr)):
+            fd = pipe.fileno()
+            self.pipes[fd] = (child, pipe, output)
+            child.fds.add(fd)
+            if self.poller is not None:
+                self.poller.register(fd, select.POLLIN | select.POLLPRI)
+        self.children.append(child)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for a job to finish and return it, or
+        None if no job finished in time. Without job running, return None
+        after timeout seconds, or at once if timeout is None."""
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.done:
+            if not self.children:
+                if deadline is not None:
+                    time.sleep(max(0., deadline - time.time()))
+                return None
+            now = time.time()
+            wait = self.check(now)
+            if self.done:
+                break
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wait = min(wait, deadline - now)
+            self.poll(wait)
+        return self.done.popleft()
+
+    def check(self, now):
+        """Stop, kill or finish the children as needed. Return the number of
+        seconds until the next check is needed."""
+
+        wait = MAX_WAIT
+        for child in list(self.children):
+            job, process = child.job, child.process
+            if process.poll() is not None:
+                if child.exited is None:
+                    child.exited = now
+                if not child.fds or now - child.exited >= EXIT_DRAIN:
+                    # a child of the command may keep the pipes open
+                    self.finish(job, child)
+                    continue
+                wait = min(wait, EXIT_DRAIN)
+                continue
+            if not child.fds:
+                # the output is closed, the process should exit soon
+                wait = min(wait, 0.001)
+
+            if child.kill is not None:
+                if now >= child.kill:
+                    self.signal(child, signal.SIGKILL)
+                    child.kill = now + self.grace
+                wait = min(wait, child.kill - now)
+                continue
+
+            if job.timeout and now - job.started > job.timeout:
+                job.reason = 'timeout'
+            elif job.idle_timeout and \
+                 now - child.activity > job.idle_timeout:
+                job.reason = 'idle'
+            if job.reason is not None:
+                if debug: print 'Stopping %s (%s)' % (job.tool, job.reason)
+                self.signal(child, signal.SIGTERM)
+                child.kill = now + self.grace
+                wait = min(wait, self.grace)
+                continue
+            if job.timeout:
+                wait = min(wait, job.started + job.timeout - now)
+            if job.idle_timeout:
+                wait = min(wait, child.activity + job.idle_timeout - now)
+        return max(0., wait)
+
+    def poll(self, timeout):
+        """Forward the output of the children, waiting up to timeout
+        seconds for some"""
+
+        try:
+            if self.poller is not None:
+                fds = [fd for fd, event
+                          in self.poller.poll(int(timeout * 1000) + 1)]
+            else:
+                fds = select.select(list(self.pipes), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in fds:
+            if fd not in self.pipes:
+                continue
+            child, pipe, output = self.pipes[fd]
+            data = os.read(fd, 65536)
+            if data:
+                child.activity = time.time()
+                output.write(data)
+                output.flush()
+            else:
+                self.close(fd)
+
+    def close(self, fd):
+        child, pipe, output = self.pipes.pop(fd)
+        if self.poller is not None:
+            self.poller.unregister(fd)
+        child.fds.discard(fd)
+        pipe.close()
+
+    def signal(self, child, sig):
+        """Send sig to the process group of child, so that the commands it
+        started stop too"""
+        try:
+            os.killpg(child.process.pid, sig)
+        except OSError: # already exited
+            pass
+
+    def finish(self, job, child=None):
+        if child is not None:
+            for fd in list(child.fds):
+                self.close(fd)
+            self.children.remove(child)
+            job.returncode = child.process.wait()
+        job.finished = time.time()
+        job.output_files = count_outputs(job.outdir, job.started)
+        self.done.append(job)
+
+    def terminate(self):
+        """Stop all the running children, killing those still running grace
+        seconds later"""
+
+        for child in self.children:
+            self.signal(child, signal.SIGTERM)
+        deadline = time.time() + self.grace
+        while any(child.process.poll() is None for child in self.children) \
+              and time.time() < deadline:
+            time.sleep(0.05)
+        for child in list(self.children):
+            self.signal(child, signal.SIGKILL)
+            self.finish(child.job, child)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file imagecache.py
+    \date 2013
+
+    \mainpage Cache of the images rendered by Gwyexport
+
+    The images of each input file are kept under the hash of the file
+    content and of the rendering settings. When the same data is rendered
+    again with the same settings, even into another output folder, the
+    images are hard linked, or copied, from the cache instead of running
+    Gwyexport. The least recently used images are removed once the cache
+    is larger than its maximal size.
+
+    Gwyexport names its images after the input file, an image belongs to
+    the input file whose name is the longest prefix of the image name.
+    Images linked to the cache are removed from an output folder before
+    they are rendered again there, so that the cached ones never change.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+
+import os
+import json
+import shutil
+import hashlib
+
+from manifest import file_state
+
+debug = False
+
+INDEX_FILENAME = 'index.json'
+
+
+def settings_key(settings):
+    """Return the hash of the rendering settings, a dict of JSON values.
+    Flags are compared word by word."""
+
+    normalized = dict((key, ' '.join(value.split())
+                            if isinstance(value, basestring) else value)
+                      for key, value in settings.items())
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True)).hexdigest()
+
+def match_outputs(inputs, outputs):
+    """Return {input: [output names]}, each output name given to the input
+    path whose file name is the longest prefix of it"""
+
+    names = sorted(((os.path.basename(path), path) for path in inputs),
+                   key=lambda name: -len(name[0]))
+    matched = dict((path, []) for path in inputs)
+    for output in outputs:
+        for name, path in names:
+            if output.startswith(name):
+                matched[path].append(output)
+                break
+    return matched
+
+def link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError): # no hard links on this OS or volume
+        shutil.copy2(source, destination)
+
+
+class ImageCache(object):
+    """The images in folder, at most maxBytes of them.
+
+    An entry holds the images of an input file content. Its images are kept
+    by the end of their names after the input file name, so that a file of
+    the same content but another name gets images of its own name.
+
+    The index keeps, for each entry, its image name ends, size and last
+    use, and the hashes of the input files by path, size and modification time
+    so that unchanged files are not hashed again."""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.entries = {} # key -> {'suffixes': [...], 'size': n, 'used': t}
+        self.hashes = {} # input path -> [size, mtime, hash]
+        self.hits = 0
+        self.clock = 0 # order of use, the index may move between computers
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        # entries of older indexes, by whole image names, are not usable
+        self.entries = dict((key, entry) for key, entry
+                            in data.get('entries', {}).items()
+                            if 'suffixes' in entry)
+        self.hashes = data.get('hashes', {})
+        self.clock = max([e['used'] for e in self.entries.values()] or [0])
+
+    def key(self, path, settings):
+        """Return the key of the images of the file path rendered with
+        settings, a settings_key()"""
+
+        path = os.path.abspath(path)
+        state = file_state(path, self.hashes.get(path))
+        self.hashes[path] = state
+        return hashlib.sha1(state[2] + settings).hexdigest()
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def fetch(self, key, path, outdir):
+        """Put the images of key in outdir, named after the input file
+        path. Return False if not cached."""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        folder = self.entry_folder(key)
+        name = os.path.basename(path)
+        try:
+            for suffix in entry['suffixes']:
+                link_or_copy(os.path.join(folder, 'image' + suffix),
+                             os.path.join(outdir, name + suffix))
+        except (IOError, OSError):
+            # removed from the cache meanwhile, render again
+            del self.entries[key]
+            return False
+        self.clock += 1
+        entry['used'] = self.clock
+        self.hits += 1
+        return True
+
+    def store(self, key, path, outdir, filenames):
+        """Keep the images filenames of outdir, rendered from the input
+        file path, under key"""
+
+        folder = self.entry_folder(key)
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        name = os.path.basename(path)
+        suffixes = [filename[len(name):] for filename in filenames]
+        size = 0
+        for filename, suffix in zip(filenames, suffixes):
+            cached = os.path.join(folder, 'image' + suffix)
+            link_or_copy(os.path.join(outdir, filename), cached)
+            size += os.path.getsize(cached)
+        self.clock += 1
+        self.entries[key] = {'suffixes': suffixes, 'size': size,
+                             'used': self.clock}
+        if debug: print 'Cached %d images as %s' % (len(filenames), key)
+
+    def store_outputs(self, inputs, outdir, since, settings):
+        """Keep the images written to outdir after since for the input
+        files inputs, rendered with settings"""
+
+        try:
+            outputs = [filename for filename in os.listdir(outdir)
+                       if os.path.getmtime(os.path.join(outdir, filename))
+                          >= since]
+        except OSError:
+            return
+        for path, filenames in match_outputs(inputs, outputs).items():
+            if filenames:
+                self.store(self.key(path, settings), path, outdir,
+                           sorted(filenames))
+        self.evict()
+
+    def detach(self, inputs, outdir):
+        """Remove the images of the input files inputs from outdir if they
+        are linked to the cache, so that rendering them again does not
+        change the cached images"""
+
+        try:
+            outputs = os.listdir(outdir)
+        except OSError:
+            return
+        for filenames in match_outputs(inputs, outputs).values():
+            for filename in filenames:
+                path = os.path.join(outdir, filename)
+                if os.stat(path).st_nlink > 1:
+                    os.remove(path)
+
+    def evict(self):
+        """Remove the least recently used images beyond max_bytes"""
+
+        total = sum(entry['size'] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(),
+                                 key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_folder(key), ignore_errors=True)
+            del self.entries[key]
+            total -= entry['size']
+
+    def save(self):
+        """Write the index, replacing the old one only once complete"""
+
+        # forget the hashes of the files removed since
+        self.hashes = dict((path, state) for path, state
+                           in self.hashes.items() if os.path.exists(path))
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump({'entries': self.entries, 'hashes': self.hashes}, f)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path) # rename does not overwrite on Windows
+        os.rename(tmppath, self.path)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file journal.py
+    \date 2013
+
+    \mainpage Journal of the conversion of the folders of an output tree
+
+    Each conversion appends to a journal at the root of the output tree
+    when the conversion of a folder starts and when it is done or failed.
+    Every line is written to disk before going on, so that after the
+    computer or Wine crashed, a resumed conversion can skip the folders
+    already done and convert again only the unfinished or failed ones.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import json
+import time
+
+JOURNAL_FILENAME = '.autoconvert_journal.jsonl'
+
+def replay(path):
+    """Return {folder: state} from the journal at path, since the last
+    conversion which overwrote the converted folders and was not resumed.
+
+    The other conversions only convert the folders without output, so the
+    states of the earlier folders still hold. A conversion is only taken
+    into account once it recorded a folder."""
+
+    states = {}
+    reset = False
+    try:
+        f = open(path)
+    except IOError:
+        return states
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError: # line cut by a crash
+                continue
+            if 'run' in entry:
+                # journals without 'overwrite' are from before it was written
+                reset = not entry.get('resume') and \
+                        entry.get('overwrite', True)
+            elif 'folder' in entry:
+                if reset:
+                    states = {}
+                    reset = False
+                states[entry['folder']] = entry['state']
+    return states
+
+
+class Journal(object):
+    """The journal of an output tree.
+
+    Folders are given relative to the output tree. A folder can be
+    converted by several jobs, it is done once they all succeeded and
+    failed if any of them failed."""
+
+    def __init__(self, outputfolder, resume=False, overwrite=False):
+        self.path = os.path.join(outputfolder, JOURNAL_FILENAME)
+        self.states = replay(self.path) if resume else {}
+        self.pending = {} # folder -> [jobs left, failed]
+        self.started = set()
+        self.output = open(self.path, 'a+')
+        self.output.seek(0, os.SEEK_END)
+        if self.output.tell() > 0:
+            # end a line cut by a crash, not to spoil the next one
+            self.output.seek(-1, os.SEEK_END)
+            if self.output.read(1) != '\n':
+                self.output.write('\n')
+        self.write({'run': time.time(), 'resume': resume,
+                    'overwrite': overwrite})
+
+    def write(self, entry):
+        if self.output.closed: # a job which outlived its conversion
+            return
+        self.output.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+    def is_done(self, folder):
+        """Return whether folder was done by the resumed conversions"""
+        return self.states.get(folder) == 'done'
+
+    def queued(self, folder, jobs=1):
+        self.pending.setdefault(folder, [0, False])[0] += jobs
+
+    def job_started(self, folder):
+        if folder not in self.started:
+            self.started.add(folder)
+            self.record(folder, 'started')
+
+    def job_finished(self, folder, success):
+        pending = self.pending.get(folder)
+        if pending is None:
+            return
+        pending[0] -= 1
+        pending[1] = pending[1] or not success
+        if pending[0] == 0:
+            del self.pending[folder]
+            self.started.discard(folder)
+            self.record(folder, 'failed' if pending[1] else 'done')
+
+    def record(self, folder, state):
+        self.states[folder] = state
+        self.write({'folder': folder, 'state': state, 'time': time.time()})
+
+    def close(self):
+        self.output.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file manifest.py
+    \date 2013
+
+    \mainpage Persistent manifest of already converted files
+
+    A manifest is stored at the root of each output tree. It records, for
+    each converted input file, its size, modification time and a content
+    hash, together with the settings used for the conversion. It allows to
+    convert again only the new or changed files.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = '.autoconvert_manifest.json'
+
+def file_hash(path, blocksize=1<<20):
+    """Return the sha1 hex digest of the file content"""
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+def file_state(path, record=None):
+    """Return the [size, mtime, hash] record of path.
+
+    The file is only hashed if its size or mtime differ from record."""
+
+    st = os.stat(path)
+    if record is not None and record[0] == st.st_size \
+       and record[1] == st.st_mtime:
+        return [st.st_size, st.st_mtime, record[2]]
+    return [st.st_size, st.st_mtime, file_hash(path)]
+
+def changed_files(dirpath, records, filenames=None):
+    """Compare the files of dirpath with records of the same folder.
+
+    Return the list of new or changed file paths and the new records of the
+    folder. A file touched but with the same content is not changed. If
+    filenames is given, only these files of dirpath are compared."""
+
+    if filenames is None:
+        filenames = sorted(os.listdir(dirpath))
+
+    changed = []
+    new_records = {}
+    for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        if not os.path.isfile(path):
+            continue
+        old = records.get(filename)
+        state = file_state(path, old)
+        if old is None or old[2] != state[2]:
+            changed.append(path)
+        new_records[filename] = state
+    return changed, new_records
+
+
+class Manifest(object):
+    """The manifest of an output tree.
+
+    Records are stored per folder, as {folder: {filename: record}}. If the
+    settings differ from the stored ones, all the records are dropped so
+    that everything is converted again."""
+
+    def __init__(self, outputfolder, settings):
+        self.path = os.path.join(outputfolder, MANIFEST_FILENAME)
+        self.settings = settings
+        self.folders = {}
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if data.get('settings') == settings:
+            self.folders = data.get('folders', {})
+
+    def records(self, folder):
+        return self.folders.get(folder, {})
+
+    def update(self, folder, records):
+        self.folders[folder] = records
+
+    def save(self):
+        """Write the manifest, replacing the old one only once complete"""
+
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump({'settings': self.settings, 'folders': self.folders}, f)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path) # rename does not overwrite on Windows
+        os.rename(tmppath, self.path)
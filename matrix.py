@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file matrix.py
+    \date 2013
+
+    \mainpage Reader of the Omicron Matrix image files
+
+    The values of a Matrix channel file are memory-mapped as a NumPy view,
+    without copy, and the scan geometry is taken from the parameter file of
+    the experiment. The native renderer can so render the Matrix images
+    directly, without the Flattener copy of Vernissage. Anything this
+    reader does not understand raises MatrixError, for Vernissage to
+    convert it instead.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import mmap
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from datafiles import MATRIX_IMAGE_MAGIC
+
+FILE_MAGIC = 'ONTMATRX0101'
+PARAMETER_EXTENSION = '.mtrx'
+SCANNER = 'XYScanner'
+
+# Value types of the parameters, their identifiers are stored reversed
+TYPES = {'LOOB': 'I', 'GNOL': 'i', 'BUOD': 'd'}
+
+
+class MatrixError(Exception): pass
+
+
+class _Reader(object):
+    """Read the little endian values of a Matrix file in sequence"""
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, fmt):
+        try:
+            values = struct.unpack_from('<' + fmt, self.data, self.offset)
+        except struct.error:
+            raise MatrixError('truncated block')
+        self.offset += struct.calcsize('<' + fmt)
+        return values
+
+    def tag(self):
+        tag = self.data[self.offset:self.offset + 4]
+        self.offset += 4
+        return tag
+
+    def string(self):
+        """Read a string stored as its length and UTF-16 characters"""
+        length, = self.unpack('I')
+        end = self.offset + 2 * length
+        if end > len(self.data):
+            raise MatrixError('truncated string')
+        value = self.data[self.offset:end].decode('utf-16-le')
+        self.offset = end
+        return value
+
+    def count(self):
+        """Read a number of items, each taking at least 4 bytes"""
+        count, = self.unpack('I')
+        if 4 * count > len(self.data) - self.offset:
+            raise MatrixError('corrupted block')
+        return count
+
+    def value(self):
+        """Read a typed parameter value"""
+        tag = self.tag()
+        if tag == 'GRTS':
+            return self.string()
+        if tag not in TYPES:
+            raise MatrixError('unknown value type %r' % tag)
+        return self.unpack(TYPES[tag])[0]
+
+def _blocks(data):
+    """Yield the (tag, body) of the blocks of a parameter file, each stored
+    as its reversed tag, its length and its body starting with a
+    timestamp. A block still being written ends the file."""
+
+    offset = len(FILE_MAGIC)
+    while offset + 8 <= len(data):
+        tag = data[offset:offset + 4]
+        length, = struct.unpack_from('<I', data, offset + 4)
+        offset += 8
+        if offset + length > len(data):
+            break
+        yield tag, data[offset:offset + length]
+        offset += length
+
+def geometry(parameters):
+    """Return the (columns, lines, forward and backward, up and down) of
+    the scan from the parameters"""
+
+    try:
+        return (int(parameters[SCANNER, 'Points']),
+                int(parameters[SCANNER, 'Lines']),
+                bool(parameters[SCANNER, 'X_Retrace']),
+                bool(parameters[SCANNER, 'Y_Retrace']))
+    except KeyError, e:
+        raise MatrixError('no scanner parameter %s.%s' % e.args[0])
+
+
+class ParameterFile(object):
+    """The parameters of an experiment, as they were when each of its
+    channel files was created.
+
+    The parameter file starts with the initial parameters and logs their
+    modifications and the channel files in time order."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(FILE_MAGIC):
+            raise MatrixError('not a Matrix parameter file')
+
+        parameters = {}
+        self.geometries = {} # channel file name -> geometry
+        self.errors = {} # channel file name -> MatrixError
+        for tag, body in _blocks(data):
+            reader = _Reader(body, 8) # after the timestamp
+            if tag == 'APEE': # initial parameters
+                reader.unpack('I')
+                for i in range(reader.count()):
+                    instance = reader.string()
+                    for j in range(reader.count()):
+                        name = reader.string()
+                        reader.string() # unit
+                        parameters[instance, name] = reader.value()
+            elif tag == 'DOMP': # parameter modified
+                instance = reader.string()
+                name = reader.string()
+                reader.string() # unit
+                parameters[instance, name] = reader.value()
+            elif tag == 'FERB': # channel file created
+                filename = os.path.basename(
+                    reader.string().replace('\\', '/'))
+                try:
+                    self.geometries[filename] = geometry(parameters)
+                except MatrixError, e:
+                    self.errors[filename] = e
+
+    def geometry(self, filename):
+        if filename in self.errors:
+            raise self.errors[filename]
+        if filename not in self.geometries:
+            raise MatrixError('%s is not in the parameter file' % filename)
+        return self.geometries[filename]
+
+_parameter_files = {} # path -> (size, mtime, ParameterFile)
+
+def parameter_file(path):
+    """Return the ParameterFile of path, parsed again only if the file
+    changed, as the experiment goes on"""
+
+    st = os.stat(path)
+    cached = _parameter_files.get(path)
+    if cached is None or cached[:2] != (st.st_size, st.st_mtime):
+        cached = (st.st_size, st.st_mtime, ParameterFile(path))
+        _parameter_files[path] = cached
+    return cached[2]
+
+def parameter_path(path):
+    """Return the path of the parameter file of the channel file at path.
+
+    The channel files of an experiment are named after its parameter file,
+    default_0001.mtrx for default_0001.Z_mtrx or default--1_1.Z_mtrx."""
+
+    dirpath, filename = os.path.split(path)
+    candidates = []
+    for name in os.listdir(dirpath or os.curdir):
+        if name.lower().endswith(PARAMETER_EXTENSION):
+            prefix = name[:-len(PARAMETER_EXTENSION)].rsplit('_', 1)[0]
+            if filename.startswith(prefix + '_') or \
+               filename.startswith(prefix + '--'):
+                candidates.append((len(prefix), name))
+    if not candidates:
+        raise MatrixError('no parameter file for %s' % filename)
+    return os.path.join(dirpath, max(candidates)[1])
+
+def is_image_channel(filename):
+    """Return True for the channel files of images, Z_mtrx but not
+    I(V)_mtrx which are spectroscopy curves"""
+
+    channel = filename.rsplit('.', 1)[-1]
+    return channel.lower().endswith('_mtrx') and '(' not in channel
+
+def read_image(path):
+    """Return the values of the channel file at path, as a NumPy view on
+    the memory-mapped file, and the geometry of the scan. There may be
+    fewer values than in the scan, if it was stopped."""
+
+    if numpy is None:
+        raise MatrixError('NumPy is needed to read the Matrix files')
+    if not is_image_channel(os.path.basename(path)):
+        raise MatrixError('not an image channel')
+    columns, lines, xretrace, yretrace = parameter_file(
+        parameter_path(path)).geometry(os.path.basename(path))
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(MATRIX_IMAGE_MAGIC):
+            raise MatrixError('not a Matrix channel file')
+        # the map stays open as long as the view refers to it
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(MATRIX_IMAGE_MAGIC)] != MATRIX_IMAGE_MAGIC:
+        raise MatrixError('not a Matrix channel file')
+    offset = data.find('ATAD', len(MATRIX_IMAGE_MAGIC))
+    if offset < 0 or offset + 8 > len(data):
+        raise MatrixError('no data block')
+    length, = struct.unpack_from('<I', data, offset + 4)
+    offset += 8
+    count = min(length, len(data) - offset) // 4
+    expected = columns * lines * (2 if xretrace else 1) * \
+               (2 if yretrace else 1)
+    if count > expected:
+        raise MatrixError('more values than the scan has points')
+    values = numpy.frombuffer(data, '<i4', count, offset)
+    return values, (columns, lines, xretrace, yretrace)
+
+def supported(path):
+    """Return True if the channel file at path can be read"""
+
+    try:
+        if not is_image_channel(os.path.basename(path)):
+            return False
+        parameter_file(parameter_path(path)).geometry(os.path.basename(path))
+    except (MatrixError, EnvironmentError):
+        return False
+    return numpy is not None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file metrics.py
+    \date 2013
+
+    \mainpage Timing and throughput of the conversion jobs
+
+    Each job gives a record with its queue wait, start and end times, exit
+    code, input size and number of output files. The records can be written
+    as JSON lines and summarised per tool with the throughput and the job
+    latency percentiles.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import json
+
+def files_size(paths):
+    """Return the total size in bytes of the existing files among paths"""
+
+    total = 0
+    for path in paths:
+        try:
+            if os.path.isfile(path):
+                total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def folder_size(dirpath):
+    """Return the total size in bytes of the files directly in dirpath"""
+
+    try:
+        filenames = os.listdir(dirpath)
+    except OSError:
+        return 0
+    return files_size(os.path.join(dirpath, f) for f in filenames)
+
+def count_outputs(outdir, since):
+    """Return the number of files of outdir modified after since, not
+    counting the folders.
+
+    This is approximate if several jobs write in the same folder at the
+    same time."""
+
+    count = 0
+    try:
+        filenames = os.listdir(outdir)
+    except OSError:
+        return 0
+    for filename in filenames:
+        path = os.path.join(outdir, filename)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) >= since:
+                count += 1
+        except OSError:
+            pass
+    return count
+
+def percentile(values, p):
+    """Return the p percentile of values, with p between 0 and 100"""
+
+    if not values:
+        return 0.
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def job_record(tool, folder, queued, started, finished, returncode,
+               input_bytes, input_files, output_files):
+    """Return the structured record of a finished job"""
+
+    return {'tool': tool,
+            'folder': folder,
+            'queued': queued,
+            'start': started,
+            'end': finished,
+            'wait': started - queued,
+            'duration': finished - started,
+            'returncode': returncode,
+            'input_bytes': input_bytes,
+            'input_files': input_files,
+            'output_files': output_files}
+
+
+class Metrics(object):
+    """Collect the job records, optionally writing them as JSON lines to
+       the file path."""
+
+    def __init__(self, path=None):
+        self.records = []
+        self.output = open(path, 'a') if path else None
+
+    def add(self, record):
+        self.records.append(record)
+        if self.output is not None:
+            self.output.write(json.dumps(record, sort_keys=True) + '\n')
+            self.output.flush()
+
+    def summary(self):
+        """Return the summary of the records, as {tool: statistics}"""
+
+        tools = {}
+        for record in self.records:
+            tools.setdefault(record['tool'], []).append(record)
+
+        summary = {}
+        for tool, records in tools.items():
+            wall = max(r['end'] for r in records) - \
+                   min(r['start'] for r in records)
+            durations = [r['duration'] for r in records]
+            files = sum(r['input_files'] for r in records)
+            nbytes = sum(r['input_bytes'] for r in records)
+            summary[tool] = {
+                'jobs': len(records),
+                'failed': len([r for r in records if r['returncode'] != 0]),
+                'files': files,
+                'bytes': nbytes,
+                'output_files': sum(r['output_files'] for r in records),
+                'wall': wall,
+                'files_per_s': files / wall if wall > 0 else 0.,
+                'mb_per_s': nbytes / 1e6 / wall if wall > 0 else 0.,
+                'p50': percentile(durations, 50),
+                'p95': percentile(durations, 95),
+                'wait_p50': percentile([r['wait'] for r in records], 50),
+            }
+        return summary
+
+    def format_summary(self):
+        lines = []
+        for tool, s in sorted(self.summary().items()):
+            lines.append('%s: %d jobs (%d failed), %d files in %.1f s, '
+                '%.1f files/s, %.2f MB/s, latency p50 %.2f s p95 %.2f s, '
+                'queue wait p50 %.2f s, %d output files'
+                % (tool, s['jobs'], s['failed'], s['files'], s['wall'],
+                   s['files_per_s'], s['mb_per_s'], s['p50'], s['p95'],
+                   s['wait_p50'], s['output_files']))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file priority.py
+    \date 2013
+
+    \mainpage Order in which the folders are converted
+
+    By default folders are converted in the order of the walk of the input
+    folder. After a long session the interesting folder is usually the last
+    one written, so the folders can rather be ordered newest first, or
+    smallest first to get some images quickly. Pinned folders always come
+    first.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+
+from metrics import folder_size
+
+POLICIES = ('walk', 'newest', 'smallest')
+
+def folder_key(dirname, policy):
+    """Return the sort key of dirname for policy, lower keys first"""
+
+    if policy == 'newest':
+        # a new file changes the folder modification time
+        try:
+            return -os.path.getmtime(dirname)
+        except OSError:
+            return 0
+    elif policy == 'smallest':
+        return folder_size(dirname)
+    return 0
+
+def prioritize(items, policy='walk', pinned=(), key=None):
+    """Return items sorted by policy, the items in pinned folders first in
+    the order of pinned. key(item) gives the folder of an item, by default
+    the item is the folder. The walk order is kept between equal items."""
+
+    if key is None:
+        key = lambda item: item
+    pinned = [os.path.normcase(os.path.abspath(p)) for p in pinned]
+    if policy == 'walk' and not pinned:
+        return list(items)
+
+    keys = {}
+    def sort_key(item):
+        dirname = key(item)
+        if dirname not in keys:
+            path = os.path.normcase(os.path.abspath(dirname))
+            rank = pinned.index(path) if path in pinned else len(pinned)
+            keys[dirname] = (rank, folder_key(dirname, policy))
+        return keys[dirname]
+    return sorted(items, key=sort_key)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file processlog.py
+    \date 2013
+
+    \mainpage Bounded log of the output of a conversion process
+
+    Only the last part of the output of a process is kept in memory. Older
+    output is written to a log file on disk, so that long runs of gwyexport
+    printing the metadata of every file do not grow the memory usage
+    without limit.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import tempfile
+from collections import deque
+
+MAX_MEMORY_LOG = 256*1024 # bytes of output kept in memory per process
+
+
+class ProcessLog(object):
+    """The output of a process, as utf-8 bytes.
+
+    At most maxBytes are kept in memory, in a ring of chunks. When the ring
+    is full the oldest chunks are moved to a log file created in spillDir,
+    or dropped if spillDir is None. Positions count all the bytes ever
+    appended, so that a reader can ask only for what it has not seen yet."""
+
+    def __init__(self, maxBytes=MAX_MEMORY_LOG, spillDir=None):
+        self.maxBytes = maxBytes
+        self.spillDir = spillDir
+        self.chunks = deque()
+        self.size = 0 # bytes in memory
+        self.start = 0 # position of the first byte in memory
+        self.spillPath = None
+
+    def __len__(self):
+        return self.start + self.size
+
+    def append(self, text):
+        """Append text (unicode or utf-8 bytes), return its position"""
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        position = len(self)
+        if not text:
+            return position
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size > self.maxBytes:
+            self.trim()
+        return position
+
+    def trim(self):
+        """Move the oldest chunks out of memory until maxBytes fit"""
+
+        old = []
+        while self.size > self.maxBytes and len(self.chunks) > 1:
+            chunk = self.chunks.popleft()
+            self.size -= len(chunk)
+            self.start += len(chunk)
+            old.append(chunk)
+        if self.size > self.maxBytes: # a single huge chunk, keep its end
+            chunk = self.chunks.popleft()
+            cut = len(chunk) - self.maxBytes
+            old.append(chunk[:cut])
+            self.chunks.append(chunk[cut:])
+            self.size -= cut
+            self.start += cut
+
+        if self.spillDir is None:
+            return
+        if self.spillPath is None:
+            fd, self.spillPath = tempfile.mkstemp(prefix='autoconvert-',
+                                                  suffix='.log',
+                                                  dir=self.spillDir)
+            os.close(fd)
+        with open(self.spillPath, 'ab') as f:
+            f.write(''.join(old))
+
+    def since(self, position):
+        """Return the text appended after position which is still in
+        memory, and the position of the end of the log"""
+
+        end = len(self)
+        # from the last chunk back to the one holding position, as readers
+        # usually only miss the last few chunks
+        parts = []
+        offset = end # position of the chunk
+        for chunk in reversed(self.chunks):
+            if offset <= position:
+                break
+            offset -= len(chunk)
+            parts.append(chunk[max(0, position - offset):])
+        data = ''.join(reversed(parts))
+        return unicode(data, 'utf-8', errors='replace'), end
+
+    def text(self):
+        """Return the text kept in memory, preceded by a note if the
+        beginning of the log is not in memory"""
+
+        text = self.since(0)[0]
+        if self.start == 0:
+            return text
+        if self.spillPath is not None:
+            note = '[%d bytes of earlier output in %s]\n' % (self.start,
+                                                           self.spillPath)
+        else:
+            note = '[%d bytes of earlier output dropped]\n' % self.start
+        return note + text
+
+    def close(self):
+        """Free the memory and remove the log file"""
+
+        self.chunks.clear()
+        self.start += self.size
+        self.size = 0
+        if self.spillPath is not None:
+            try:
+                os.remove(self.spillPath)
+            except OSError:
+                pass
+            self.spillPath = None
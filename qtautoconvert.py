@@ -36,44 +36,27 @@
 
 """
 
-import sys, os, re
+import sys, os, time, heapq, shutil, tempfile, threading
 
 from PyQt4 import Qt
 
+import engine
+from watcher import Watcher
+from metrics import Metrics, count_outputs, job_record
+from concurrency import ConcurrencyController, cpu_count
+from processlog import ProcessLog
+from priority import POLICIES, prioritize
+from journal import Journal
+
 debug = False
 
-class InvalidFlag(Exception): pass
+MAX_LOG_LINES = 5000 # lines shown in the details of a process
+MAX_DONE_JOBS = 10000 # finished jobs kept in the table between conversions
 
 def _tr(s):
     """ Allow to implement a translation mechanism """
     return s
 
-    
-def build_command_list(cmd, flags='', arguments={}):
-
-    command_list = [cmd,]
-
-    try:
-        argument = re.compile('^\{.*\}$')
-        for flag in flags.split(' '):
-            if argument.match(flag):
-                if isinstance(arguments[flag], list):
-                    command_list.extend(arguments[flag])
-                else:
-                    command_list.append(arguments[flag])
-            else:
-                command_list.append(flag)
-    except KeyError:
-        mb = Qt.QMessageBox()
-        mb.setWindowTitle('Error')
-        mb.setIcon(Qt.QMessageBox.Critical)
-        mb.setText(_tr('Error malformed command string for %s,\n' \
-                       'check flags %s' % (cmd, flags)))
-        mb.exec_()
-        raise InvalidFlag
-
-    return command_list
-
 
 class RetardedProcess(Qt.QProcess):
     """Implement a process class that can be started on will later."""
@@ -99,56 +82,320 @@ class RetardedProcess(Qt.QProcess):
 
             
 class ProcessesQueue(Qt.QObject):
-    """Implement a very basic process queue fro the many conversion
-       processes."""
+    """Implement a very basic queue for the many conversion jobs.
+
+       The process of a job is only created when the job starts and it is
+       released once finished, so that waiting and finished jobs do not
+       hold any Qt object.
+
+       A job can be held until another job, usually from another queue, has
+       finished. This allows a pipeline of queues without waiting for the
+       whole previous queue to finish.
+
+       Jobs start in the order they were queued, except for pinned jobs
+       which start first.
+
+       A process running longer than timeout seconds, or without output for
+       idleTimeout seconds, is stopped. A failed job is run again up to
+       retries times, after retryDelay seconds doubled at each retry, and
+       then added to deadLetters. The jobDone signal is emitted with each
+       job once it will not run anymore. A failed job converting a group
+       of folders is not retried, its folders are queued again one by one
+       by the window.
+
+       If a controller is given, it sets the number of simultaneous
+       processes each time a process finishes. If maxBacklog is given,
+       producers should not append jobs while isFull(), and wait for the
+       backlogAvailable() signal."""
 
-    def __init__(self, maxProcesses=2, *args):
+    def __init__(self, maxProcesses=2, controller=None, maxBacklog=None,
+                 *args):
 
         Qt.QObject.__init__(self, *args)
 
         self.maxProcesses = maxProcesses
-        self.processesQueue = []
-        self.running = 0
+        self.controller = controller
+        if controller is not None:
+            self.maxProcesses = controller.limit
+        self.maxBacklog = maxBacklog
+        self.processesQueue = [] # heap of (key, job), some may be outdated
+        self.queued = set()
+        self.held = set()
+        self.running = set()
+        self.retrying = set()
+        self.count = 0
+
+        self.timeout = None
+        self.idleTimeout = None
+        self.retries = 0
+        self.retryDelay = 10.
+        self.deadLetters = []
+        self.watchdog = Qt.QTimer(self)
+        self.watchdog.setInterval(1000)
+        Qt.QObject.connect(self.watchdog, Qt.SIGNAL("timeout()"),
+                           self.checkRunning)
+
+    def append(self, job, after=None):
+        """Queue job, if after is given the job is only queued once the
+           after job has finished."""
+
+        if after is None or after.isDone():
+            self.enqueue(job)
+            self.startProcesses()
+        else:
+            job.state = 'held'
+            job.waitsFor = after
+            self.held.add(job)
+            after.dependents.append((self, job))
 
-    def append(self,process):
-        self.processesQueue.append(process)
+    def enqueue(self, job):
+        job.state = 'queued'
+        job.queued = time.time()
+        self.queued.add(job)
+        self.push(job)
 
-        Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
-                           self.startNextProcess)
-        Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
-                           self.countFinished)
+    def push(self, job):
+        job.queueKey = (0 if job.pinned else 1, self.count)
+        self.count += 1
+        heapq.heappush(self.processesQueue, (job.queueKey, job))
+
+    def pin(self, job):
+        """Start job before the not pinned jobs"""
+
+        job.pinned = True
+        if job in self.queued:
+            self.push(job) # the previous entry is now outdated
+
+    def release(self, job):
+        """Move a held job to the queue and start it if a slot is free"""
+
+        if job not in self.held: # already released or queue stopped
+            return
+        self.held.remove(job)
+        self.enqueue(job)
+        self.startProcesses()
+
+    def isIdle(self):
+        """Return whether no job is waiting, running or will be retried"""
+        return not (self.queued or self.running or self.held or
+                    self.retrying)
+
+    def isFull(self):
+        return self.maxBacklog is not None and \
+               len(self.queued) + len(self.held) >= self.maxBacklog
 
     def startNextProcess(self):
-        if len(self.processesQueue) == 0:
+        if len(self.queued) == 0:
             return
 
-        p = self.processesQueue.pop(0)
-        self.running+=1
-        p.start()
+        key, job = heapq.heappop(self.processesQueue)
+        while job not in self.queued or key != job.queueKey:
+            key, job = heapq.heappop(self.processesQueue)
+        self.queued.remove(job)
+        process = job.createProcess(self)
+        # connected first, so that the job is complete before jobDone
+        if job.processCreated is not None:
+            job.processCreated(process)
+        Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
+                           lambda exitCode: self.jobFinished(job, exitCode))
+        Qt.QObject.connect(process,
+                           Qt.SIGNAL("error(QProcess::ProcessError)"),
+                           lambda error: self.processError(job, error))
+        def activity():
+            job.lastActivity = time.time()
+        for signal in ("readyReadStandardOutput()",
+                       "readyReadStandardError()"):
+            Qt.QObject.connect(process, Qt.SIGNAL(signal), activity)
+
+        self.running.add(job)
+        job.state = 'running'
+        job.attempts += 1
+        job.reason = None
+        job.runStarted = job.lastActivity = time.time()
+        if not self.watchdog.isActive():
+            self.watchdog.start()
+        process.start()
+
+    def checkRunning(self):
+        """Stop the processes running for too long or without output"""
+
+        now = time.time()
+        for job in list(self.running):
+            if job.reason is not None or job.process is None:
+                continue
+            if self.timeout and now - job.runStarted > self.timeout:
+                job.reason = 'timeout'
+                message = 'running for more than %g s' % self.timeout
+            elif self.idleTimeout and \
+                 now - job.lastActivity > self.idleTimeout:
+                job.reason = 'idle'
+                message = 'no output for %g s' % self.idleTimeout
+            else:
+                continue
+            if job.log is not None:
+                job.log.append('error: %s, stopped\n' % message)
+            job.terminate()
+
+    def startProcesses(self):
+        """Start queued jobs until maxProcesses are running"""
+        while len(self.running) < self.maxProcesses and self.queued:
+            self.startNextProcess()
 
-    def countFinished(self):
+    def jobFinished(self, job, exitCode):
+        if job.reason is not None or \
+           job.process.exitStatus() == Qt.QProcess.CrashExit:
+            exitCode = exitCode or -1
+        job.setFinished(exitCode)
+        self.jobDone(job)
 
-        self.running-=1
-        if len(self.processesQueue) == 0 and self.running == 0:
+    def processError(self, job, error):
+        job.error = error
+        # a process which failed to start never emits finished(int)
+        if error == Qt.QProcess.FailedToStart:
+            job.state = 'error'
+            self.jobDone(job)
+
+    def jobDone(self, job):
+
+        self.running.discard(job)
+        if not self.running:
+            self.watchdog.stop()
+        job.releaseProcess()
+        if job.state == 'error' and job.attempts <= self.retries and \
+           job.group is None:
+            job.state = 'retry'
+            self.retrying.add(job)
+            delay = self.retryDelay * 2 ** (job.attempts - 1)
+            Qt.QTimer.singleShot(int(delay * 1000), lambda: self.retry(job))
+        else:
+            if job.state == 'error' and job.group is None:
+                self.deadLetters.append(job)
+            for queue, dependent in job.dependents:
+                queue.release(dependent)
+            job.dependents = []
+            self.emit(Qt.SIGNAL("jobDone"), job)
+
+        if self.controller is not None:
+            self.controller.job_finished()
+            self.maxProcesses = self.controller.update(len(self.running),
+                                                       len(self.queued))
+        self.startProcesses()
+        if not self.isFull():
+            self.emit(Qt.SIGNAL("backlogAvailable()"))
+
+        if self.isIdle():
             if debug: print 'Queue finished'
             self.emit(Qt.SIGNAL("finished()"))
-        
+
+    def retry(self, job):
+        if job not in self.retrying: # queue stopped
+            return
+        self.retrying.remove(job)
+        self.enqueue(job)
+        self.startProcesses()
+
     def start(self):
 
-        if len(self.processesQueue) == 0:
+        if len(self.queued) == 0 and len(self.held) == 0:
             self.emit(Qt.SIGNAL("finished()"))
-            
-        for i in range(self.maxProcesses):
-            self.startNextProcess()
+
+        self.startProcesses()
 
     def stop(self):
+        """Cancel the waiting jobs, the running ones continue"""
+
+        for job in self.queued:
+            job.setCanceled()
+        for job in self.held | self.retrying:
+            job.setCanceled()
+        for job in self.queued | self.held | self.retrying:
+            self.emit(Qt.SIGNAL("jobDone"), job)
         self.processesQueue = []
+        self.queued = set()
+        self.held = set()
+        self.retrying = set()
+
+
+class ScanThread(Qt.QThread):
+    """Plan the conversion in the background: walk the input folder, create
+       the output folders and prepare the first jobs of each folder, as the
+       file system may be slow.
+
+       plan is called in the thread as plan(cancelled) and returns the
+       (dirname, tools) to convert. The folderPlanned(dirname, tools, jobs)
+       signal is emitted for each folder with its Vernissage job, or its
+       Gwyexport jobs without Vernissage, and scanError(error) if the
+       planning failed. The scan waits while paused and stops once
+       cancelled.
+
+       The Vernissage jobs of several folders are packed in group jobs as
+       set by the settings, so the jobs of a folder may come with another
+       folder, and the last ones with the jobsPlanned(jobs) signal."""
+
+    def __init__(self, plan, settings, *args):
+
+        Qt.QThread.__init__(self, *args)
+        self.plan = plan
+        self.settings = settings
+        self.condition = threading.Condition()
+        self.paused = False
+        self.cancelled = False
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def isCancelled(self):
+        return self.cancelled
+
+    def waitResumed(self):
+        """Wait while paused, return False if cancelled"""
+
+        with self.condition:
+            while self.paused and not self.cancelled:
+                self.condition.wait()
+            return not self.cancelled
+
+    def run(self):
+        try:
+            planned = iter(self.plan(self.isCancelled))
+            grouper = engine.VernissageGrouper(self.settings)
+            while self.waitResumed():
+                try:
+                    dirname, tools = next(planned)
+                except StopIteration:
+                    break
+                engine.make_output_folders(dirname, tools, self.settings)
+                jobs = []
+                if 'vernissage' in tools:
+                    jobs = grouper.add(engine.vernissage_job(dirname,
+                                                             self.settings))
+                elif 'gwyexport' in tools:
+                    jobs = engine.gwyexport_jobs(dirname, self.settings)[0]
+                self.emit(Qt.SIGNAL("folderPlanned"), dirname, tools, jobs)
+            if not self.cancelled:
+                self.emit(Qt.SIGNAL("jobsPlanned"), grouper.flush())
+        except (OSError, engine.InvalidFlag), e:
+            self.emit(Qt.SIGNAL("scanError"), e)
 
 
 class DetailMessageBox(Qt.QMessageBox):
-    """A message box to show the result of the launched process """
+    """A message box to show the result of the process of a job.
+
+    The output is stored in the job log, the text edit is only updated with
+    the new output while the message box is visible."""
 
-    def __init__(self, process, button, *args):
+    def __init__(self, job, *args):
 
         Qt.QMessageBox.__init__(self, *args)
         self.setIcon(Qt.QMessageBox.Information)
@@ -160,6 +407,7 @@ class DetailMessageBox(Qt.QMessageBox):
 
         # Get the text edit out of the message box
         self.logTextEdit = self.children()[4].children()[2]
+        self.logTextEdit.document().setMaximumBlockCount(MAX_LOG_LINES)
         horizontalSpacer = Qt.QSpacerItem(500, 0,
                            Qt.QSizePolicy.Minimum, Qt.QSizePolicy.Expanding)
         # Add a spacer to control the message box size
@@ -167,27 +415,24 @@ class DetailMessageBox(Qt.QMessageBox):
         layout.addItem(horizontalSpacer, layout.rowCount(), 0, 1,
                        layout.columnCount());
 
-        self.button = button
-        self.process = process
-        self.log = Qt.QString()
+        self.job = job
+        self.log = job.log
+        self.shown = 0 # position in the log of the end of the shown text
 
-    def readOutput(self):
-        self.log.append(
-            Qt.QString(unicode(self.process.readAllStandardOutput(),'utf-8',
-                               errors='replace')))
-        self.setDetailedText(self.log)
+    def showNewOutput(self):
+        if not self.isVisible():
+            return
+        text, self.shown = self.log.since(self.shown)
         self.logTextEdit.moveCursor(Qt.QTextCursor.End)
-
-    def readErrors(self):
-        self.log.append("error: " +
-            Qt.QString(unicode(self.process.readAllStandardError(),'utf-8',
-                               errors='replace')))
-        self.setDetailedText(self.log)
+        self.logTextEdit.insertPlainText(text)
         self.logTextEdit.moveCursor(Qt.QTextCursor.End)
 
     def showEvent(self, event):
 
-        state = self.process.state()
+        process = self.job.process
+        state = Qt.QProcess.NotRunning
+        if process is not None:
+            state = process.state()
         if state == Qt.QProcess.NotRunning:
             self.setText(_tr('Not running'))
         elif state == Qt.QProcess.Starting:
@@ -195,7 +440,7 @@ class DetailMessageBox(Qt.QMessageBox):
         elif state == Qt.QProcess.Running:
             self.setText(_tr('Running'))
             
-        error = self.process.error()
+        error = self.job.error
         if error == Qt.QProcess.FailedToStart:
             self.setInformativeText(_tr('The process failed to start. Either ' \
 'the invoked program is missing, or you may have insufficient permissions to ' \
@@ -216,59 +461,259 @@ class DetailMessageBox(Qt.QMessageBox):
         elif error == Qt.QProcess.UnknownError:
             self.setInformativeText(_tr('Check process output below.'))
 
-        self.setDetailedText(self.log)
+        self.shown = len(self.log)
+        self.setDetailedText(self.log.text())
         self.logTextEdit.moveCursor(Qt.QTextCursor.End)
 
         super(DetailMessageBox, self).showEvent(event)
 
 
-class StatusItem(Qt.QTableWidgetItem):
-    """An item showing the state of the conversion process"""
+class ProcessJob(object):
+    """A conversion job with its state, timing and output log, as shown in
+    one row of the jobs table.
 
-    States = {'idle':0,'running':1,'error':2,'finished':3,'cancelled':4}
+    The process is created by the queue when the job starts, and
+    processCreated, if set, is then called with it, before the queue
+    connects the process, so that its slots run before the job is done.
+    The process is deleted once finished."""
 
-    def __init__(self, *args):
+    DoneStates = ('finished', 'error', 'cancelled')
 
-        Qt.QTableWidgetItem.__init__(self, *args)
-        self.setIdle()
+    def __init__(self, args, name, folder, outdir, files=None, log=None,
+                 workingDirectory=None):
 
-    def setState(self, s):
-        self.state = StatusItem.States[s]
+        self.args = args
+        self.name = name
+        self.tool = name.lower()
+        self.folder = folder
+        self.outdir = outdir
+        self.files = files
+        self.log = log
+        self.workingDirectory = workingDirectory
+        self.state = 'idle'
+        self.error = Qt.QProcess.UnknownError
+        self.row = None
+        self.dialog = None # created when the details are first shown
+        self.process = None
+        self.processCreated = None
+        self.dependents = [] # (queue, job) held until this job is done
+        self.waitsFor = None # the job this one is held for
+        self.pinned = False
+        self.queueKey = None
+        self.attempts = 0
+        self.reason = None # why the queue stopped the process
+        self.runStarted = None
+        self.lastActivity = None
+        self.journal = None
+        self.journalFolder = None
+        self.group = None # the engine job, if converting several folders
+
+        self.queued = None
+        self.started = None
+        self.finished = None
+        self.inputFiles = None
+        self.inputBytes = None
+        self.outputs = None
+
+    def createProcess(self, parent):
+        self.process = RetardedProcess(self.args, parent)
+        if self.workingDirectory:
+            self.process.setWorkingDirectory(self.workingDirectory)
+        return self.process
+
+    def releaseProcess(self):
+        if self.process is not None:
+            self.process.deleteLater()
+            self.process = None
+
+    def isDone(self):
+        return self.state in ProcessJob.DoneStates
 
-    def setIdle(self):
-        self.setState('idle')
-        self.setIcon(Qt.QIcon('img/idle.svgz'))
-        self.setText(_tr('Idle'))
+    def setFinished(self, exitCode):
+        if self.state == 'running':
+            # /!\ a zero exit code does not imply success of process
+            self.state = 'finished' if exitCode == 0 else 'error'
 
-    def setStarted(self):
-        if self.state == StatusItem.States['idle']:
-            self.setState('running')
-            self.setIcon(Qt.QIcon('img/running.svgz'))
-            self.setText(_tr('Running'))
+    def setCanceled(self):
+        if self.state in ('idle', 'held', 'queued', 'running', 'retry'):
+            self.state = 'cancelled'
 
-    def setFinished(self, exitCode):
-        if self.state == StatusItem.States['running']:
-            if exitCode == 0:
-                self.setFinishedDone() # /!\ do not imply success of process
-            else:
-                self.setFinishedError()
+    def isStoppable(self):
+        return self.state == 'running' and self.process is not None
 
-    def setFinishedDone(self):
-        self.setState('finished')
-        self.setIcon(Qt.QIcon('img/done.svgz'))
-        self.setText(_tr('Done'))
+    def terminate(self):
+        """Terminate the process, and kill it if still running 5 s later"""
 
-    def setFinishedError(self):
-        self.setState('error')
-        self.setIcon(Qt.QIcon('img/error.svgz'))
-        self.setText(_tr('Error'))
+        process = self.process
+        process.terminate()
+        def kill():
+            if self.process is process: # not finished and released yet
+                process.kill()
+        Qt.QTimer.singleShot(5000, kill)
 
-    def setCanceled(self):
-        if self.state == StatusItem.States['running'] or \
-           self.state == StatusItem.States['idle'] :
-            self.setState('cancelled')
-            self.setIcon(Qt.QIcon('img/canceled.svgz'))
-            self.setText(_tr('Canceled'))
+    def stop(self):
+        self.terminate()
+        self.setCanceled()
+
+
+class ProcessesModel(Qt.QAbstractTableModel):
+    """The table of the conversion jobs. Nothing is drawn for the rows out
+    of view, so that large batches do not create any widget."""
+
+    Columns = [_tr('Process'), _tr('File/Folder'), _tr('Status'),
+               _tr('Detail'), _tr('Force stop'), _tr('Queue wait'),
+               _tr('Duration'), _tr('Input size'), _tr('Output files')]
+    DetailColumn = 3
+    StopColumn = 4
+
+    def __init__(self, *args):
+
+        Qt.QAbstractTableModel.__init__(self, *args)
+        self.jobs = []
+        self.states = {
+            'idle': (_tr('Idle'), Qt.QIcon('img/idle.svgz')),
+            'held': (_tr('Idle'), Qt.QIcon('img/idle.svgz')),
+            'queued': (_tr('Idle'), Qt.QIcon('img/idle.svgz')),
+            'retry': (_tr('Retrying'), Qt.QIcon('img/idle.svgz')),
+            'running': (_tr('Running'), Qt.QIcon('img/running.svgz')),
+            'error': (_tr('Error'), Qt.QIcon('img/error.svgz')),
+            'finished': (_tr('Done'), Qt.QIcon('img/done.svgz')),
+            'cancelled': (_tr('Canceled'), Qt.QIcon('img/canceled.svgz')),
+            }
+
+    def rowCount(self, parent=Qt.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.jobs)
+
+    def columnCount(self, parent=Qt.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.Columns)
+
+    def headerData(self, section, orientation, role=Qt.Qt.DisplayRole):
+        if orientation == Qt.Qt.Horizontal and role == Qt.Qt.DisplayRole:
+            return Qt.QVariant(self.Columns[section])
+        return Qt.QAbstractTableModel.headerData(self, section, orientation,
+                                                 role)
+
+    def flags(self, index):
+        return Qt.Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.Qt.DisplayRole):
+        if not index.isValid():
+            return Qt.QVariant()
+        job = self.jobs[index.row()]
+        column = index.column()
+
+        if role == Qt.Qt.DecorationRole and column == 2:
+            return Qt.QVariant(self.states[job.state][1])
+        if role != Qt.Qt.DisplayRole:
+            return Qt.QVariant()
+
+        if column == 0:
+            return Qt.QVariant(job.name)
+        elif column == 1:
+            if job.pinned:
+                return Qt.QVariant(_tr('%s (first)') % job.folder)
+            return Qt.QVariant(job.folder)
+        elif column == 2:
+            return Qt.QVariant(self.states[job.state][0])
+        elif column == 5 and job.started is not None:
+            return Qt.QVariant('%.1f s' % (job.started - job.queued))
+        elif column == 6 and job.finished is not None:
+            return Qt.QVariant('%.1f s' % (job.finished - job.started))
+        elif column == 7 and job.inputBytes is not None:
+            return Qt.QVariant('%.1f MB' % (job.inputBytes / 1e6))
+        elif column == 8 and job.outputs is not None:
+            return Qt.QVariant(str(job.outputs))
+        return Qt.QVariant()
+
+    def job(self, row):
+        return self.jobs[row]
+
+    def addJob(self, job):
+        row = len(self.jobs)
+        self.beginInsertRows(Qt.QModelIndex(), row, row)
+        job.row = row
+        self.jobs.append(job)
+        self.endInsertRows()
+
+    def jobChanged(self, job):
+        self.emit(Qt.SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
+                  self.index(job.row, 0),
+                  self.index(job.row, len(self.Columns) - 1))
+
+    def removeDone(self, keep):
+        """Remove the oldest done jobs, keeping the last keep of them"""
+
+        done = [job for job in self.jobs
+                    if job.isDone() and job.process is None]
+        removed = set(id(job) for job in done[:max(0, len(done) - keep)])
+        if not removed:
+            return
+        self.beginResetModel()
+        for job in done[:len(removed)]:
+            job.log.close()
+            if job.dialog is not None:
+                job.dialog.deleteLater()
+        self.jobs = [job for job in self.jobs if id(job) not in removed]
+        for row, job in enumerate(self.jobs):
+            job.row = row
+        self.endResetModel()
+
+    def cancelAll(self):
+        """Mark the idle and running jobs as canceled"""
+
+        for job in self.jobs:
+            job.setCanceled()
+        if self.jobs:
+            self.emit(Qt.SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
+                      self.index(0, 0),
+                      self.index(len(self.jobs) - 1, len(self.Columns) - 1))
+
+
+class ButtonDelegate(Qt.QStyledItemDelegate):
+    """Draw a push button in the cells of a column, and emit clicked(int)
+    with the row when it is clicked.
+
+    enabled(job) and checked(job) give the state of the button of a job."""
+
+    def __init__(self, icon, text, enabled, checked=None, *args):
+
+        Qt.QStyledItemDelegate.__init__(self, *args)
+        self.icon = icon
+        self.text = text
+        self.enabled = enabled
+        self.checked = checked
+
+    def paint(self, painter, option, index):
+        job = index.model().job(index.row())
+
+        button = Qt.QStyleOptionButton()
+        button.rect = option.rect
+        button.icon = self.icon
+        button.iconSize = Qt.QSize(16, 16)
+        button.text = self.text
+        button.state = Qt.QStyle.State_Raised
+        if self.enabled(job):
+            button.state |= Qt.QStyle.State_Enabled
+        if self.checked is not None and self.checked(job):
+            button.state |= Qt.QStyle.State_On
+        Qt.QApplication.style().drawControl(Qt.QStyle.CE_PushButton, button,
+                                            painter)
+
+    def sizeHint(self, option, index):
+        return Qt.QSize(option.fontMetrics.width(self.text) + 40,
+                        option.fontMetrics.height() + 10)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == Qt.QEvent.MouseButtonRelease \
+           and option.rect.contains(event.pos()) \
+           and self.enabled(model.job(index.row())):
+            self.emit(Qt.SIGNAL("clicked(int)"), index.row())
+            return True
+        return False
 
     
 class FolderLineEdit(Qt.QHBoxLayout):
@@ -347,6 +792,10 @@ class AutoconvertWindow(Qt.QMainWindow):
         # store the application for the quit action
         self.application = application
 
+        self.logDir = None # for the output of the processes
+        self.converting = False
+        self.scanner = None # the ScanThread planning the conversion
+
         widget = Qt.QWidget(self)
         layout = Qt.QFormLayout()
         widget.setLayout(layout)
@@ -402,7 +851,12 @@ class AutoconvertWindow(Qt.QMainWindow):
                             " file conversion ?"),
                         Qt.QMessageBox.Cancel | Qt.QMessageBox.Yes):
             self.cancelConvert()
+            self.watchAct.setChecked(False)
             self.writeSettings()
+            for journal in getattr(self, 'journals', {}).values():
+                journal.close()
+            if self.logDir is not None:
+                shutil.rmtree(self.logDir, ignore_errors=True)
 
             if event:
                 event.accept()
@@ -429,6 +883,21 @@ class AutoconvertWindow(Qt.QMainWindow):
         Qt.QObject.connect( self.startAct, Qt.SIGNAL( "triggered()" ),
             self.startConvert )
 
+        self.resumeAct = Qt.QAction(Qt.QIcon('img/start.svgz'),
+            _tr('Resume last run'), self)
+        self.resumeAct.setToolTip(_tr('Convert only the folders which were '
+            'not converted successfully by the last run'))
+        Qt.QObject.connect(self.resumeAct, Qt.SIGNAL("triggered()"),
+            lambda: self.startConvert(resume=True))
+
+        self.watchAct = Qt.QAction(Qt.QIcon('img/arrow-right-double.svgz'),
+            _tr('Watch input folder'), self)
+        self.watchAct.setCheckable(True)
+        self.watchAct.setToolTip(_tr('Convert new data files as soon as '
+                                     'they are written in the input folder'))
+        Qt.QObject.connect(self.watchAct, Qt.SIGNAL("toggled(bool)"),
+                           self.toggleWatch)
+
         self.configureAct = Qt.QAction(self)
         self.configureAct.setIcon( Qt.QIcon('img/config.svgz') )
         self.configureAct.setText( _tr('Show options') )
@@ -441,7 +910,9 @@ class AutoconvertWindow(Qt.QMainWindow):
         self.convertToolBar = Qt.QToolBar( _tr( "Convert" ) )
         self.convertToolBar.setObjectName( "Convert tools" )
         self.convertToolBar.addAction(self.startAct)
+        self.convertToolBar.addAction(self.resumeAct)
         self.convertToolBar.addAction(self.cancelAct)
+        self.convertToolBar.addAction(self.watchAct)
         self.convertToolBar.addSeparator()
         self.convertToolBar.addAction(self.quitAct)
 
@@ -460,7 +931,9 @@ class AutoconvertWindow(Qt.QMainWindow):
 
         self.convertMenu = self.menuBar().addMenu( _tr('Convert') )
         self.convertMenu.addAction(self.startAct)
+        self.convertMenu.addAction(self.resumeAct)
         self.convertMenu.addAction(self.cancelAct)
+        self.convertMenu.addAction(self.watchAct)
         self.convertMenu.addSeparator()
         self.convertMenu.addAction( self.quitAct )
 
@@ -472,12 +945,35 @@ class AutoconvertWindow(Qt.QMainWindow):
         self.outputDock.setObjectName('outputdock')
         self.addDockWidget( Qt.Qt.BottomDockWidgetArea, self.outputDock )
 
-        self.processesListWidget = Qt.QTableWidget(0, 5)
-        self.processesListWidget.setHorizontalHeaderLabels(Qt.QStringList(
-            [_tr('Process'), _tr('File/Folder'), _tr('Status'),
-             _tr('Detail'), _tr('Force stop')]))
+        self.processesModel = ProcessesModel(self)
+        self.processesView = Qt.QTableView()
+        self.processesView.setModel(self.processesModel)
+        self.processesView.setSelectionMode(Qt.QAbstractItemView.NoSelection)
+        # fixed row heights, so that the view never measures all the rows
+        self.processesView.verticalHeader().setResizeMode(
+            Qt.QHeaderView.Fixed)
+
+        detailDelegate = ButtonDelegate(Qt.QIcon('img/detail.svgz'),
+            _tr('Details'), lambda job: True,
+            lambda job: job.dialog is not None and job.dialog.isVisible(),
+            self.processesView)
+        stopDelegate = ButtonDelegate(Qt.QIcon('img/stop.svgz'), _tr('Stop'),
+            ProcessJob.isStoppable, None, self.processesView)
+        self.processesView.setItemDelegateForColumn(
+            ProcessesModel.DetailColumn, detailDelegate)
+        self.processesView.setItemDelegateForColumn(
+            ProcessesModel.StopColumn, stopDelegate)
+        Qt.QObject.connect(detailDelegate, Qt.SIGNAL("clicked(int)"),
+                           self.toggleDetails)
+        Qt.QObject.connect(stopDelegate, Qt.SIGNAL("clicked(int)"),
+                           self.stopJob)
+        self.processesView.setContextMenuPolicy(Qt.Qt.CustomContextMenu)
+        Qt.QObject.connect(self.processesView,
+                           Qt.SIGNAL("customContextMenuRequested(QPoint)"),
+                           self.showJobMenu)
+
         self.outputLog = Qt.QPlainTextEdit()
-        self.outputDock.setWidget(self.processesListWidget)
+        self.outputDock.setWidget(self.processesView)
         self.outputDock.setVisible(True)
         
     def makeConfigWidget(self):
@@ -496,6 +992,13 @@ Synopsis: {-path path-spec | -file file-spec}[...]\n
         configLayout.addRow(_tr('Vernissage command path'), self.vernissageCmd)
         configLayout.addRow(_tr('Vernissage flags'), self.vernissageFlags)
         configLayout.addRow(_tr('Vernissage exporter'), self.vernissageExporter)
+        self.vernissageGroup = Qt.QSpinBox()
+        self.vernissageGroup.setRange(1, 100)
+        self.vernissageGroup.setToolTip(_tr('Convert several small folders '
+            'with each Vernissage process, repeating the flag before {path}, '
+            'so that Wine and Vernissage start only once for them.'))
+        configLayout.addRow(_tr('Folders per Vernissage process'),
+                            self.vernissageGroup)
 
         separator = Qt.QFrame()
         separator.setFrameStyle(Qt.QFrame.HLine)
@@ -578,6 +1081,17 @@ Specifies filters applied to each image.
                     will be executed.
         Example: pc;melc;poly:2,2;melc""")
         configLayout.addRow(_tr('Filters'), self.gwyexportFilters)
+
+        self.includeFiles = Qt.QLineEdit()
+        self.includeFiles.setToolTip(_tr("""
+File name patterns, separated by `;', of files always passed to Gwyexport
+when the flags use {inputfiles}. Example: *.sxm;*.dat"""))
+        configLayout.addRow(_tr('Include files'), self.includeFiles)
+        self.excludeFiles = Qt.QLineEdit()
+        self.excludeFiles.setToolTip(_tr("""
+File name patterns, separated by `;', of files never passed to Gwyexport
+when the flags use {inputfiles}. Example: *I(V)_flat"""))
+        configLayout.addRow(_tr('Exclude files'), self.excludeFiles)
         
         separator = Qt.QFrame()
         separator.setFrameStyle(Qt.QFrame.HLine)
@@ -586,14 +1100,59 @@ Specifies filters applied to each image.
         self.overwrite = Qt.QCheckBox()
         configLayout.addRow(_tr('Overwrite existing files'), self.overwrite)
 
+        self.priority = Qt.QComboBox()
+        self.priority.addItems(Qt.QStringList([_tr('Walk order'),
+                               _tr('Newest first'), _tr('Smallest first')]))
+        self.priority.setToolTip(_tr('Order in which the folders are '
+            'converted. Right click a waiting job to convert it first.'))
+        configLayout.addRow(_tr('Conversion order'), self.priority)
+
         separator = Qt.QFrame()
         separator.setFrameStyle(Qt.QFrame.HLine)
         configLayout.addRow(separator)
 
         self.maxProcesses = Qt.QSpinBox()
-        self.maxProcesses.setRange(1, 10)
+        self.maxProcesses.setRange(1, 64)
         configLayout.addRow(_tr('Number of simultaneous process'),
                             self.maxProcesses)
+        self.adaptiveProcesses = Qt.QCheckBox()
+        self.adaptiveProcesses.setToolTip(_tr('Adapt the number of '
+            'simultaneous Vernissage and Gwyexport processes to the CPU load,\n'
+            'disk load and throughput, between the minimal number and the '
+            'number above.'))
+        configLayout.addRow(_tr('Adapt number of process'),
+                            self.adaptiveProcesses)
+        self.minProcesses = Qt.QSpinBox()
+        self.minProcesses.setRange(1, 64)
+        configLayout.addRow(_tr('Minimal number of simultaneous process'),
+                            self.minProcesses)
+
+        self.vernissageTimeout = Qt.QSpinBox()
+        self.vernissageTimeout.setRange(0, 24*3600)
+        self.vernissageTimeout.setSuffix(' s')
+        self.vernissageTimeout.setSpecialValueText(_tr('No limit'))
+        configLayout.addRow(_tr('Vernissage timeout'), self.vernissageTimeout)
+        self.gwyexportTimeout = Qt.QSpinBox()
+        self.gwyexportTimeout.setRange(0, 24*3600)
+        self.gwyexportTimeout.setSuffix(' s')
+        self.gwyexportTimeout.setSpecialValueText(_tr('No limit'))
+        configLayout.addRow(_tr('Gwyexport timeout'), self.gwyexportTimeout)
+        self.idleTimeout = Qt.QSpinBox()
+        self.idleTimeout.setRange(0, 24*3600)
+        self.idleTimeout.setSuffix(' s')
+        self.idleTimeout.setSpecialValueText(_tr('No limit'))
+        self.idleTimeout.setToolTip(_tr('Stop a process which did not output '
+                                        'anything for this time, as hung.'))
+        configLayout.addRow(_tr('Inactivity timeout'), self.idleTimeout)
+        self.retries = Qt.QSpinBox()
+        self.retries.setRange(0, 10)
+        configLayout.addRow(_tr('Retries of a failed process'), self.retries)
+        self.retryDelay = Qt.QSpinBox()
+        self.retryDelay.setRange(0, 3600)
+        self.retryDelay.setSuffix(' s')
+        self.retryDelay.setToolTip(_tr('Delay before the first retry, doubled '
+                                       'at each retry.'))
+        configLayout.addRow(_tr('Retry delay'), self.retryDelay)
 
         separator = Qt.QFrame()
         separator.setFrameStyle(Qt.QFrame.HLine)
@@ -630,12 +1189,12 @@ Specifies filters applied to each image.
         self.restoreGeometry( settings.value( "windowGeometry" ).toByteArray() )
         self.outputDock.restoreGeometry(
                             settings.value("outputDockGeometry").toByteArray())
-        self.processesListWidget.restoreGeometry(settings.value(
+        self.processesView.restoreGeometry(settings.value(
                             "processesListWidgetGeometry").toByteArray())
         self.restoreState( settings.value("windowState").toByteArray() )
         self.configWidget.restoreGeometry(
                         settings.value("configDialogGeometry").toByteArray())
-        self.processesListWidget.horizontalHeader().restoreState(
+        self.processesView.horizontalHeader().restoreState(
                         settings.value("processesListWidth").toByteArray())
 
         self.inputFolder.setText(settings.value(
@@ -664,6 +1223,8 @@ Specifies filters applied to each image.
                          '-exporter {exporter}')).toString() )
         self.vernissageExporter.setText(settings.value("vernissageExporter",
              Qt.QVariant('Flattener')).toString())
+        self.vernissageGroup.setValue(settings.value("vernissageGroup",
+                          Qt.QVariant(1)).toInt()[0])
 
         self.gwyexportCmd.setText(settings.value("gwyexportCmd",
              Qt.QVariant('''c:\gwyexport\gwyexport.exe''') ).toString() )
@@ -685,8 +1246,28 @@ Specifies filters applied to each image.
                                 ).toString()))
         self.gwyexportFilters.setText(settings.value("gwyexportFilters",
                Qt.QVariant('pc;melc;sr;melc;pc') ).toString())
+        self.includeFiles.setText(settings.value("includeFiles",
+               Qt.QVariant('') ).toString())
+        self.excludeFiles.setText(settings.value("excludeFiles",
+               Qt.QVariant('') ).toString())
         self.maxProcesses.setValue(settings.value("maxProcesses",
                           Qt.QVariant(2)).toInt()[0])
+        self.priority.setCurrentIndex(settings.value("priority",
+                          Qt.QVariant(0)).toInt()[0])
+        self.vernissageTimeout.setValue(settings.value("vernissageTimeout",
+                          Qt.QVariant(0)).toInt()[0])
+        self.gwyexportTimeout.setValue(settings.value("gwyexportTimeout",
+                          Qt.QVariant(0)).toInt()[0])
+        self.idleTimeout.setValue(settings.value("idleTimeout",
+                          Qt.QVariant(0)).toInt()[0])
+        self.retries.setValue(settings.value("retries",
+                          Qt.QVariant(2)).toInt()[0])
+        self.retryDelay.setValue(settings.value("retryDelay",
+                          Qt.QVariant(10)).toInt()[0])
+        self.adaptiveProcesses.setChecked(settings.value("adaptiveProcesses",
+                          Qt.QVariant(False)).toBool())
+        self.minProcesses.setValue(settings.value("minProcesses",
+                          Qt.QVariant(1)).toInt()[0])
         
 
     def writeSettings(self):
@@ -713,6 +1294,8 @@ Specifies filters applied to each image.
                             Qt.QVariant(self.vernissageFlags.text()))
         settings.setValue("vernissageExporter",
                             Qt.QVariant(self.vernissageExporter.text()))
+        settings.setValue("vernissageGroup",
+                          Qt.QVariant(self.vernissageGroup.value()))
                             
         settings.setValue("gwyexportCmd",
                             Qt.QVariant(self.gwyexportCmd.text()))
@@ -726,35 +1309,82 @@ Specifies filters applied to each image.
                         Qt.QVariant(self.gwyexportColormap.currentText()))
         settings.setValue("gwyexportFilters",
                         Qt.QVariant(self.gwyexportFilters.text()))
-                        
+        settings.setValue("includeFiles",
+                        Qt.QVariant(self.includeFiles.text()))
+        settings.setValue("excludeFiles",
+                        Qt.QVariant(self.excludeFiles.text()))
+
         settings.setValue("windowGeometry", Qt.QVariant(self.saveGeometry()))
         settings.setValue("windowState", Qt.QVariant(self.saveState()))
         settings.setValue("outputDockGeometry",
                           Qt.QVariant(self.outputDock.saveGeometry()))
         settings.setValue("processesListWidgetGeometry",
-                          Qt.QVariant(self.processesListWidget.saveGeometry()))
+                          Qt.QVariant(self.processesView.saveGeometry()))
         settings.setValue("processesListWidth",
-           Qt.QVariant(self.processesListWidget.horizontalHeader().saveState()))
+           Qt.QVariant(self.processesView.horizontalHeader().saveState()))
         settings.setValue("configDialogGeometry",
                           Qt.QVariant(self.configWidget.saveGeometry()))
         settings.setValue("maxProcesses",
                           Qt.QVariant(self.maxProcesses.value()))
+        settings.setValue("priority",
+                          Qt.QVariant(self.priority.currentIndex()))
+        settings.setValue("vernissageTimeout",
+                          Qt.QVariant(self.vernissageTimeout.value()))
+        settings.setValue("gwyexportTimeout",
+                          Qt.QVariant(self.gwyexportTimeout.value()))
+        settings.setValue("idleTimeout",
+                          Qt.QVariant(self.idleTimeout.value()))
+        settings.setValue("retries", Qt.QVariant(self.retries.value()))
+        settings.setValue("retryDelay", Qt.QVariant(self.retryDelay.value()))
+        settings.setValue("adaptiveProcesses",
+                          Qt.QVariant(self.adaptiveProcesses.isChecked()))
+        settings.setValue("minProcesses",
+                          Qt.QVariant(self.minProcesses.value()))
 
         
-    def startConvert(self):
+    def startConvert(self, folders=None, resume=False):
+        """Convert the input folder. If folders is given, only these folders
+           of the input folder are converted and their output overwritten,
+           as done by the watch mode. If resume, the folders converted
+           successfully by the last run are skipped."""
+
         # since Vernissage might be blocking for Gwyexport, we create
-        # two queue for the different process and start them sequentially
+        # two queue for the different process, the Gwyexport processes of
+        # a folder are queued once the Vernissage process of the folder
+        # has finished
         maxProcesses = self.maxProcesses.value()
-        self.processesQueue1 = ProcessesQueue(maxProcesses) # for vernissage
-        self.processesQueue2 = ProcessesQueue(maxProcesses) # for Gwyexport
+        controllers = [None, None]
+        if self.adaptiveProcesses.isChecked():
+            controllers = [ConcurrencyController(self.minProcesses.value(),
+                                maxProcesses, min(maxProcesses, cpu_count()))
+                           for i in range(2)]
+        # the folders are planned as the jobs run, a few jobs ahead
+        maxBacklog = engine.PLAN_AHEAD * maxProcesses
+        # for vernissage
+        self.processesQueue1 = ProcessesQueue(maxProcesses, controllers[0],
+                                              maxBacklog)
+        # for Gwyexport
+        self.processesQueue2 = ProcessesQueue(maxProcesses, controllers[1],
+                                              maxBacklog)
+        self.metrics = Metrics()
+        self.processesModel.removeDone(MAX_DONE_JOBS)
+        self.plannedTools = {}
 
         self.startButton.setEnabled(False)
         self.startAct.setEnabled(False)
+        self.resumeAct.setEnabled(False)
         self.cancelAct.setEnabled(True)
-        Qt.QObject.connect(self.processesQueue1, Qt.SIGNAL("finished()"),
-                           self.processesQueue2.start)
-        Qt.QObject.connect(self.processesQueue2, Qt.SIGNAL("finished()"),
-                           self.resetButtons)
+        for queue, timeout in ((self.processesQueue1, self.vernissageTimeout),
+                               (self.processesQueue2, self.gwyexportTimeout)):
+            queue.timeout = timeout.value()
+            queue.idleTimeout = self.idleTimeout.value()
+            queue.retries = self.retries.value()
+            queue.retryDelay = self.retryDelay.value()
+            Qt.QObject.connect(queue, Qt.SIGNAL("finished()"),
+                               self.queueFinished)
+            Qt.QObject.connect(queue, Qt.SIGNAL("jobDone"), self.jobDone)
+            Qt.QObject.connect(queue, Qt.SIGNAL("backlogAvailable()"),
+                               self.scanMore)
 
         self.ifpath = os.path.abspath(unicode(self.inputFolder.text()))
         if not os.path.isdir(self.ifpath):
@@ -770,208 +1400,438 @@ Specifies filters applied to each image.
 
         self.vofpath = os.path.abspath(unicode(self.vernissageOutFolder.text()))
         self.iofpath = os.path.abspath(unicode(self.imageOutFolder.text()))
-
+        self.settings = self.engineSettings(overwrite=folders is not None,
+                                            resume=resume)
+
+        self.converting = True
+        settings = self.settings
+        if folders is not None:
+            plan = lambda cancelled: [(dirname,
+                                       engine.plan_tools(dirname, settings))
+                                      for dirname in prioritize(folders,
+                                                    settings.priority)]
+        else:
+            ifpath = self.ifpath
+            plan = lambda cancelled: engine.stream_plan([ifpath], settings,
+                                                        cancelled)
         try:
-            if self.recursive.isChecked():
-                for dirname, subdirnames, f in os.walk(self.ifpath):
-                    self.convert(os.path.join(self.ifpath, dirname))
-            else:
-                self.convert(self.ifpath)
-        except OSError:
-            self.cancelConvert()
+            self.openJournals(resume or folders is not None)
+        except OSError, e:
+            self.conversionError(e)
             return
-        except InvalidFlag:
-            self.cancelConvert()
+
+        # the input folder is walked as the jobs run, the conversion starts
+        # with the first folder found
+        self.scanner = ScanThread(plan, settings, self)
+        Qt.QObject.connect(self.scanner, Qt.SIGNAL("folderPlanned"),
+                           self.folderPlanned)
+        Qt.QObject.connect(self.scanner, Qt.SIGNAL("jobsPlanned"),
+                           self.jobsPlanned)
+        Qt.QObject.connect(self.scanner, Qt.SIGNAL("scanError"),
+                           self.scanError)
+        Qt.QObject.connect(self.scanner, Qt.SIGNAL("finished()"),
+                           self.scanFinished)
+        self.plannedFolders = 0
+        self.processesQueue1.start()
+        self.processesQueue2.start()
+        self.statusBar().showMessage(_tr('Scanning %s...') % self.ifpath)
+        self.scanner.start()
+
+    def folderPlanned(self, dirname, tools, jobs):
+        """Queue the jobs of a folder found by the scanner, and pause it
+           once a queue is full"""
+
+        if self.sender() is not self.scanner: # canceled meanwhile
+            engine.remove_groups(jobs)
+            return
+        self.plannedFolders += 1
+        self.convert(dirname, tools, jobs)
+        if self.processesQueue1.isFull() or self.processesQueue2.isFull():
+            self.scanner.pause()
+
+    def jobsPlanned(self, jobs):
+        """Queue the last Vernissage jobs packed by the scanner"""
+
+        if self.sender() is not self.scanner: # canceled meanwhile
+            engine.remove_groups(jobs)
             return
+        for job in jobs:
+            self.queueJob(job)
+
+    def scanMore(self):
+        if self.scanner is not None and not (self.processesQueue1.isFull()
+                                             or self.processesQueue2.isFull()):
+            self.scanner.resume()
+
+    def scanError(self, error):
+        if self.sender() is self.scanner:
+            self.conversionError(error)
+
+    def scanFinished(self):
+        scanner = self.sender()
+        scanner.deleteLater()
+        if scanner is not self.scanner:
+            return
+        self.scanner = None
+        if self.plannedFolders:
+            self.statusBar().clearMessage()
         else:
-            self.processesQueue1.start() # the queue 2 will be started
-                                         # by the finished signal of 1
+            self.statusBar().showMessage(_tr('Nothing to convert, the '
+                                             'output folders already exist.'))
+        self.queueFinished()
+
+    def engineSettings(self, overwrite=False, resume=False):
+        """Return the conversion engine settings given by the widgets"""
+
+        patterns = [[p for p in unicode(edit.text()).split(';') if p]
+                    for edit in (self.includeFiles, self.excludeFiles)]
+        return engine.settings(
+            root=self.ifpath,
+            recursive=self.recursive.isChecked(),
+            novernissage=not self.exportVernissage.isChecked(),
+            vernissageoutfolder=self.vofpath,
+            vernissagecmd=unicode(self.vernissageCmd.text()),
+            vernissageflags=unicode(self.vernissageFlags.text()),
+            vernissageexporter=unicode(self.vernissageExporter.text()),
+            vernissagegroup=self.vernissageGroup.value(),
+            noimage=not self.exportImage.isChecked(),
+            imageoutfolder=self.iofpath,
+            gwyexportcmd=unicode(self.gwyexportCmd.text()),
+            gwyexportflags=unicode(self.gwyexportFlags.text()),
+            format=unicode(self.gwyexportFormat.currentText()),
+            filters=unicode(self.gwyexportFilters.text()),
+            gradient=unicode(self.gwyexportGradient.currentText()),
+            colormap=unicode(self.gwyexportColormap.currentText()),
+            include=patterns[0],
+            exclude=patterns[1],
+            jobs=self.maxProcesses.value(),
+            priority=POLICIES[self.priority.currentIndex()],
+            overwrite=self.overwrite.isChecked() or overwrite,
+            resume=resume,
+            verbose=False)
+
+    def conversionError(self, error):
+        """Show why the jobs could not be created, and stop the conversion"""
 
+        mb = Qt.QMessageBox()
+        mb.setWindowTitle('Error')
+        mb.setIcon(Qt.QMessageBox.Critical)
+        if isinstance(error, engine.InvalidFlag):
+            mb.setText(_tr(str(error)))
+        else:
+            mb.setText(_tr('Error output folder cannot be created.\n'
+                           'Process stopped'))
+            mb.setDetailedText(unicode(error))
+        mb.exec_()
+        self.cancelConvert()
+
+    def openJournals(self, resume):
+        """Open the journal of each output folder, continuing the last
+           run if resume"""
+
+        for journal in getattr(self, 'journals', {}).values():
+            journal.close()
+        self.journals = {}
+        for tool, folder in engine.output_folders(self.settings).items():
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.journals[tool] = Journal(folder, resume,
+                                          self.settings.overwrite)
+
+    def jobDone(self, job):
+        """Write the state of a job which will not run anymore to the
+           journal, and show it. Queue the Gwyexport jobs of the folder
+           once its Vernissage job is done."""
+
+        if job.group is not None:
+            self.groupDone(job)
+            return
+        if job.journal is not None:
+            job.journal.job_finished(job.journalFolder,
+                                     job.state == 'finished')
+        self.processesModel.jobChanged(job)
+        if job.tool == 'vernissage' and self.converting and \
+           'gwyexport' in self.plannedTools.pop(job.folder, ()):
+            try:
+                self.queueGwyexport(job.folder, job.pinned)
+            except (OSError, engine.InvalidFlag), e:
+                self.conversionError(e)
+
+    def groupDone(self, job):
+        """Move the output of a Vernissage job converting several folders
+           to their output folders, and continue each folder as if it was
+           converted alone. The folders of a failed group are queued again
+           one by one."""
+
+        group = job.group
+        group.started = job.runStarted
+        group.finished = time.time()
+        group.returncode = 0 if job.state == 'finished' else 1
+        group.reason = job.reason
+        self.processesModel.jobChanged(job)
+        for member in engine.split_group(group):
+            if member.returncode != 0 and job.state == 'error' and \
+               self.converting:
+                if job.journal is not None: # queued again by queueJob
+                    job.journal.job_finished(member.folder, False)
+                self.queueJob(member, job.pinned)
+                continue
+            if job.journal is not None:
+                job.journal.job_finished(member.folder,
+                                         member.returncode == 0)
+            if self.converting and \
+               'gwyexport' in self.plannedTools.pop(member.dirname, ()):
+                try:
+                    self.queueGwyexport(member.dirname, job.pinned)
+                except (OSError, engine.InvalidFlag), e:
+                    self.conversionError(e)
+                    return
+
+    def queueFinished(self):
+        if not self.converting or self.scanner is not None \
+           or not self.processesQueue1.isIdle() \
+           or not self.processesQueue2.isIdle():
+            return
+        self.converting = False
+        self.resetButtons()
+        if self.metrics.records:
+            self.statusBar().showMessage(
+                self.metrics.format_summary().replace('\n', '; '))
+        dead = self.processesQueue1.deadLetters + \
+               self.processesQueue2.deadLetters
+        if dead:
+            mb = Qt.QMessageBox(self)
+            mb.setWindowTitle(_tr('Failed jobs'))
+            mb.setIcon(Qt.QMessageBox.Warning)
+            mb.setText(_tr('%d jobs still failed after %d attempts.') %
+                       (len(dead), max(job.attempts for job in dead)))
+            mb.setDetailedText('\n'.join('%s %s: %s' % (job.name,
+                job.folder, job.reason or 'error') for job in dead))
+            mb.show()
+
+    def toggleWatch(self, checked):
+        """Start or stop watching the input folder for new data files"""
+
+        if not checked:
+            if hasattr(self, 'watcher'):
+                self.watchTimer.stop()
+                self.watcher.close()
+                del self.watcher
+            return
+
+        ifpath = os.path.abspath(unicode(self.inputFolder.text()))
+        if not os.path.isdir(ifpath):
+            mb = Qt.QMessageBox()
+            mb.setWindowTitle('Error')
+            mb.setIcon(Qt.QMessageBox.Critical)
+            mb.setText(_tr('Error input folder is not a directory'))
+            mb.setDetailedText(_tr('%s is a file or cannot '
+                                   'be read.' % ifpath))
+            mb.exec_()
+            self.watchAct.setChecked(False)
+            return
+
+        self.watcher = Watcher([ifpath], self.recursive.isChecked(),
+            exclude=(unicode(self.vernissageOutFolder.text()),
+                     unicode(self.imageOutFolder.text())))
+        self.watchedFolders = set()
+        self.watchTimer = Qt.QTimer()
+        self.watchTimer.setInterval(1000)
+        Qt.QObject.connect(self.watchTimer, Qt.SIGNAL("timeout()"),
+                           self.checkWatcher)
+        self.watchTimer.start()
 
-    def convert(self, path):
-        """" dirname is an absolute path """
+    def checkWatcher(self):
+        """Queue the folders with new data, once no conversion is running"""
+
+        self.watchedFolders.update(self.watcher.changes())
+        if self.watchedFolders and self.startAct.isEnabled():
+            folders = sorted(self.watchedFolders)
+            self.watchedFolders = set()
+            self.startConvert(folders)
+
+
+    def convert(self, dirname, tools, jobs):
+        """Queue the first jobs of tools for dirname, an absolute path,
+           prepared by the scanner. The Gwyexport jobs of a folder converted
+           with Vernissage are queued once the Vernissage job is done, as
+           they need its flat files."""
 
         if debug:
-            print 'convert', path
+            print 'convert', dirname, tools
             print '-->ifpath', self.ifpath
             print '-->iofpath', self.iofpath
             print '-->vofpath', self.vofpath
 
-        
-        currentFolder = os.path.relpath(path, start = self.ifpath)
-
-        if self.exportVernissage.isChecked(): # Do Vernissage conversion
-            if debug: print 'Export vernissage'
-            vofpath = os.path.normpath(
-                            os.path.join(self.vofpath, currentFolder))
-            if not os.path.isdir(vofpath):
-                os.mkdir(vofpath)
-            elif not self.overwrite.isChecked() and currentFolder != '.' :
-                # dir exist + do not overwrite
-                mb = Qt.QMessageBox()
-                mb.setWindowTitle('Error')
-                mb.setIcon(Qt.QMessageBox.Critical)
-                mb.setText(_tr('Error output folder already exists.\n'
-                               'Process stopped'))
-                mb.setDetailedText(_tr('Folder %s exists or cannot '
-                                   'be created.' % vofpath))
-                mb.exec_()
-                raise OSError
-                return
-
-            ## To fix a BUG with VernissageCmd (or possibly Wine)
-            ## which prevent using absolute posix path as input path
-            ## we set the working directory as the current path
-            ## and we run the command with the relative path '.'
-            args = build_command_list(
-                unicode(self.vernissageCmd.text()),
-                unicode(self.vernissageFlags.text()),
-                {'{path}': '.',
-                '{outdir}': vofpath,
-                '{exporter}': unicode(self.vernissageExporter.text())
-                })
-            self.createProcess(args, 'Vernissage', path, workingDirectory=path)
-
-
-        if self.exportImage.isChecked(): # Do Gwyexport
-            if debug: print 'Export images'
-            iofpath = os.path.normpath(
-                            os.path.join(self.iofpath, currentFolder))
-            if not os.path.isdir(iofpath):
-                os.mkdir(iofpath)
-            elif not self.overwrite.isChecked() and currentFolder != '.' :
-                mb = Qt.QMessageBox()
-                mb.setWindowTitle('Error')
-                mb.setIcon(Qt.QMessageBox.Critical)
-                mb.setText(_tr('Error output folder already exists.\n'
-                               'Process stopped'))
-                mb.setDetailedText(_tr('Folder %s exists or cannot '
-                                       'be created.' % iofpath))
-                mb.exec_()
-                raise OSError
-                return
-
-            # Use the flat files rather than Matrix if available
-            if self.exportVernissage.isChecked() and \
-                     unicode(self.vernissageExporter.text()) == 'Flattener':
-                path = vofpath
-
-            args = build_command_list(
-                    unicode(self.gwyexportCmd.text()),
-                    unicode(self.gwyexportFlags.text()),
-                {'{exportformat}': unicode(self.gwyexportFormat.currentText()),
-                 '{outputpath}': iofpath,
-                 '{filterlist}': unicode(self.gwyexportFilters.text()),
-                 '{gradient}': unicode(self.gwyexportGradient.currentText()),
-                 '{colormap}': unicode(self.gwyexportColormap.currentText()),
-                 '{inputfolder}': path,
-                })
-            self.createProcess(args, 'Gwyexport', path )
-
-    def createProcess(self, args, name, folder, workingDirectory=None):
-
-        if debug: print 'Create process'
+        if 'vernissage' in tools:
+            self.plannedTools[dirname] = tools
+            for job in jobs:
+                self.queueJob(job)
+        elif 'gwyexport' in tools:
+            self.queueGwyexportJobs(dirname, jobs)
+
+    def queueGwyexport(self, dirname, pinned=False):
+        """Queue the Gwyexport jobs of dirname"""
+
+        self.queueGwyexportJobs(dirname,
+            engine.gwyexport_jobs(dirname, self.settings)[0], pinned)
+
+    def queueGwyexportJobs(self, dirname, jobs, pinned=False):
+        """Queue the Gwyexport jobs of dirname, the folder is recorded as
+           done if it has no data file"""
+
+        if not jobs and 'gwyexport' in self.journals:
+            self.journals['gwyexport'].record(
+                engine.relative_folder(dirname, self.settings), 'done')
+        for job in jobs:
+            self.queueJob(job, pinned)
+
+    def queueJob(self, engineJob, pinned=False):
+        """Create a job and its table row for a job of the conversion
+        engine, and queue it. A pinned job starts before the other jobs.
+
+        The job state is written to the journal of its output folder."""
+
+        if debug: print 'Queue job', engineJob.tool, engineJob.dirname
+
+        if self.logDir is None:
+            self.logDir = tempfile.mkdtemp(prefix='autoconvert-logs-')
+        log = ProcessLog(spillDir=self.logDir)
+        if engineJob.cwd:
+            log.append('cd %s\n' % engineJob.cwd)
+        log.append(' '.join(engineJob.command) + '\n')
+
+        job = ProcessJob(engineJob.command, engineJob.tool.capitalize(),
+                         engineJob.dirname, engineJob.outdir,
+                         list(engineJob.files) or None, log, engineJob.cwd)
+        job.pinned = pinned
+        job.inputFiles = engineJob.input_files
+        job.inputBytes = engineJob.input_bytes
+        if engineJob.members:
+            job.group = engineJob
+        folders = [member.folder for member in engineJob.members or
+                   [engineJob]]
+        model = self.processesModel
+        journal = self.journals.get(engineJob.tool)
+        if journal is not None:
+            for folder in folders:
+                journal.queued(folder)
+        job.journal = journal
+        job.journalFolder = engineJob.folder
+
+        def processStarted():
+            if journal is not None:
+                for folder in folders:
+                    journal.job_started(folder)
+            job.started = time.time()
+            model.jobChanged(job)
+
+        def processFinished(exitCode):
+            job.finished = time.time()
+            job.outputs = count_outputs(engineJob.outdir, job.started)
+            self.metrics.add(job_record(engineJob.tool, engineJob.folder,
+                job.queued, job.started, job.finished, exitCode,
+                job.inputBytes, job.inputFiles, job.outputs))
+
+            model.jobChanged(job)
+
+        def processCreated(process):
+            def readOutput():
+                log.append(str(process.readAllStandardOutput()))
+                if job.dialog is not None:
+                    job.dialog.showNewOutput()
+
+            def readErrors():
+                log.append("error: " + str(process.readAllStandardError()))
+                if job.dialog is not None:
+                    job.dialog.showNewOutput()
+
+            process.closeReadChannel(Qt.QProcess.StandardOutput)
+            Qt.QObject.connect(process, Qt.SIGNAL("started()"),
+                               processStarted)
+            Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
+                               processFinished)
+            Qt.QObject.connect(process,
+                               Qt.SIGNAL("error(QProcess::ProcessError)"),
+                               lambda error: model.jobChanged(job))
+            Qt.QObject.connect(process,
+                               Qt.SIGNAL("readyReadStandardOutput()"),
+                               readOutput)
+            Qt.QObject.connect(process,
+                               Qt.SIGNAL("readyReadStandardError()"),
+                               readErrors)
+            model.jobChanged(job)
+
+        job.processCreated = processCreated
+        model.addJob(job)
+
+        if 'gwyexport' == engineJob.tool:
+            self.processesQueue2.append(job)
+        else:
+            self.processesQueue1.append(job)
 
-        
-        process = RetardedProcess(args, self) # self will be parent
+        return job
 
-        if workingDirectory:
-            process.setWorkingDirectory(workingDirectory)
-        
-        row = self.processesListWidget.rowCount()
-        self.processesListWidget.insertRow(row)
-
-        processLabel = Qt.QTableWidgetItem(name)
-        folderLabel = Qt.QTableWidgetItem(folder)
-        statusItem = StatusItem()
-
-        col = 0
-        for i, item in enumerate([processLabel, folderLabel, statusItem]):
-            item.setFlags(Qt.Qt.NoItemFlags )
-            item.setFlags(Qt.Qt.ItemIsEnabled)
-            self.processesListWidget.setItem(row, i, item)
-            col = i
-
-        detailButton = Qt.QPushButton(Qt.QIcon('img/detail.svgz'),
-                                     _tr('Details'))
-        detailButton.setCheckable(True)
-        stopButton = Qt.QPushButton(Qt.QIcon('img/stop.svgz'),
-                                    _tr('Stop'))
-        stopButton.setEnabled(False)
-
-        # Ugly by-pass
-        stopButton.setEnabledSlot = lambda: stopButton.setEnabled(True)
-        stopButton.setDisabledSlot = lambda: stopButton.setEnabled(False)
-        statusItem.disconnectSlot = lambda: Qt.QObject.disconnect(self,
-                Qt.SIGNAL("conversionCanceled()"), statusItem.setCanceled)
-
-        self.processesListWidget.setCellWidget(row, col+1, detailButton)
-        self.processesListWidget.setCellWidget(row, col+2, stopButton)
-
-        detailMessageBox = DetailMessageBox(process, detailButton, self)
-        if workingDirectory:
-            detailMessageBox.log.append('cd %s\n' % workingDirectory)
-        detailMessageBox.log.append(Qt.QString(' '.join(args) + '\n'))
-        
-        # Stop and kill
-        Qt.QObject.connect(stopButton, Qt.SIGNAL("clicked()"), process,
-                           Qt.SLOT("terminate()"))
-        killTimer = Qt.QTimer()
-        killTimer.setInterval(5000)
-        Qt.QObject.connect(stopButton, Qt.SIGNAL("clicked()"), killTimer,
-                           Qt.SLOT("start()"))
-        Qt.QObject.connect(killTimer, Qt.SIGNAL("timeout()"), process,
-                           Qt.SLOT("kill()"))
-        Qt.QObject.connect(process, Qt.SIGNAL("started()"),
-                           stopButton.setEnabledSlot)
-        Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
-                           stopButton.setDisabledSlot)
-
-        # Process state
-        process.closeReadChannel(Qt.QProcess.StandardOutput)
-        Qt.QObject.connect(process, Qt.SIGNAL("readyReadStandardOutput()"),
-                           detailMessageBox.readOutput)
-        Qt.QObject.connect(process, Qt.SIGNAL("readyReadStandardError()"),
-                           detailMessageBox.readErrors)
-        Qt.QObject.connect(process, Qt.SIGNAL("finished(int)"),
-                           statusItem.setFinished)
-        Qt.QObject.connect(process, Qt.SIGNAL("started()"),
-                           statusItem.setStarted)
-        Qt.QObject.connect(self, Qt.SIGNAL("conversionCanceled()"),
-                           statusItem.setCanceled)
-        Qt.QObject.connect(stopButton, Qt.SIGNAL("clicked()"),
-                           statusItem.setCanceled)
-
-        # Cancel action
-        Qt.QObject.connect(self.cancelAct, Qt.SIGNAL("triggered()"),
-                           self.processesQueue1.stop)
-        Qt.QObject.connect(self.cancelAct, Qt.SIGNAL("triggered()"),
-                           self.processesQueue2.stop)
-        Qt.QObject.connect(self.cancelAct, Qt.SIGNAL("triggered()"),
-                           stopButton.setDisabledSlot)
-
-
-        # Detail
-        Qt.QObject.connect(detailButton, Qt.SIGNAL("toggled(bool)"),
-                           detailMessageBox.setVisible)
-        Qt.QObject.connect(detailMessageBox, Qt.SIGNAL("finished(int)"),
-                           detailButton.toggle)
-
-        if 'Vernissage' == name:
-            self.processesQueue1.append(process)
-        elif 'Gwyexport' == name:
-            self.processesQueue2.append(process)
-        else: # should never occur
-            self.processesQueue1.append(process)
+    def toggleDetails(self, row):
+        """Show or hide the details of a job, creating its message box the
+        first time"""
+
+        job = self.processesModel.job(row)
+        if job.dialog is None:
+            job.dialog = DetailMessageBox(job, self)
+            Qt.QObject.connect(job.dialog, Qt.SIGNAL("finished(int)"),
+                               lambda result: self.processesModel.jobChanged(job))
+        job.dialog.setVisible(not job.dialog.isVisible())
+        self.processesModel.jobChanged(job)
+
+    def showJobMenu(self, pos):
+        index = self.processesView.indexAt(pos)
+        if not index.isValid():
+            return
+        job = self.processesModel.job(index.row())
+        menu = Qt.QMenu(self)
+        pinAct = menu.addAction(_tr('Convert first'))
+        pinAct.setEnabled(job.state in ('held', 'queued') and not job.pinned)
+        if menu.exec_(self.processesView.viewport().mapToGlobal(pos)) \
+           is pinAct:
+            self.pinJob(job)
+
+    def pinJob(self, job):
+        """Start job, the job it waits for and the jobs waiting for it
+        before the other jobs"""
+
+        jobs = [job]
+        while jobs[-1].waitsFor is not None:
+            jobs.append(jobs[-1].waitsFor)
+        jobs.extend(dependent for queue, dependent in job.dependents)
+        for j in jobs:
+            if j.isDone() or j.state == 'running':
+                continue
+            for queue in (self.processesQueue1, self.processesQueue2):
+                queue.pin(j)
+            self.processesModel.jobChanged(j)
+
+    def stopJob(self, row):
+        job = self.processesModel.job(row)
+        job.stop()
+        self.processesModel.jobChanged(job)
 
     def resetButtons(self):
         if debug: print "Reset buttons called"
         self.startAct.setEnabled(True)
+        self.resumeAct.setEnabled(True)
         self.startButton.setEnabled(True)
         self.cancelAct.setEnabled(False)
         
     def cancelConvert(self):
-        self.emit(Qt.SIGNAL("conversionCanceled()"))
+        self.converting = False
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+        for queue in ('processesQueue1', 'processesQueue2'):
+            if hasattr(self, queue):
+                getattr(self, queue).stop()
+        self.processesModel.cancelAll()
         self.resetButtons()
 
 def main():
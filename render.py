@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file render.py
+    \date 2013
+
+    \mainpage Native rendering of the Flattener files to images
+
+    Read the Flat files written by the Vernissage Flattener exporter, or
+    the Matrix image files directly, into NumPy arrays, apply vectorized
+    equivalents of the Gwyddion filters, map them through a colour
+    gradient and write the images, without starting Gwyexport and loading
+    the Gwyddion libraries for every batch of files.
+    NumPy is needed, and PIL to write JPEG images.
+
+    Usage: python render.py -f png -o OUTDIR --filters 'pc;melc' FILES...
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import sys
+import zlib
+import struct
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from datafiles import FLAT_MAGIC, MATRIX_IMAGE_MAGIC
+import matrix
+
+FORMATS = ('jpg', 'png')
+COLORMAPS = ('full', 'adaptive', 'auto')
+AUTO_CUT = 0.5 # percent of the values out of range on each side with 'auto'
+
+# Approximations of the Gwyddion gradients, as (position, (r, g, b))
+GRADIENTS = {
+    'gray': [(0., (0, 0, 0)), (1., (255, 255, 255))],
+    'gold': [(0., (0, 0, 0)), (0.33, (120, 62, 0)), (0.67, (230, 165, 30)),
+             (1., (255, 255, 200))],
+    'gwyddionnet': [(0., (0, 0, 0)), (0.5, (168, 80, 10)),
+                    (0.85, (250, 190, 80)), (1., (255, 255, 255))],
+    'rust': [(0., (0, 0, 0)), (0.4, (110, 35, 10)), (0.75, (200, 100, 30)),
+             (1., (250, 220, 160))],
+    'warm': [(0., (0, 0, 0)), (0.33, (180, 0, 0)), (0.67, (255, 180, 0)),
+             (1., (255, 255, 255))],
+    'wrappmono': [(0., (0, 0, 0)), (0.5, (255, 255, 255)),
+                  (0.5001, (0, 0, 0)), (1., (255, 255, 255))],
+    'blue': [(0., (0, 0, 0)), (0.5, (20, 60, 200)), (1., (220, 240, 255))],
+    'spectral': [(0., (94, 79, 162)), (0.2, (50, 136, 189)),
+                 (0.4, (171, 221, 164)), (0.6, (254, 224, 139)),
+                 (0.8, (244, 109, 67)), (1., (158, 1, 66))],
+}
+
+
+class RenderError(Exception): pass
+
+
+class _Reader(object):
+    """Read the little endian values of a Flat file in sequence"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from('<' + fmt, self.data, self.offset)
+        self.offset += struct.calcsize('<' + fmt)
+        return values
+
+    def uint32(self):
+        return self.unpack('I')[0]
+
+    def double(self):
+        return self.unpack('d')[0]
+
+    def count(self):
+        """Read a number of items, each taking at least 4 bytes"""
+        count = self.uint32()
+        if 4 * count > len(self.data) - self.offset:
+            raise RenderError('corrupted file')
+        return count
+
+    def string(self):
+        """Read a string stored as its length and UTF-16 characters"""
+        length = self.uint32()
+        end = self.offset + 2 * length
+        if end > len(self.data):
+            raise RenderError('truncated file')
+        value = self.data[self.offset:end].decode('utf-16-le')
+        self.offset = end
+        return value
+
+def _transfer(name, parameters, raw):
+    """Return the physical values of the raw values"""
+
+    if name == 'TFF_Linear1D':
+        return (raw - parameters.get('Offset', 0.)) / \
+               parameters.get('Factor', 1.)
+    if name == 'TFF_MultiLinear1D':
+        factor = (parameters['Raw_1'] - parameters['PreOffset']) / \
+                 (parameters['NeutralFactor'] * parameters['PreFactor'])
+        return (raw - parameters['Offset']) * factor
+    return raw # TFF_Identity
+
+def read_flat(path):
+    """Return the images of a Flat file as 2D float arrays, one per scan
+    direction: forward and backward if the lines are mirrored, up and down
+    if the frame is. The lines not completed are dropped. A file which is
+    not an image, a spectroscopy curve for example, has no image."""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(FLAT_MAGIC):
+        raise RenderError('not a Flat file')
+
+    reader = _Reader(data)
+    reader.offset = len(FLAT_MAGIC)
+    try:
+        axes = []
+        for i in range(reader.count()):
+            reader.string() # name
+            reader.string() # trigger axis name
+            reader.string() # physical unit
+            clocks, = reader.unpack('I')
+            reader.unpack('iidd') # raw start, raw and physical increments
+            mirrored = reader.uint32()
+            for j in range(reader.count()): # table sets
+                reader.string() # axis name
+                reader.unpack('%dI' % (3 * reader.count())) # intervals
+            axes.append((clocks, mirrored))
+
+        reader.string() # channel name
+        function = reader.string()
+        reader.string() # unit
+        parameters = {}
+        for i in range(reader.count()):
+            name = reader.string()
+            parameters[name] = reader.double()
+        reader.unpack('%dI' % reader.count()) # view types
+        reader.unpack('Q') # creation time
+        reader.string() # comment
+        reader.uint32() # bricklet size
+        count = reader.uint32()
+    except struct.error:
+        raise RenderError('truncated file')
+
+    if len(axes) != 2:
+        return []
+    (xclocks, xmirrored), (yclocks, ymirrored) = axes
+    count = min(count, (len(data) - reader.offset) // 4, xclocks * yclocks)
+    raw = numpy.frombuffer(data, '<i4', count, reader.offset)
+    return directions(_transfer(function, parameters, raw.astype(float)),
+                      xclocks, yclocks, xmirrored, ymirrored)
+
+def directions(values, xclocks, yclocks, xmirrored, ymirrored):
+    """Return the images of the scan directions as views of the values,
+    stored line after line with the backward line after the forward one if
+    xmirrored and the down frame after the up one if ymirrored. The lines
+    not completed are dropped."""
+
+    lines = len(values) // xclocks
+    values = values[:lines * xclocks].reshape(lines, xclocks)
+    frames = [values]
+    if ymirrored:
+        frames = [values[:yclocks // 2], values[yclocks // 2:][::-1]]
+    images = []
+    for frame in frames:
+        if xmirrored:
+            images.extend((frame[:, :xclocks // 2],
+                           frame[:, xclocks // 2:][:, ::-1]))
+        else:
+            images.append(frame)
+    return [image for image in images if len(image)]
+
+def read_matrix(path):
+    """Return the images of a Matrix channel file, as read_flat. The
+    transfer function is not applied, the images only depend on the values
+    up to a scale."""
+
+    try:
+        values, (columns, lines, xretrace, yretrace) = \
+            matrix.read_image(path)
+    except matrix.MatrixError, e:
+        raise RenderError(str(e))
+    xclocks = columns * (2 if xretrace else 1)
+    return directions(values, xclocks, lines * (2 if yretrace else 1),
+                      xretrace, yretrace)
+
+def read_images(path):
+    """Return the images of a Flat or Matrix channel file"""
+
+    with open(path, 'rb') as f:
+        head = f.read(len(MATRIX_IMAGE_MAGIC))
+    if head.startswith(MATRIX_IMAGE_MAGIC):
+        return read_matrix(path)
+    return read_flat(path)
+
+def _coordinates(shape):
+    """Return the x and y coordinates of the pixels, between -1 and 1"""
+
+    y, x = numpy.mgrid[:shape[0], :shape[1]].astype(float)
+    return (2 * x / max(shape[1] - 1, 1) - 1,
+            2 * y / max(shape[0] - 1, 1) - 1)
+
+def poly_level(z, xdegree=2, ydegree=2, maxdegree=None):
+    """Subtract the polynomial fitted to z, of degree up to xdegree in x,
+    ydegree in y and maxdegree in total, by default xdegree + ydegree"""
+
+    if maxdegree is None:
+        maxdegree = xdegree + ydegree
+    x, y = _coordinates(z.shape)
+    terms = [x.ravel() ** i * y.ravel() ** j
+             for i in range(xdegree + 1) for j in range(ydegree + 1)
+             if i + j <= maxdegree]
+    design = numpy.column_stack(terms)
+    coefficients = numpy.linalg.lstsq(design, z.ravel(), rcond=None)[0]
+    return z - numpy.dot(design, coefficients).reshape(z.shape)
+
+def plane_level(z):
+    """Subtract the mean plane"""
+    return poly_level(z, 1, 1, 1)
+
+def median_line(z):
+    """Shift each line to a zero median"""
+    return z - numpy.median(z, axis=1)[:, numpy.newaxis]
+
+def mean_filter(z, size=3):
+    """Average each pixel with its size x size neighbours"""
+
+    # an even size has one more neighbour after than before
+    pad = (size - 1) // 2, size // 2
+    padded = numpy.pad(z, (pad, pad), 'edge')
+    sums = padded.cumsum(axis=0).cumsum(axis=1)
+    sums = numpy.pad(sums, ((1, 0), (1, 0)), 'constant')
+    total = (sums[size:, size:] - sums[:-size, size:]
+             - sums[size:, :-size] + sums[:-size, :-size])
+    return total / float(size * size)
+
+def _long_runs(mask, length):
+    """Return the pixels of mask in horizontal runs of at least length"""
+
+    width = mask.shape[1]
+    if width < length:
+        return numpy.zeros_like(mask)
+    zeros = numpy.zeros((mask.shape[0], 1), int)
+    counts = numpy.hstack((zeros, mask.cumsum(axis=1)))
+    starts = counts[:, length:] - counts[:, :-length] == length
+    covered = numpy.hstack((zeros, starts.cumsum(axis=1)))
+    columns = numpy.arange(width)
+    high = numpy.minimum(columns + 1, width - length + 1)
+    low = numpy.maximum(columns - length + 1, 0)
+    return covered[:, high] - covered[:, low] > 0
+
+def remove_scars(z, threshold=0.666, min_length=16, max_width=4):
+    """Replace the scars, strokes of up to max_width lines and at least
+    min_length pixels standing out of the lines above and below by more
+    than threshold times the rms of the line differences, by the
+    interpolation of the lines around"""
+
+    z = z.copy()
+    rows = z.shape[0]
+    limit = threshold * numpy.sqrt(numpy.mean(numpy.diff(z, axis=0) ** 2))
+    if not limit:
+        return z
+    for width in range(1, min(max_width, rows - 2) + 1):
+        above = z[:rows - width - 1]
+        below = z[width + 1:]
+        blocks = [z[k + 1:rows - width + k] for k in range(width)]
+        high = numpy.ones(above.shape, bool)
+        low = numpy.ones(above.shape, bool)
+        for block in blocks:
+            high &= (block - numpy.maximum(above, below) > limit)
+            low &= (numpy.minimum(above, below) - block > limit)
+        scars = _long_runs(high, min_length) | _long_runs(low, min_length)
+        starts, columns = numpy.nonzero(scars)
+        for k in range(width):
+            t = (k + 1.) / (width + 1)
+            z[starts + k + 1, columns] = (1 - t) * z[starts, columns] + \
+                                         t * z[starts + width + 1, columns]
+    return z
+
+# The filters of gwyexport, as name or name:arguments, poly:2,2 or mean:3,
+# with their function, number of arguments and smallest argument
+FILTERS = {'pc': (plane_level, 0, 0),
+           'melc': (median_line, 0, 0),
+           'sr': (remove_scars, 0, 0),
+           'poly': (poly_level, 2, 0),
+           'mean': (mean_filter, 1, 1)}
+
+def parse_filters(filters):
+    """Return the filter functions of a list of filters separated by
+    semicolons, with their integer arguments"""
+
+    functions = []
+    for spec in filters.split(';'):
+        name, sep, arguments = spec.strip().partition(':')
+        if not name:
+            continue
+        if name not in FILTERS:
+            raise RenderError('Unknown filter %s, the native renderer has '
+                              '%s' % (name, ', '.join(sorted(FILTERS))))
+        function, count, minimum = FILTERS[name]
+        try:
+            arguments = [int(a) for a in arguments.split(',') if a.strip()]
+        except ValueError:
+            arguments = None
+        if arguments is None or len(arguments) > count or \
+           any(a < minimum for a in arguments):
+            raise RenderError('Invalid arguments of filter %s' % spec.strip())
+        functions.append(lambda z, f=function, a=arguments: f(z, *a))
+    return functions
+
+def scale(z, colormap):
+    """Return the values of z mapped between 0 and 1"""
+
+    if colormap == 'adaptive':
+        # equalize the histogram, by the rank of each value
+        order = z.ravel().argsort(kind='mergesort')
+        ranks = numpy.empty(z.size)
+        ranks[order] = numpy.arange(z.size)
+        return ranks.reshape(z.shape) / max(z.size - 1, 1)
+    if colormap == 'auto':
+        low, high = numpy.percentile(z, (AUTO_CUT, 100 - AUTO_CUT))
+    else:
+        low, high = z.min(), z.max()
+    if high <= low:
+        return numpy.zeros(z.shape)
+    return numpy.clip((z - low) / (high - low), 0, 1)
+
+def gradient(name):
+    """Return the 256 x 3 colour table of a gradient. The name is matched
+    ignoring the case and punctuation, Wrapp-mono as Wrappmono."""
+
+    key = ''.join(c for c in name.lower() if c.isalnum())
+    if key not in GRADIENTS:
+        raise RenderError('Unknown gradient %s, the native renderer has %s'
+                          % (name, ', '.join(sorted(GRADIENTS))))
+    stops = GRADIENTS[key]
+    positions = [p for p, color in stops]
+    levels = numpy.linspace(0, 1, 256)
+    return numpy.column_stack([numpy.interp(levels, positions,
+                                            [color[i] for p, color in stops])
+                               for i in range(3)]).round().astype(numpy.uint8)
+
+def write_png(path, rgb):
+    """Write the rows x columns x 3 uint8 array as a PNG image"""
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + \
+               struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    height, width = rgb.shape[:2]
+    scanlines = numpy.zeros((height, 1 + 3 * width), numpy.uint8)
+    scanlines[:, 1:] = rgb.reshape(height, -1) # filter type 0 per line
+    with open(path, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2,
+                                          0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(scanlines.tostring(), 6)))
+        f.write(chunk('IEND', ''))
+
+def write_image(path, rgb, format):
+    if Image is not None:
+        Image.fromarray(rgb).save(path, 'JPEG' if format == 'jpg' else 'PNG')
+    elif format == 'png':
+        write_png(path, rgb)
+    else:
+        raise RenderError('PIL is needed to write JPEG images')
+
+def check(format, filters, gradient_name, colormap):
+    """Raise RenderError if the images can not be rendered with these
+    settings"""
+
+    if numpy is None:
+        raise RenderError('The native renderer needs NumPy')
+    if format not in FORMATS:
+        raise RenderError('Unknown image format %s' % format)
+    if format == 'jpg' and Image is None:
+        raise RenderError('The native renderer needs PIL to write JPEG '
+                          'images, use the png format')
+    if colormap not in COLORMAPS:
+        raise RenderError('Unknown colormap %s' % colormap)
+    parse_filters(filters)
+    gradient(gradient_name)
+
+def render_file(path, outdir, format, filters, table, colormap):
+    """Render the images of the file at path in outdir, as the file name
+    followed by the image number. Return the number of images."""
+
+    images = read_images(path)
+    basename = os.path.basename(path)
+    for number, z in enumerate(images):
+        z = z.astype(float)
+        for apply in filters:
+            z = apply(z)
+        levels = (scale(z, colormap) * 255).round().astype(int)
+        # the first line is at the bottom
+        rgb = table[levels[::-1]]
+        write_image(os.path.join(outdir, '%s_%d.%s' % (basename, number,
+                                                       format)),
+                    rgb, format)
+    return len(images)
+
+parser = argparse.ArgumentParser(description='''Render Flat or Matrix
+files to images, as gwyexport does.''')
+parser.add_argument('-f', '--format', choices=FORMATS, default='jpg',
+    help='Image output format')
+parser.add_argument('-o', '--outputpath', default='.',
+    help='Image files output folder')
+parser.add_argument('--filters', default='pc;melc;sr;melc;pc',
+    help='Filters applied in order, separated by semicolons: %s.'
+         % ', '.join(sorted(FILTERS)))
+parser.add_argument('--gradient', default='Wrappmono',
+    help='Colour gradient: %s.' % ', '.join(sorted(GRADIENTS)))
+parser.add_argument('--colormap', choices=COLORMAPS, default='adaptive',
+    help='Colour scale of the values, full range, equalized or without the '
+         'outliers.')
+parser.add_argument('files', nargs='+',
+    help='The Flat or Matrix channel files to render.')
+
+def main(argv=None):
+    """Render the files given by the command line arguments argv. Return 0
+    if all the files were rendered, 1 otherwise."""
+
+    args = parser.parse_args(argv)
+    try:
+        check(args.format, args.filters, args.gradient, args.colormap)
+    except RenderError, e:
+        print >> sys.stderr, e
+        return 1
+    filters = parse_filters(args.filters)
+    table = gradient(args.gradient)
+
+    returncode = 0
+    for path in args.files:
+        try:
+            render_file(path, args.outputpath, args.format, filters, table,
+                        args.colormap)
+        except Exception, e: # a bad file must not stop the others
+            print >> sys.stderr, 'Error rendering %s: %s: %s' % (path,
+                                                    type(e).__name__, e)
+            returncode = 1
+    return returncode
+
+if __name__ == "__main__":
+    sys.exit(main())
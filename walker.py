@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file walker.py
+    \date 2013
+
+    \mainpage Fast walk of the folder trees
+
+    Walk the input trees with scandir where available, which tells the
+    subfolders from the directory entries without a stat of each entry,
+    and cache the existence of the output folders, listed once per parent
+    rather than stat'ed one by one. On a network drive each stat is a round
+    trip to the server.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+
+try:
+    from os import scandir # Python 3.5
+except ImportError:
+    try:
+        from scandir import scandir # the scandir package
+    except ImportError:
+        scandir = None
+
+def _subfolders(dirpath, links=True):
+    """Return the names of the subfolders of dirpath, without the links to
+    folders unless links"""
+
+    if scandir is None:
+        return [name for name in os.listdir(dirpath)
+                if os.path.isdir(os.path.join(dirpath, name)) and
+                   (links or not os.path.islink(os.path.join(dirpath, name)))]
+    return [entry.name for entry in scandir(dirpath)
+            if entry.is_dir(follow_symlinks=links)]
+
+def walk(top, cancelled=None):
+    """Yield top and its subfolders, parents first as os.walk does.
+
+    The links to folders are not followed and the folders which can not be
+    listed are skipped. The walk stops as soon as
+    cancelled(), if given, returns True."""
+
+    stack = [top]
+    while stack:
+        if cancelled is not None and cancelled():
+            return
+        dirpath = stack.pop()
+        try:
+            names = sorted(_subfolders(dirpath, links=False))
+        except OSError:
+            continue
+        yield dirpath
+        stack.extend(os.path.join(dirpath, name) for name in reversed(names))
+
+
+class StatCache(object):
+    """Tell whether folders exist, listing each parent folder once with
+    scandir, or with a stat of each folder once otherwise.
+
+    Meant for a single planning pass, the folders created meanwhile are
+    not seen."""
+
+    def __init__(self):
+        self.known = {} # path -> whether a folder
+        self.listed = set() # parents whose subfolders are known
+
+    def isdir(self, path):
+        path = os.path.normpath(os.path.abspath(path))
+        if path in self.known:
+            return self.known[path]
+        parent = os.path.dirname(path)
+        if scandir is None or parent == path:
+            self.known[path] = os.path.isdir(path)
+        elif parent not in self.listed:
+            self.listed.add(parent)
+            try:
+                for name in _subfolders(parent):
+                    self.known[os.path.join(parent, name)] = True
+            except OSError:
+                pass
+        return self.known.setdefault(path, False)
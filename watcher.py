@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    \package autoconvert
+
+    \file watcher.py
+    \date 2013
+
+    \mainpage Watch input folders for new data files
+
+    Use inotify on Linux and fall back to polling the folders elsewhere, or
+    when no more inotify watches are available. Files are reported only once
+    they did not change for a settle time, so that files still being written
+    by the instrument are not converted too early.
+
+    \section Copyright
+
+    Copyright (C) 2011 François Bianco, University of Geneva - francois.bianco@unige.ch
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+debug = False
+
+# inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyUnavailable(Exception): pass
+
+
+def _load_libc():
+    if not hasattr(os, 'uname') or os.uname()[0] != 'Linux':
+        raise InotifyUnavailable
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+    except (OSError, AttributeError):
+        raise InotifyUnavailable
+    return libc
+
+
+def _is_excluded(path, exclude):
+    for folder in exclude:
+        if path == folder or path.startswith(folder + os.sep):
+            return True
+    return False
+
+
+class InotifyBackend(object):
+    """Report the files modified in the watched folders using inotify"""
+
+    def __init__(self, folders, recursive, exclude):
+        self.libc = _load_libc()
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise InotifyUnavailable
+        self.recursive = recursive
+        self.exclude = exclude
+        self.folders = {} # watch descriptor -> folder
+        try:
+            for folder in folders:
+                self.add_folder(folder)
+        except InotifyUnavailable:
+            self.close()
+            raise
+
+    def add_folder(self, folder):
+        """Watch folder, and its subfolders if recursive. Return the files
+           which already exist in new subfolders."""
+
+        found = []
+        for dirname, subdirnames, filenames in os.walk(folder):
+            if _is_excluded(dirname, self.exclude):
+                subdirnames[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, dirname, WATCH_MASK)
+            if wd < 0: # usually ENOSPC, the max_user_watches limit
+                raise InotifyUnavailable
+            self.folders[wd] = dirname
+            found.extend(os.path.join(dirname, f) for f in filenames)
+            if not self.recursive:
+                break
+        return found
+
+    def read(self, timeout):
+        """Wait up to timeout seconds, return the modified file paths"""
+
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+
+        buf = os.read(self.fd, 64*1024)
+        paths = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset+length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, report every watched folder again
+                for folder in self.folders.values():
+                    paths.extend(os.path.join(folder, f)
+                                 for f in os.listdir(folder))
+                continue
+            if wd not in self.folders or not name:
+                continue
+            path = os.path.join(self.folders[wd], name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO) \
+                   and not _is_excluded(path, self.exclude):
+                    paths.extend(self.add_folder(path))
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend(object):
+    """Report the files modified in the watched folders by comparing
+       periodic listings of the folders"""
+
+    def __init__(self, folders, recursive, exclude, interval=2.0):
+        self.folders = folders
+        self.recursive = recursive
+        self.exclude = exclude
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for folder in self.folders:
+            for dirname, subdirnames, filenames in os.walk(folder):
+                if _is_excluded(dirname, self.exclude):
+                    subdirnames[:] = []
+                    continue
+                for filename in filenames:
+                    path = os.path.join(dirname, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError: # removed in the meantime
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime)
+                if not self.recursive:
+                    break
+        return snapshot
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        paths = [path for path, state in snapshot.items()
+                      if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    """Watch folders and report the folders with new or changed files.
+
+    A file is reported once no event was seen for it during settle
+    seconds. Output folders given in exclude are never reported, in case
+    they are inside the watched folders."""
+
+    def __init__(self, folders, recursive=False, exclude=(), settle=5.0,
+                 polling=False):
+
+        folders = [os.path.abspath(folder) for folder in folders]
+        exclude = [os.path.abspath(folder) for folder in exclude]
+        self.settle = settle
+        self.pending = {} # path -> time of the last event
+
+        self.backend = None
+        if not polling:
+            try:
+                self.backend = InotifyBackend(folders, recursive, exclude)
+            except InotifyUnavailable:
+                if debug: print 'inotify unavailable, polling folders'
+        if self.backend is None:
+            self.backend = PollingBackend(folders, recursive, exclude)
+
+    def changes(self, timeout=0):
+        """Wait up to timeout seconds for events, and return the list of
+           folders containing files which have settled."""
+
+        paths = self.backend.read(timeout)
+        now = time.time() # after the wait, not to report them early
+        for path in paths:
+            self.pending[path] = now
+
+        folders = set()
+        for path, seen in self.pending.items():
+            if now - seen >= self.settle:
+                del self.pending[path]
+                if os.path.isfile(path):
+                    folders.add(os.path.dirname(path))
+        return sorted(folders)
+
+    def close(self):
+        self.backend.close()